@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+"""
+End to end REST benchmark for the MeArm servers.
+
+Each server is started in a subprocess against its simulated backend (see
+GPIODirect/SimPigpio.py and I2C/SimBus.py) and driven by concurrent HTTP
+clients through a number of scenarios:
+
+    sliders  - slider storm: all clients share the session holding the
+               control stick and PUT joint positions as fast as they can
+    polling  - info polling: independent clients GET joint info
+    stick    - control stick contention: every client tries to take the
+               stick, move a joint and release it again. A 402 for a stick
+               held by someone else is an expected outcome, not an error.
+               GPIODirect only, the I²C server has no control stick.
+    static   - static asset loads of the UI page, scripts and style sheets
+
+For every server and scenario the p50/p95/p99 latencies, requests per second,
+HTTP status counts and simulated hardware calls per request are reported, and
+all results are written to a JSON file. Passing an earlier results file with
+--compare reports the change per scenario, and exits with status 1 if any
+scenario got slower or lost throughput by more than the threshold:
+
+    python Benchmark.py -o new.json --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import urllib2
+import argparse
+import tempfile
+import threading
+import cookielib
+import subprocess
+
+## The directory this script lives in, with the server directories below it
+BASE = os.path.dirname(os.path.abspath(__file__))
+
+## Server definitions
+SERVERS = {
+    'gpio': {
+        'dir': 'GPIODirect',
+        'script': 'MeArmServer.py',
+        'conf': {'arm.backend': 'sim', 'arm.sim': {}},
+        'joint': '/services/arm/{}',
+        'stick': '/services/control',
+        'static': ['/', '/static/js/MeArmControl.js',
+                   '/static/css/style.css'],
+    },
+    'i2c': {
+        'dir': 'I2C',
+        'script': 'MeArmServerI2C.py',
+        'conf': {'i2c.backend': 'sim', 'i2c.sim': {}},
+        'joint': '/services/{}',
+        'stick': None,
+        'static': ['/', '/static/js/MeArmControl.js', '/static/js/script.js',
+                   '/static/css/style.css'],
+    },
+}
+
+## The joints to spread requests over
+JOINTS = ['base', 'shoulder', 'wrist', 'grip']
+
+## Default latency regression threshold as a fraction
+THRESHOLD = 0.2
+
+class Client(object):
+    """
+    HTTP client with its own session cookie.
+    """
+
+    def __init__(self, url, jar=None):
+        """
+        @param url: The server base URL.
+        @param jar: Optional cookie jar to share a session with another client.
+        """
+        self.url = url
+        self.jar = cookielib.CookieJar() if jar is None else jar
+        self.opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(self.jar))
+
+    def request(self, method, path, body=None):
+        """
+        Makes a request.
+
+        @param method: The HTTP method.
+        @param path: The path on the server.
+        @param body: Optional object to send as JSON.
+        @return: (status, response body) tuple. Status is 0 for a connection
+                 failure.
+        """
+        data = None if body is None else json.dumps(body)
+        req = urllib2.Request(self.url + path, data)
+        req.get_method = lambda: method
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        try:
+            res = self.opener.open(req, timeout=10)
+            return res.getcode(), res.read()
+        except urllib2.HTTPError, e:
+            return e.code, e.read()
+        except (urllib2.URLError, socket.error), e:
+            return 0, str(e)
+
+class Server(object):
+    """
+    A server subprocess running against its simulated backend.
+    """
+
+    def __init__(self, name, port, sim=None):
+        """
+        @param name: The server name; a key in SERVERS.
+        @param port: The port to listen on.
+        @param sim: Optional keyword args for the simulated backend.
+        """
+        self.name = name
+        self.defn = SERVERS[name]
+        self.port = port
+        self.url = "http://127.0.0.1:{}".format(port)
+        self.sim = sim or {}
+        self.proc = None
+        self.confFile = None
+        self.log = None
+
+    def start(self, timeout=30):
+        """
+        Starts the server and waits for it to answer.
+
+        @raises RuntimeError: If the server does not come up within timeout.
+        """
+        conf = dict(self.defn['conf'])
+        for k in conf:
+            if k.endswith('.sim'):
+                conf[k] = self.sim
+        conf.update({'server.socket_host': '127.0.0.1',
+                     'server.socket_port': self.port,
+                     'log.screen': False})
+        fd, self.confFile = tempfile.mkstemp(suffix='.conf')
+        with os.fdopen(fd, 'w') as f:
+            f.write("[global]\n")
+            for k, v in sorted(conf.items()):
+                f.write("{} = {!r}\n".format(k, v))
+
+        path = os.path.join(BASE, self.defn['dir'])
+        self.log = open(os.path.join(tempfile.gettempdir(),
+                                     "bench-{}.log".format(self.name)), 'w')
+        self.proc = subprocess.Popen([sys.executable, self.defn['script'],
+                                      self.confFile], cwd=path,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+        client = Client(self.url)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            if client.request('GET', '/services/sim')[0] == 200:
+                return
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("Server {} did not start, see {}"\
+                           .format(self.name, self.log.name))
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        self.proc = None
+        if self.confFile is not None:
+            os.remove(self.confFile)
+            self.confFile = None
+        if self.log is not None:
+            self.log.close()
+
+    def hwCalls(self):
+        """
+        @return: The simulated backend call counters per method.
+        """
+        status, body = Client(self.url).request('GET', '/services/sim')
+        return json.loads(body) if status == 200 else {}
+
+
+def sliders(server, clients):
+    """
+    Slider storm scenario.
+    """
+    defn = server.defn
+    owner = Client(server.url)
+    if defn['stick']:
+        owner.request('GET', defn['stick'] + '?name=bench')
+    fns = []
+    for n in range(clients):
+        c = Client(server.url, owner.jar)
+        def fn(c=c, rnd=random.Random(n)):
+            j = rnd.choice(JOINTS)
+            return [c.request('PUT', defn['joint'].format(j),
+                              {'pos': rnd.randint(85, 95)})]
+        fns.append(fn)
+    done = None
+    if defn['stick']:
+        done = lambda: owner.request('DELETE', defn['stick'])
+    return fns, done
+
+def polling(server, clients):
+    """
+    Info polling scenario.
+    """
+    defn = server.defn
+    fns = []
+    for n in range(clients):
+        c = Client(server.url)
+        def fn(c=c, rnd=random.Random(n)):
+            j = rnd.choice(JOINTS)
+            return [c.request('GET', defn['joint'].format(j) + '/info')]
+        fns.append(fn)
+    return fns, None
+
+def stick(server, clients):
+    """
+    Control stick contention scenario.
+    """
+    defn = server.defn
+    fns = []
+    for n in range(clients):
+        c = Client(server.url)
+        def fn(c=c, n=n, rnd=random.Random(n)):
+            res = [c.request('GET', defn['stick'] + '?name=c{}'.format(n))]
+            if res[0][0] == 200:
+                res.append(c.request('PUT', defn['joint'].format('grip'),
+                                     {'pos': rnd.randint(85, 95)}))
+                res.append(c.request('DELETE', defn['stick']))
+            return res
+        fns.append(fn)
+    return fns, None
+
+def static(server, clients):
+    """
+    Static asset load scenario.
+    """
+    defn = server.defn
+    fns = []
+    for n in range(clients):
+        c = Client(server.url)
+        def fn(c=c, rnd=random.Random(n)):
+            return [c.request('GET', rnd.choice(defn['static']))]
+        fns.append(fn)
+    return fns, None
+
+## The scenarios in the order they are run. Each scenario is a function taking
+## the Server and number of clients, and returning a list with a request
+## function per client, and a function to call when done, or None. A request
+## function makes one or more requests and returns the list of
+## (status, body) tuples.
+SCENARIOS = [('sliders', sliders), ('polling', polling), ('stick', stick),
+             ('static', static)]
+
+## Statuses that are expected outcomes for a scenario. Requests shed by
+## admission control are reported in the status counts, but are not errors.
+EXPECTED = {'sliders': [429, 503], 'stick': [402, 429, 503]}
+
+def percentile(vals, p):
+    """
+    @param vals: Sorted list of values.
+    @param p: The percentile (0-100).
+    @return: The nearest rank percentile, or None for no values.
+    """
+    if not vals:
+        return None
+    i = int(round(p / 100.0 * (len(vals) - 1)))
+    return vals[i]
+
+def runScenario(server, name, setup, clients, duration):
+    """
+    Runs a scenario against a server for a duration.
+
+    @return: Dictionary with the scenario results.
+    """
+    fns, done = setup(server, clients)
+    before = server.hwCalls()
+    stop = threading.Event()
+    lat = [[] for f in fns]
+    statuses = [{} for f in fns]
+
+    def worker(i):
+        while not stop.is_set():
+            for status, t in timed(fns[i]):
+                lat[i].append(t)
+                statuses[i][status] = statuses[i].get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(len(fns))]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+    after = server.hwCalls()
+    if done is not None:
+        done()
+
+    allLat = sorted(t for l in lat for t in l)
+    status = {}
+    for s in statuses:
+        for k, v in s.items():
+            status[k] = status.get(k, 0) + v
+    n = len(allLat)
+    ok = [200] + EXPECTED.get(name, [])
+    calls = dict((k, after.get(k, 0) - before.get(k, 0)) for k in after)
+    calls = dict((k, v) for k, v in calls.items() if v)
+    ms = lambda v: None if v is None else round(v*1000.0, 3)
+    return {
+        'server': server.name,
+        'scenario': name,
+        'clients': clients,
+        'duration': round(elapsed, 3),
+        'requests': n,
+        'errors': sum(v for k, v in status.items() if k not in ok),
+        'status': dict((str(k), v) for k, v in status.items()),
+        'rps': round(n / elapsed, 1),
+        'latencyMs': {'p50': ms(percentile(allLat, 50)),
+                      'p95': ms(percentile(allLat, 95)),
+                      'p99': ms(percentile(allLat, 99)),
+                      'max': ms(allLat[-1] if allLat else None)},
+        'hwCalls': calls,
+        'hwCallsPerRequest': round(sum(calls.values()) / float(n), 3) \
+                             if n else None,
+    }
+
+def timed(fn):
+    """
+    Calls a scenario request function and times each request it makes.
+
+    @return: List of (status, seconds) tuples. When a function makes more
+             than one request, the time is spread evenly over them.
+    """
+    t = time.time()
+    res = fn()
+    t = (time.time() - t) / len(res)
+    return [(status, t) for status, body in res]
+
+def gitVersion():
+    """
+    @return: The git description of the working tree, or None.
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+                                        '--dirty'], cwd=BASE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new, threshold):
+    """
+    Compares two result sets and prints the change per scenario.
+
+    @return: True if any scenario regressed by more than threshold.
+    """
+    key = lambda r: (r['server'], r['scenario'])
+    prev = dict((key(r), r) for r in old['results'])
+    regressed = False
+    print "\nChange from {}:".format(old.get('version'))
+    for r in new['results']:
+        o = prev.get(key(r))
+        if o is None or not o['requests'] or not r['requests']:
+            continue
+        p95 = r['latencyMs']['p95'] / max(o['latencyMs']['p95'], 0.001) - 1
+        rps = r['rps'] / max(o['rps'], 0.001) - 1
+        flag = p95 > threshold or rps < -threshold
+        regressed = regressed or flag
+        print "  {:5} {:8} p95 {:+6.1%}  rps {:+6.1%}{}"\
+              .format(r['server'], r['scenario'], p95, rps,
+                      "  REGRESSION" if flag else "")
+    return regressed
+
+def report(r):
+    l = r['latencyMs']
+    print "  {:5} {:8} {:7} req {:8.1f} rps  p50 {:7.2f}  p95 {:7.2f}  "\
+          "p99 {:7.2f} ms  {:6.2f} hw/req  {} errors"\
+          .format(r['server'], r['scenario'], r['requests'], r['rps'],
+                  l['p50'] or 0, l['p95'] or 0, l['p99'] or 0,
+                  r['hwCallsPerRequest'] or 0, r['errors'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MeArm REST server "
+                                     "benchmark against simulated backends.")
+    parser.add_argument('-s', '--servers', nargs='+', default=sorted(SERVERS),
+                        choices=sorted(SERVERS), help="Servers to benchmark")
+    parser.add_argument('-S', '--scenarios', nargs='+',
+                        default=[s for s, f in SCENARIOS],
+                        choices=[s for s, f in SCENARIOS],
+                        help="Scenarios to run")
+    parser.add_argument('-c', '--clients', type=int, default=8,
+                        help="Concurrent clients per scenario")
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help="Seconds per scenario")
+    parser.add_argument('-p', '--port', type=int, default=18081,
+                        help="Port for the first server")
+    parser.add_argument('--sim', type=json.loads, default={},
+                        help="JSON object with simulated backend keyword args")
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help="Results file")
+    parser.add_argument('--compare', help="Earlier results file to compare "
+                        "against")
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help="Regression threshold as a fraction")
+    args = parser.parse_args()
+
+    results = {'version': gitVersion(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': sys.version.split()[0],
+               'clients': args.clients,
+               'duration': args.duration,
+               'sim': args.sim,
+               'results': []}
+    for i, name in enumerate(args.servers):
+        server = Server(name, args.port + i, args.sim)
+        server.start()
+        try:
+            for scen, setup in SCENARIOS:
+                if scen not in args.scenarios:
+                    continue
+                if scen == 'stick' and not server.defn['stick']:
+                    continue
+                r = runScenario(server, scen, setup, args.clients,
+                                args.duration)
+                report(r)
+                results['results'].append(r)
+        finally:
+            server.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print "Results written to", args.output
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.threshold):
+                sys.exit(1)
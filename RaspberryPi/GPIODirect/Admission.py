@@ -0,0 +1,226 @@
+# *-* coding: utf-8 *-*
+"""
+Bounded admission control for requests that need the arm hardware.
+
+Only a few requests can usefully use the hardware at the same time, as it is
+one pigpiod connection or I²C bus behind a lock. Letting every request thread
+queue up on it makes latency grow without bound under load. Instead, the
+AdmissionController admits at most maxActive requests at a time and holds at
+most maxQueue more in a bounded queue. Anything beyond that is rejected
+straight away with an estimate of when to retry:
+
+    adm = AdmissionController(maxActive=1, maxQueue=16, perClient=4)
+    try:
+        adm.admit(clientIP)
+    except Rejected, e:
+        ... respond with e.status and a Retry-After of e.retryAfter
+    try:
+        ... use the hardware
+    finally:
+        adm.release(clientIP)
+
+Queued requests are admitted round robin per client, so one client sending a
+burst of requests can not starve the others, and no client can have more than
+perClient requests admitted or queued at once.
+
+In a CherryPy request, rejectRequest() sends the rejection response.
+"""
+
+import json
+import math
+import threading
+from collections import deque
+
+try:
+    import cherrypy
+except ImportError:
+    # The controller itself does not need CherryPy, only rejectRequest()
+    cherrypy = None
+
+from Clock import monotonic
+from Metrics import REGISTRY, describe
+
+describe('mearm_admission_wait_seconds', "Time admitted requests waited in "
+         "the admission queue.")
+describe('mearm_admission_rejected_total', "Requests rejected by admission "
+         "control.")
+_wait = REGISTRY.histogram('mearm_admission_wait_seconds')
+
+class Rejected(Exception):
+    """
+    Raised when a request is not admitted.
+    """
+
+    def __init__(self, status, retryAfter, message):
+        """
+        @param status: The HTTP status to respond with; 429 when the client
+               has too many requests outstanding, 503 when the server is
+               overloaded.
+        @param retryAfter: Whole seconds after which to retry.
+        @param message: The reason.
+        """
+        super(Rejected, self).__init__(message)
+        self.status = status
+        self.retryAfter = retryAfter
+
+## HTTP status lines for rejections
+STATUS = {429: "429 Too Many Requests",
+          503: "503 Service Unavailable"}
+
+def rejectRequest(status, message, retryAfter):
+    """
+    Answers the current CherryPy request with an error status and a
+    Retry-After header without running the handler. An HTTPError can not be
+    used for this, as CherryPy removes the Retry-After header from error
+    responses.
+
+    @param status: The HTTP status code, a key of STATUS.
+    @param message: The error message.
+    @param retryAfter: Seconds the client should wait before retrying.
+    """
+    resp = cherrypy.response
+    resp.status = STATUS[status]
+    resp.headers['Retry-After'] = str(retryAfter)
+    resp.headers['Content-Type'] = 'application/json'
+    resp.body = json.dumps({'status': resp.status, 'message': message})
+    # Skip the handler
+    cherrypy.request.handler = None
+
+class _Waiter(object):
+    __slots__ = ['client', 'granted']
+
+    def __init__(self, client):
+        self.client = client
+        self.granted = False
+
+class AdmissionController(object):
+    """
+    Bounded, per client fair admission queue.
+    """
+
+    def __init__(self, maxActive=1, maxQueue=16, perClient=4, timeout=2.0):
+        """
+        @param maxActive: The number of requests admitted at the same time.
+        @param maxQueue: The number of requests waiting at most.
+        @param perClient: The number of requests one client can have admitted
+               or waiting at most.
+        @param timeout: Seconds a request waits in the queue at most before it
+               is rejected.
+        """
+        self.maxActive = maxActive
+        self.maxQueue = maxQueue
+        self.perClient = perClient
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        # Waiters per client, and the clients with waiters in round robin order
+        self._waiters = {}
+        self._order = deque()
+        # Admitted and waiting requests per client
+        self._perClient = {}
+        # Moving average of the time a request is admitted for, in seconds
+        self.avgService = 0.05
+        # Admission time per thread, for the service time average
+        self._local = threading.local()
+
+    def retryAfter(self):
+        """
+        @return: The estimated seconds until the queue has drained, at least 1.
+        """
+        t = (self.active + self.queued) * self.avgService / self.maxActive
+        return max(1, int(math.ceil(t)))
+
+    def _reject(self, status, message):
+        REGISTRY.counter('mearm_admission_rejected_total',
+                         status=str(status)).inc()
+        raise Rejected(status, self.retryAfter(), message)
+
+    def admit(self, client):
+        """
+        Admits a request, waiting in the queue if needed. Every successful
+        admit() must be followed by a release() in the same thread.
+
+        @param client: The client key, like its IP address.
+        @raises Rejected: If the request is not admitted.
+        """
+        t = monotonic()
+        with self._cond:
+            n = self._perClient.get(client, 0)
+            if n >= self.perClient:
+                self._reject(429, "Too many requests outstanding.")
+            if self.active < self.maxActive and self.queued == 0:
+                self.active += 1
+                self._perClient[client] = n + 1
+                self._local.start = monotonic()
+                _wait.observe(0.0)
+                return
+            if self.queued >= self.maxQueue:
+                self._reject(503, "Server busy.")
+
+            w = _Waiter(client)
+            if client not in self._waiters:
+                self._waiters[client] = deque()
+                self._order.append(client)
+            self._waiters[client].append(w)
+            self.queued += 1
+            self._perClient[client] = n + 1
+
+            deadline = t + self.timeout
+            while not w.granted:
+                left = deadline - monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            if not w.granted:
+                # Timed out, so take ourselves out of the queue
+                q = self._waiters[client]
+                q.remove(w)
+                if not q:
+                    del self._waiters[client]
+                    self._order.remove(client)
+                self.queued -= 1
+                self._done(client)
+                self._reject(503, "Server busy.")
+        self._local.start = monotonic()
+        _wait.observe(self._local.start - t)
+
+    def _done(self, client):
+        n = self._perClient[client] - 1
+        if n:
+            self._perClient[client] = n
+        else:
+            del self._perClient[client]
+
+    def release(self, client):
+        """
+        Releases an admitted request, and admits the next one in the queue.
+
+        @param client: The client key given to admit().
+        """
+        service = monotonic() - getattr(self._local, 'start', monotonic())
+        with self._cond:
+            self.avgService += 0.2 * (service - self.avgService)
+            self.active -= 1
+            self._done(client)
+            if self._order:
+                # Next client in round robin order
+                c = self._order.popleft()
+                q = self._waiters[c]
+                q.popleft().granted = True
+                if q:
+                    self._order.append(c)
+                else:
+                    del self._waiters[c]
+                self.queued -= 1
+                self.active += 1
+                self._cond.notify_all()
+
+    def status(self):
+        """
+        @return: A dictionary with the admission state.
+        """
+        return {'active': self.active, 'queued': self.queued,
+                'clients': len(self._perClient),
+                'avgService': self.avgService,
+                'retryAfter': self.retryAfter()}
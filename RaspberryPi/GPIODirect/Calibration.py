@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+"""
+Per servo calibration curves.
+
+Cheap servos are not linear: the angle reached for a pulse width differs from
+a straight line between the 0° and 180° pulse widths, and differently for
+every servo. A calibration curve is a list of measured (angle, pulse width)
+points for one servo, interpolated piecewise linearly between the points and
+extrapolated from the end segments outside them.
+
+Curves are compiled into dense lookup tables at 0.1° resolution, for both
+directions, so converting in the hot path is one index calculation and one
+array lookup:
+
+    curve = Curve([(0, 560), (45, 1010), (90, 1490), (135, 1990), (180, 2480)])
+    pw = curve.angleToPulse(92.5)
+    a = curve.pulseToAngle(pw)      # 92.5
+
+Converting an angle to a pulse width and back gives the same angle, as long
+as the curve has at least 1µs per 0.1° everywhere.
+
+The calibration for all joints is stored as JSON, keyed on joint name:
+
+    {"base": [[0, 560], [90, 1490], [180, 2480]], ...}
+
+To measure the points for the joints, by moving each servo to a set of
+reference angles checked with a protractor:
+
+    python Calibration.py [-j joint] [-a angles] [--sim] [file]
+"""
+
+import json
+from array import array
+
+## Table steps per degree
+RES = 10
+## Default calibration file
+PATH = 'calibration.json'
+
+class Curve(object):
+    """
+    Compiled angle to pulse width calibration curve for one servo.
+    """
+    __slots__ = ['points', 'a2p', 'p2a', 'pLo']
+
+    def __init__(self, points):
+        """
+        @param points: List of (angle, pulse width) pairs. There must be at
+               least two, with increasing angles and strictly increasing or
+               decreasing pulse widths.
+        @raises ValueError: If the points are not valid.
+        """
+        points = sorted((float(a), float(p)) for a, p in points)
+        if len(points) < 2:
+            raise ValueError("At least two calibration points are needed")
+        da = [b[0] - a[0] for a, b in zip(points, points[1:])]
+        dp = [b[1] - a[1] for a, b in zip(points, points[1:])]
+        if min(da) <= 0:
+            raise ValueError("Calibration angles must be unique")
+        if not (min(dp) > 0 or max(dp) < 0):
+            raise ValueError("Calibration pulse widths must be strictly "
+                             "increasing or decreasing with the angle")
+        self.points = points
+
+        # Pulse width per 0.1° from 0 to 180°
+        self.a2p = array('H', [int(round(self._pulse(i / float(RES))))
+                               for i in xrange(180*RES + 1)])
+        # Angle in 0.1° per pulse width over the pulse widths in the table
+        self.pLo = min(self.a2p)
+        pHi = max(self.a2p)
+        self.p2a = array('H', [int(round(self._angle(p) * RES))
+                               for p in xrange(self.pLo, pHi + 1)])
+
+    @classmethod
+    def linear(cls, pwMin, pwMax):
+        """
+        @return: A straight line curve from pwMin at 0° to pwMax at 180°.
+        """
+        return cls([(0, pwMin), (180, pwMax)])
+
+    def _segment(self, v, k):
+        """
+        @return: The pair of points to interpolate v between, where k is 0 to
+                 look v up as an angle, or 1 as a pulse width.
+        """
+        pts = self.points
+        if k == 1 and pts[0][1] > pts[-1][1]:
+            # Decreasing pulse widths, so search from the other end
+            pts = pts[::-1]
+        for a, b in zip(pts, pts[1:-1]):
+            if v <= b[k]:
+                return a, b
+        return pts[-2], pts[-1]
+
+    def _pulse(self, a):
+        (a0, p0), (a1, p1) = self._segment(a, 0)
+        return p0 + (a - a0) * (p1 - p0) / (a1 - a0)
+
+    def _angle(self, p):
+        (a0, p0), (a1, p1) = self._segment(p, 1)
+        return a0 + (p - p0) * (a1 - a0) / (p1 - p0)
+
+    def angleToPulse(self, a):
+        """
+        @param a: Angle from 0 to 180°, used to 0.1° accuracy.
+        @return: The pulse width for the angle.
+        @raises ValueError: If the angle is out of range.
+        """
+        if not 0 <= a <= 180:
+            raise ValueError("Angle {} outside of 0 - 180".format(a))
+        return self.a2p[int(a * RES + 0.5)]
+
+    def pulseToAngle(self, p):
+        """
+        @param p: Pulse width.
+        @return: The angle to 0.1° accuracy. Pulse widths outside the 0 - 180°
+                 range are extrapolated.
+        """
+        i = p - self.pLo
+        if 0 <= i < len(self.p2a):
+            return self.p2a[i] / float(RES)
+        return round(self._angle(p), 1)
+
+def load(path=PATH):
+    """
+    Loads a calibration file.
+
+    @param path: The file path.
+    @return: Dictionary of calibration points per joint name.
+    """
+    with open(path) as f:
+        cal = json.load(f)
+    # Compile to validate the points
+    for name, points in cal.items():
+        try:
+            Curve(points)
+        except (TypeError, ValueError), e:
+            raise ValueError("Invalid calibration for {}: {}".format(name, e))
+    return cal
+
+def save(cal, path=PATH):
+    """
+    Saves a calibration file.
+
+    @param cal: Dictionary of calibration points per joint name.
+    @param path: The file path.
+    """
+    with open(path, 'w') as f:
+        json.dump(cal, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+    import SimPigpio
+    from MeArm import armDef
+
+    parser = argparse.ArgumentParser(description="Measure the servo "
+                                     "calibration points for the MeArm "
+                                     "joints.")
+    parser.add_argument('-j', '--joint', action='append',
+                        choices=sorted(armDef),
+                        help="Joint to calibrate. May be repeated. Default "
+                        "is all joints")
+    parser.add_argument('-a', '--angles', default='0,45,90,135,180',
+                        help="Comma separated reference angles")
+    parser.add_argument('--sim', action='store_true',
+                        help="Use simulated servos")
+    parser.add_argument('path', nargs='?', default=PATH,
+                        help="Calibration file to update")
+    args = parser.parse_args()
+
+    if args.sim:
+        io = SimPigpio.pi()
+    else:
+        import pigpio
+        io = pigpio.pi()
+    cal = load(args.path) if os.path.exists(args.path) else {}
+    angles = [float(a) for a in args.angles.split(',')]
+
+    print "Only do this with the servos disconnected from the arm, or with"
+    print "angles inside the joint limits, to prevent damage to the arm."
+    print "Enter a pulse width to move the servo, or nothing to accept the"
+    print "current one for the angle."
+    for name in args.joint or sorted(armDef):
+        gpio = armDef[name]['gpio']
+        curve = Curve(cal[name]) if name in cal else Curve.linear(550, 2500)
+        points = []
+        for a in angles:
+            pw = curve.angleToPulse(a)
+            while True:
+                io.set_servo_pulsewidth(gpio, pw)
+                v = raw_input("{} at {}° [{}]: ".format(name, a, pw)).strip()
+                if not v:
+                    break
+                try:
+                    pw = int(v)
+                except ValueError:
+                    print "Pulse width expected"
+            points.append([a, pw])
+        try:
+            Curve(points)
+        except ValueError, e:
+            print "Not saving {}: {}".format(name, e)
+            continue
+        cal[name] = points
+        save(cal, args.path)
+        print "Saved {} to {}".format(name, args.path)
+    io.stop()
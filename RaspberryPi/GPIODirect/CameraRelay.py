@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+"""
+MJPEG camera stream relay.
+
+The relay holds a single connection to the upstream MJPEG stream (like
+mjpg-streamer) and fans the frames out to any number of viewers, so extra
+viewers do not load the camera encoder or its network link:
+
+    relay = CameraRelay('http://fruitix:8080/?action=stream')
+    for chunk in relay.stream():
+        ... write chunk to the viewer
+
+Every frame is formatted as a multipart chunk once, and the same string is
+handed to every viewer. The latest frames are kept in a ring buffer. A viewer
+that falls more than maxLag frames behind skips ahead to the latest frame
+instead of queueing frames, so a slow viewer only gets a lower frame rate and
+does not hold up anyone else.
+
+The upstream connection is opened when the first viewer or snapshot needs it,
+reconnected with backoff on errors, and closed after idle seconds without
+viewers.
+
+To test without a camera, run a stand-in MJPEG server that streams numbered
+dummy frames:
+
+    python CameraRelay.py [-p port] [-r frame rate]
+"""
+
+import time
+import socket
+import urllib2
+import threading
+
+from Clock import monotonic
+
+## The multipart boundary for the relayed stream
+BOUNDARY = 'mearmframe'
+
+class CameraRelay(object):
+    """
+    Single upstream, multi viewer MJPEG relay.
+    """
+
+    def __init__(self, url, frames=8, maxLag=2, idle=30, timeout=10):
+        """
+        @param url: The upstream MJPEG stream URL.
+        @param frames: The number of frames in the ring buffer.
+        @param maxLag: The number of frames a viewer may fall behind before
+               it skips to the latest frame.
+        @param idle: Seconds without viewers before the upstream connection is
+               closed.
+        @param timeout: Upstream socket timeout in seconds.
+        """
+        self.url = url
+        self.maxLag = maxLag
+        self.idle = idle
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        # Ring buffer of (seq, jpeg, chunk) tuples. chunk is the frame
+        # formatted as a multipart part for viewers.
+        self._ring = [None] * frames
+        self.seq = 0
+        self._frameTime = 0.0
+        self.viewers = 0
+        self._lastViewer = monotonic()
+        self._thread = None
+        self._halt = threading.Event()
+        # Counters
+        self.dropped = 0
+        self.reconnects = 0
+        self.lastError = None
+
+    def _ensureRunning(self):
+        """
+        Starts the upstream reader thread if it is not running.
+        """
+        with self._cond:
+            self._lastViewer = monotonic()
+            if self._thread is not None:
+                return
+            self._halt.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="CameraRelay")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _idle(self):
+        with self._cond:
+            return self.viewers == 0 and \
+                   monotonic() - self._lastViewer > self.idle
+
+    def _run(self):
+        """
+        Upstream reader thread. Reconnects with backoff until stopped or idle.
+        """
+        backoff = 0.5
+        while True:
+            try:
+                up = urllib2.urlopen(self.url, timeout=self.timeout)
+                try:
+                    backoff = 0.5
+                    self._read(up)
+                finally:
+                    up.close()
+            except (IOError, socket.error, ValueError), e:
+                self.lastError = str(e)
+            # Decide to stop under the lock, so a viewer arriving now either
+            # keeps this thread going or sees it gone and starts a new one.
+            with self._cond:
+                if self._halt.is_set() or self._idle():
+                    self._thread = None
+                    # Wake up viewers so they notice the relay stopped
+                    self._cond.notify_all()
+                    return
+            self.reconnects += 1
+            self._halt.wait(backoff)
+            backoff = min(backoff*2, 10)
+
+    def _read(self, up):
+        """
+        Reads frames from an upstream response until it ends, the relay is
+        stopped or idle.
+        """
+        ctype = up.info().getheader('Content-Type', '')
+        if 'boundary=' not in ctype:
+            raise ValueError("Not a multipart stream: {}".format(ctype))
+        boundary = '--' + ctype.split('boundary=', 1)[1].strip().strip('"')\
+                                 .lstrip('-')
+        while not self._halt.is_set() and not self._idle():
+            # Skip to the part boundary
+            line = up.readline()
+            if not line:
+                return
+            if line.strip().lstrip('-') != boundary.lstrip('-'):
+                continue
+            # Part headers
+            length = None
+            while True:
+                line = up.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if not line:
+                    break
+                k, _, v = line.partition(':')
+                if k.strip().lower() == 'content-length':
+                    length = int(v)
+            if length is not None:
+                jpeg = up.read(length)
+                if len(jpeg) < length:
+                    return
+            else:
+                # No length, so read up to the JPEG end of image marker
+                buf = []
+                while True:
+                    line = up.readline()
+                    if not line:
+                        return
+                    buf.append(line)
+                    if line.rstrip('\r\n').endswith('\xff\xd9'):
+                        break
+                jpeg = ''.join(buf).rstrip('\r\n')
+            self._publish(jpeg)
+
+    def _publish(self, jpeg):
+        """
+        Adds a frame to the ring buffer and wakes up the viewers.
+        """
+        chunk = "--{}\r\nContent-Type: image/jpeg\r\n"\
+                "Content-Length: {}\r\n\r\n{}\r\n"\
+                .format(BOUNDARY, len(jpeg), jpeg)
+        with self._cond:
+            self.seq += 1
+            self._ring[self.seq % len(self._ring)] = (self.seq, jpeg, chunk)
+            self._frameTime = monotonic()
+            self._cond.notify_all()
+
+    def _frame(self, seq):
+        """
+        @return: The ring buffer entry for seq, or None if it is gone.
+        """
+        ent = self._ring[seq % len(self._ring)]
+        return ent if ent is not None and ent[0] == seq else None
+
+    def snapshot(self, wait=5, stale=1.0):
+        """
+        Returns the latest frame, waiting for a new one if there is none yet
+        or it is older than stale seconds, like after the relay went idle.
+
+        @param wait: Max seconds to wait for a frame.
+        @param stale: The age in seconds from which a frame is too old.
+        @return: The JPEG data, or None if there was no frame within wait.
+        """
+        self._ensureRunning()
+        deadline = monotonic() + wait
+        with self._cond:
+            # A stale frame must be replaced by a new one
+            start = self.seq if monotonic() - self._frameTime > stale else -1
+            while self.seq == 0 or self.seq == start:
+                left = deadline - monotonic()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+            return self._frame(self.seq)[1]
+
+    def stream(self, wait=10):
+        """
+        Generator of multipart chunks for a viewer. The response content type
+        must be 'multipart/x-mixed-replace; boundary=' + BOUNDARY.
+
+        @param wait: Max seconds to wait for the next frame before ending the
+               stream.
+        """
+        self._ensureRunning()
+        with self._cond:
+            self.viewers += 1
+            last = max(0, self.seq - 1)
+        try:
+            while not self._halt.is_set():
+                with self._cond:
+                    if self.seq == last:
+                        self._cond.wait(wait)
+                    if self.seq == last:
+                        # No new frame in time
+                        return
+                    nxt = last + 1
+                    if self.seq - last > self.maxLag or \
+                       self._frame(nxt) is None:
+                        # Too far behind, skip to the latest frame
+                        self.dropped += self.seq - nxt
+                        nxt = self.seq
+                    ent = self._frame(nxt)
+                last = nxt
+                yield ent[2]
+                self._ensureRunning()
+        finally:
+            with self._cond:
+                self.viewers -= 1
+                self._lastViewer = monotonic()
+
+    def stop(self):
+        """
+        Closes the upstream connection and ends all viewer streams.
+        """
+        self._halt.set()
+        with self._cond:
+            self._cond.notify_all()
+            t = self._thread
+        if t is not None:
+            t.join(self.timeout)
+
+    def stats(self):
+        """
+        @return: A dictionary with the relay state and counters.
+        """
+        return {'running': self._thread is not None,
+                'viewers': self.viewers,
+                'frames': self.seq,
+                'dropped': self.dropped,
+                'reconnects': self.reconnects,
+                'lastError': self.lastError}
+
+
+if __name__ == "__main__":
+    import argparse
+    import BaseHTTPServer
+    import SocketServer
+
+    parser = argparse.ArgumentParser(description="Stand-in MJPEG server "
+                                     "streaming numbered dummy frames.")
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help="Port to listen on")
+    parser.add_argument('-r', '--rate', type=float, default=15,
+                        help="Frames per second")
+    parser.add_argument('-s', '--size', type=int, default=20000,
+                        help="Frame size in bytes")
+    args = parser.parse_args()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; '
+                             'boundary=standin')
+            self.end_headers()
+            n = 0
+            try:
+                while True:
+                    n += 1
+                    # JPEG start and end markers around the frame number
+                    body = '\xff\xd8' + str(n).ljust(args.size - 4, '.') + \
+                           '\xff\xd9'
+                    self.wfile.write("--standin\r\nContent-Type: image/jpeg"
+                                     "\r\nContent-Length: {}\r\n\r\n{}\r\n"\
+                                     .format(len(body), body))
+                    time.sleep(1.0 / args.rate)
+            except socket.error:
+                pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    print "Stand-in MJPEG server on port {}".format(args.port)
+    Server(('', args.port), Handler).serve_forever()
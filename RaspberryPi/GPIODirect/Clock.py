@@ -0,0 +1,74 @@
+# *-* coding: utf-8 *-*
+"""
+Monotonic clock for timing.
+
+Deadlines, timeouts, expiry times and latencies are all measured with
+monotonic(), which is not affected by wall clock changes like NTP steps:
+
+    from Clock import monotonic
+
+    deadline = monotonic() + 0.5
+
+Python 2 has no time.monotonic, so on Linux the clock is read with
+clock_gettime(CLOCK_MONOTONIC) through ctypes. Only where neither is available
+does it fall back to wall clock time.
+
+libc() gives the C library loaded through ctypes, for other calls Python 2 has
+no wrapper for.
+"""
+
+import sys
+import time
+import ctypes
+import ctypes.util
+
+## CLOCK_MONOTONIC clock id from <time.h> on Linux
+CLOCK_MONOTONIC = 1
+
+_libcHandle = []
+
+def libc():
+    """
+    Returns the C library for calls Python 2 has no wrapper for, or None if
+    not available. It is loaded once.
+    """
+    if not _libcHandle:
+        lib = None
+        name = ctypes.util.find_library('c')
+        if name is not None:
+            try:
+                lib = ctypes.CDLL(name, use_errno=True)
+            except OSError:
+                pass
+        _libcHandle.append(lib)
+    return _libcHandle[0]
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _monotonicClock():
+    """
+    Returns the monotonic clock function: time.monotonic where it exists, else
+    clock_gettime(CLOCK_MONOTONIC) through ctypes on Linux. Only if neither is
+    available, like on Python 2 off Linux, is it wall clock time.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    lib = libc() if sys.platform.startswith('linux') else None
+    gettime = getattr(lib, 'clock_gettime', None)
+    if gettime is None:
+        return time.time
+    gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    gettime.restype = ctypes.c_int
+    if gettime(CLOCK_MONOTONIC, ctypes.byref(_Timespec())) != 0:
+        return time.time
+
+    def clock():
+        # A new timespec per call, as the clock is read from many threads
+        ts = _Timespec()
+        gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return clock
+
+## Monotonic clock for timing, not affected by wall clock changes.
+monotonic = _monotonicClock()
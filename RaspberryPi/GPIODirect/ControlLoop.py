@@ -0,0 +1,264 @@
+# *-* coding: utf-8 *-*
+"""
+Fixed rate control loop for the MeArm.
+
+The ControlLoop thread ticks at a fixed rate on monotonic clock deadlines and
+on every tick writes the next pose from its setpoint buffer to an arm backend
+sink (see the Trajectory module for the sinks). When the buffer is empty the
+arm simply holds its last pose.
+
+How late every tick wakes up relative to its deadline is recorded in a
+histogram, which shows how much of the motion jitter comes from scheduling in
+the software:
+
+    from Trajectory import MeArmSink, Move
+    from ControlLoop import ControlLoop
+
+    loop = ControlLoop(MeArmSink(arm), rate=50, priority=50)
+    loop.start()
+    loop.follow(Move(arm.getPose(), {'base': 30}))
+    ...
+    print loop.stats()
+"""
+
+import os
+import time
+import ctypes
+import threading
+from collections import deque
+
+from Clock import monotonic, libc as _libc
+
+## SCHED_FIFO policy value from <sched.h> on Linux
+SCHED_FIFO = 1
+
+def setFifo(priority):
+    """
+    Sets the SCHED_FIFO scheduling policy for the calling thread.
+
+    @param priority: The real time priority (1-99).
+    @raises OSError: If the policy could not be set.
+    """
+    if hasattr(os, 'sched_setscheduler'):
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return
+    libc = _libc()
+    if libc is None or not hasattr(libc, 'sched_setscheduler'):
+        raise OSError("sched_setscheduler not supported")
+    param = ctypes.c_int(priority)
+    if libc.sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+def setAffinity(cpu):
+    """
+    Pins the calling thread to a CPU.
+
+    @param cpu: The CPU number.
+    @raises OSError: If the affinity could not be set.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+        return
+    libc = _libc()
+    if libc is None or not hasattr(libc, 'sched_setaffinity'):
+        raise OSError("sched_setaffinity not supported")
+    # A cpu_set_t is a 1024 bit mask
+    mask = (ctypes.c_ulong * (1024 // (8*ctypes.sizeof(ctypes.c_ulong))))()
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask[cpu // bits] = 1 << (cpu % bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+class LatenessHistogram(object):
+    """
+    Histogram of tick lateness.
+    """
+
+    ## Upper bucket bounds in milliseconds. The last bucket is unbounded.
+    Bounds = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.Bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, lateness):
+        """
+        Records the lateness for one tick.
+
+        @param lateness: How late the tick was in seconds.
+        """
+        ms = lateness * 1000.0
+        i = 0
+        while i < len(self.Bounds) and ms > self.Bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def asDict(self):
+        """
+        @return: A dictionary with the bucket counts keyed on the bucket upper
+                 bound in ms ('inf' for the last one), and the 'n', 'meanMs'
+                 and 'maxMs' summary values.
+        """
+        buckets = [(str(b), c) for b, c in zip(self.Bounds, self.counts)]
+        buckets.append(('inf', self.counts[-1]))
+        return {'buckets': buckets,
+                'n': self.n,
+                'meanMs': self.total / self.n if self.n else 0.0,
+                'maxMs': self.max}
+
+
+class ControlLoop(threading.Thread):
+    """
+    Fixed rate setpoint executor thread.
+    """
+
+    def __init__(self, sink, rate=50, priority=None, cpu=None):
+        """
+        Instance initialization.
+
+        @param sink: The arm backend setpoint sink.
+        @param rate: Ticks per second.
+        @param priority: If not None, try to run the loop thread with the
+               SCHED_FIFO real time scheduling policy at this priority (1-99).
+               This needs root or CAP_SYS_NICE on Linux.
+        @param cpu: If not None, try to pin the loop thread to this CPU.
+        """
+        super(ControlLoop, self).__init__(name="MeArmControlLoop")
+        self.daemon = True
+        self.sink = sink
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.priority = priority
+        self.cpu = cpu
+        # The setpoint buffer and its lock
+        self._buf = deque()
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+        self.lateness = LatenessHistogram()
+        # Tick counters
+        self.ticks = 0
+        self.overruns = 0
+        self.written = 0
+        self.errors = 0
+        self.lastError = None
+        # The outcome of the real time setup, see _realtime()
+        self.realtime = {}
+
+    def _realtime(self):
+        """
+        Applies the real time scheduling policy and CPU affinity to the calling
+        thread where requested and supported.
+        """
+        if self.priority is not None:
+            try:
+                setFifo(self.priority)
+                self.realtime['fifo'] = self.priority
+            except OSError, e:
+                self.realtime['fifo'] = str(e)
+        if self.cpu is not None:
+            try:
+                setAffinity(self.cpu)
+                self.realtime['cpu'] = self.cpu
+            except OSError, e:
+                self.realtime['cpu'] = str(e)
+
+    def push(self, pose):
+        """
+        Adds a setpoint to the end of the buffer.
+
+        @param pose: A dictionary of angle per joint name.
+        """
+        with self._lock:
+            self._buf.append(pose)
+
+    def follow(self, move, replace=True):
+        """
+        Buffers all setpoints for a Trajectory.Move at the loop rate.
+
+        @param move: The Move to follow.
+        @param replace: If True, any setpoints still in the buffer are
+               discarded first, else the move is queued after them.
+        """
+        poses = [pose for t, pose in move.setpoints(self.rate)]
+        with self._lock:
+            if replace:
+                self._buf.clear()
+            self._buf.extend(poses)
+
+    def clear(self):
+        """
+        Discards all buffered setpoints. The arm holds its current pose.
+        """
+        with self._lock:
+            self._buf.clear()
+
+    def pending(self):
+        """
+        @return: The number of setpoints still in the buffer.
+        """
+        return len(self._buf)
+
+    def run(self):
+        self._realtime()
+        t0 = monotonic()
+        k = 0
+        while not self._halt.is_set():
+            deadline = t0 + k * self.period
+            delay = deadline - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            now = monotonic()
+            self.lateness.record(max(0.0, now - deadline))
+            self.ticks += 1
+
+            with self._lock:
+                pose = self._buf.popleft() if self._buf else None
+            if pose is not None:
+                try:
+                    self.sink.write(pose)
+                    self.written += 1
+                except Exception, e:
+                    # Keep ticking, but keep track of failures
+                    self.errors += 1
+                    self.lastError = str(e)
+
+            # If we fell more than a period behind, skip the missed ticks
+            # instead of trying to catch up with a burst of setpoints.
+            k += 1
+            behind = int((monotonic() - t0) / self.period) - k
+            if behind > 0:
+                self.overruns += behind
+                k += behind
+
+    def stop(self):
+        """
+        Stops the loop thread.
+        """
+        self._halt.set()
+        if self.is_alive():
+            self.join()
+
+    def stats(self):
+        """
+        @return: A dictionary with the loop rate, tick counters, real time
+                 setup outcome and lateness histogram.
+        """
+        return {'rate': self.rate,
+                'ticks': self.ticks,
+                'overruns': self.overruns,
+                'written': self.written,
+                'errors': self.errors,
+                'lastError': self.lastError,
+                'pending': self.pending(),
+                'realtime': self.realtime,
+                'lateness': self.lateness.asDict()}
@@ -0,0 +1,161 @@
+# *-* coding: utf-8 *-*
+"""
+Forward and inverse kinematics for the MeArm.
+
+The MeArm is treated as a base rotation with a two link planar arm on top of
+it. The parallel linkage keeps the gripper horizontal, so the gripper tip is a
+fixed horizontal distance in front of the wrist pivot.
+
+Coordinates are in mm with the origin on the base rotation axis at table
+level, X pointing forward when the base is at 90°, Y to the left and Z up.
+
+Joint angles use the same conventions as the MeArm joint definitions:
+
+    base:     90 + the rotation of the arm from the X axis towards Y
+    shoulder: the angle of the upper arm above horizontal (90 is upright)
+    wrist:    90 + the angle of the forearm above horizontal
+
+The grip joint does not influence the gripper position and is not solved for.
+
+Single targets are solved with plain math calls, and whole arrays of targets
+in one go with NumPy via solveMany(). NumPy is only needed for the *Many
+functions.
+"""
+
+import math
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+## The joints solved for, in the order used for angle tuples and arrays
+JOINTS = ['base', 'shoulder', 'wrist']
+
+class Geometry(object):
+    """
+    MeArm link dimensions in mm.
+    """
+
+    def __init__(self, upper=80.0, fore=80.0, grip=68.0, height=52.0):
+        """
+        @param upper: Upper arm length, shoulder pivot to elbow pivot.
+        @param fore: Forearm length, elbow pivot to wrist pivot.
+        @param grip: Horizontal distance from the wrist pivot to the gripper
+               tip.
+        @param height: Height of the shoulder pivot above the table.
+        """
+        self.upper = upper
+        self.fore = fore
+        self.grip = grip
+        self.height = height
+
+## The default geometry
+MEARM = Geometry()
+
+def _needNumpy():
+    if np is None:
+        raise ImportError("NumPy is required for solving arrays of targets")
+
+def forward(base, shoulder, wrist, geom=MEARM):
+    """
+    Calculates the gripper tip position for a set of joint angles.
+
+    @param base: Base joint angle in degrees.
+    @param shoulder: Shoulder joint angle in degrees.
+    @param wrist: Wrist joint angle in degrees.
+    @param geom: The arm Geometry.
+    @return: (x, y, z) tuple in mm.
+    """
+    th = math.radians(base - 90)
+    p1 = math.radians(shoulder)
+    p2 = math.radians(wrist - 90)
+    r = geom.upper*math.cos(p1) + geom.fore*math.cos(p2) + geom.grip
+    z = geom.height + geom.upper*math.sin(p1) + geom.fore*math.sin(p2)
+    return (r*math.cos(th), r*math.sin(th), z)
+
+def solve(x, y, z, geom=MEARM):
+    """
+    Solves the joint angles for a gripper tip position.
+
+    The elbow up solution is returned.
+
+    @param x: X position in mm.
+    @param y: Y position in mm.
+    @param z: Z position in mm.
+    @param geom: The arm Geometry.
+    @return: (base, shoulder, wrist) tuple of joint angles in degrees.
+    @raises ValueError: If the position is out of reach.
+    """
+    th = math.atan2(y, x)
+    # The wrist pivot position in the arm plane, relative to the shoulder
+    r = math.hypot(x, y) - geom.grip
+    h = z - geom.height
+    d = math.hypot(r, h)
+    if not (abs(geom.upper - geom.fore) <= d <= geom.upper + geom.fore) or \
+       d == 0:
+        raise ValueError("Position ({:.1f}, {:.1f}, {:.1f}) is out of reach"\
+                         .format(x, y, z))
+    # Law of cosines for the angle between the upper arm and the line from
+    # the shoulder to the wrist.
+    c = (geom.upper**2 + d*d - geom.fore**2) / (2*geom.upper*d)
+    p1 = math.atan2(h, r) + math.acos(max(-1.0, min(1.0, c)))
+    p2 = math.atan2(h - geom.upper*math.sin(p1), r - geom.upper*math.cos(p1))
+    return (90 + math.degrees(th), math.degrees(p1), 90 + math.degrees(p2))
+
+def forwardMany(angles, geom=MEARM):
+    """
+    Calculates the gripper tip positions for an array of joint angles.
+
+    @param angles: N x 3 array like of (base, shoulder, wrist) angles.
+    @param geom: The arm Geometry.
+    @return: N x 3 array of (x, y, z) positions.
+    """
+    _needNumpy()
+    a = np.radians(np.asarray(angles, dtype=float))
+    th = a[:, 0] - math.pi/2
+    p1 = a[:, 1]
+    p2 = a[:, 2] - math.pi/2
+    r = geom.upper*np.cos(p1) + geom.fore*np.cos(p2) + geom.grip
+    z = geom.height + geom.upper*np.sin(p1) + geom.fore*np.sin(p2)
+    return np.column_stack((r*np.cos(th), r*np.sin(th), z))
+
+def solveMany(points, limits=None, geom=MEARM):
+    """
+    Solves the joint angles for an array of gripper tip positions.
+
+    @param points: N x 3 array like of (x, y, z) positions.
+    @param limits: Optional dictionary of (min, max) tuples per joint name,
+           as returned by MeArm.limits(). Joints not in limits are taken to be
+           unlimited.
+    @param geom: The arm Geometry.
+    @return: (angles, reachable, inLimits) tuple where angles is an N x 3 array
+             of (base, shoulder, wrist) angles (NaN where not reachable),
+             reachable a boolean array indicating whether the arm can reach
+             each point, and inLimits a boolean array indicating which points
+             are reachable within the joint limits.
+    """
+    _needNumpy()
+    p = np.asarray(points, dtype=float).reshape(-1, 3)
+    th = np.arctan2(p[:, 1], p[:, 0])
+    r = np.hypot(p[:, 0], p[:, 1]) - geom.grip
+    h = p[:, 2] - geom.height
+    d = np.hypot(r, h)
+    reachable = (d >= abs(geom.upper - geom.fore)) & \
+                (d <= geom.upper + geom.fore) & (d > 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c = (geom.upper**2 + d*d - geom.fore**2) / (2*geom.upper*d)
+        p1 = np.arctan2(h, r) + np.arccos(np.clip(c, -1.0, 1.0))
+        p2 = np.arctan2(h - geom.upper*np.sin(p1), r - geom.upper*np.cos(p1))
+    angles = np.column_stack((90 + np.degrees(th), np.degrees(p1),
+                              90 + np.degrees(p2)))
+    angles[~reachable] = np.nan
+
+    inLimits = reachable.copy()
+    for i, j in enumerate(JOINTS):
+        if limits and j in limits:
+            lo, hi = limits[j]
+            with np.errstate(invalid='ignore'):
+                inLimits &= (angles[:, i] >= lo) & (angles[:, i] <= hi)
+
+    return angles, reachable, inLimits
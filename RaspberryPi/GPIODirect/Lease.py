@@ -0,0 +1,130 @@
+# *-* coding: utf-8 *-*
+"""
+Control stick lease manager.
+
+Only one client at a time may control the arm. That client holds the lease,
+identified by a random token handed to the client on acquiring it. The lease
+expires when it is not renewed within the timeout:
+
+    leases = LeaseManager(60)
+    ok, lease = leases.acquire('Tom', '10.0.0.5')
+    if ok:
+        token = lease.token
+    ...
+    leases.renew(token)      # on every control action
+    leases.release(token)
+
+All changes are made under a lock, so acquiring is atomic and two clients can
+never both get the lease. check() does not take the lock, which makes it cheap
+enough to call on every read only request. Expiry uses the monotonic clock,
+so it is not affected by wall clock changes.
+"""
+
+import uuid
+import threading
+
+from Clock import monotonic
+
+class Lease(object):
+    """
+    A control stick lease.
+    """
+    __slots__ = ['token', 'name', 'ip', 'expires']
+
+    def __init__(self, token, name, ip, expires):
+        self.token = token
+        self.name = name
+        self.ip = ip
+        # Monotonic clock expiry time
+        self.expires = expires
+
+    def remaining(self):
+        """
+        @return: The seconds until the lease expires.
+        """
+        return max(0.0, self.expires - monotonic())
+
+class LeaseManager(object):
+    """
+    Hands out the single control stick lease.
+    """
+
+    def __init__(self, timeout):
+        """
+        @param timeout: Seconds after the last acquire or renew that a lease
+               expires.
+        """
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._lease = None
+
+    def _current(self):
+        """
+        @return: The current lease, or None if there is none or it expired.
+        """
+        lease = self._lease
+        if lease is None or monotonic() >= lease.expires:
+            return None
+        return lease
+
+    def acquire(self, name, ip, token=None):
+        """
+        Acquires the lease if it is free. If token is for the current lease,
+        it is renewed instead.
+
+        @param name: The name of the client, for telling others who holds the
+               lease.
+        @param ip: The client IP address, for the same reason.
+        @param token: The token the client may already hold.
+        @return: (acquired, lease) tuple. If acquired is True, lease is the
+                 client's lease, else it is the lease held by someone else.
+        """
+        with self._lock:
+            lease = self._current()
+            if lease is not None:
+                if token is not None and lease.token == token:
+                    lease.expires = monotonic() + self.timeout
+                    return True, lease
+                return False, lease
+            self._lease = Lease(uuid.uuid4().hex, name, ip,
+                                monotonic() + self.timeout)
+            return True, self._lease
+
+    def check(self, token):
+        """
+        Checks whether token is for the current lease without renewing it.
+        This does not take the lock.
+
+        @return: True if token holds the lease.
+        """
+        lease = self._current()
+        return lease is not None and token is not None and \
+               lease.token == token
+
+    def renew(self, token):
+        """
+        Extends the lease if token is for the current lease.
+
+        @return: True if token holds the lease.
+        """
+        if token is None:
+            return False
+        with self._lock:
+            lease = self._current()
+            if lease is None or lease.token != token:
+                return False
+            lease.expires = monotonic() + self.timeout
+            return True
+
+    def release(self, token):
+        """
+        Releases the lease if token is for the current lease.
+
+        @return: True if the lease was released.
+        """
+        with self._lock:
+            lease = self._current()
+            if lease is None or lease.token != token:
+                return False
+            self._lease = None
+            return True
@@ -3,7 +3,22 @@
 MeArm controller via pigpio.
 """
 
-import pigpio
+import time
+import functools
+import threading
+from array import array
+
+import Kinematics
+import SimPigpio
+from Calibration import Curve, RES
+from Metrics import timed, describe
+try:
+    import pigpio
+    PigpioError = pigpio.error
+except ImportError:
+    # Only the simulated backend is available. See MeArm.__init__()
+    pigpio = None
+    PigpioError = SimPigpio.error
 
 # Some defaults to make it easier to instantiate a MeArm object.
 armDef = {
@@ -13,12 +28,112 @@ armDef = {
     'grip': {'gpio': 22, 'min': 80, 'max': 100, 'home': 90}
 }
 
+describe('mearm_arm_call_seconds', "Time taken by MeArm calls, including "
+         "waiting for the arm lock and the pigpiod round trips.")
+describe('mearm_arm_call_errors_total', "MeArm calls that raised an error.")
+
+def locked(f):
+    """
+    Decorator for MeArm methods that change the arm state to run them while
+    holding the instance lock. This keeps multi step changes like poses and
+    batches from interleaving with other changes.
+    """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+class ArmJoint(object):
+    """
+    A MeArm joint, with its servo conversion precomputed.
+
+    The joint keeps a pulse width table indexed on joint angle in 0.1° steps,
+    with the calibration curve and inversion applied, so converting a position
+    in goto() and setPose() is a limit check and one array lookup.
+    """
+    __slots__ = ['name', 'gpio', 'min', 'max', 'home', 'inv', 'mirror',
+                 'curve', 'table']
+
+    def __init__(self, name, definition, curve):
+        """
+        @param name: The joint name.
+        @param definition: The joint definition dictionary, see MeArm. It is
+               not changed.
+        @param curve: The Calibration.Curve for the joint servo.
+        """
+        self.name = name
+        self.gpio = definition['gpio']
+        self.min = definition['min']
+        self.max = definition['max']
+        self.home = definition['home']
+        self.inv = definition.get('inv', False)
+        # An inverted joint angle is mirrored around the middle of the
+        # defined limits to get the servo angle. This is fixed, so changing
+        # the limits does not move the joint.
+        self.mirror = self.min + self.max
+        self.setCurve(curve)
+
+    def setCurve(self, curve):
+        """
+        Sets the calibration curve and builds the pulse width table.
+
+        @param curve: The Calibration.Curve for the joint servo.
+        """
+        self.curve = curve
+        if not self.inv:
+            self.table = curve.a2p
+            return
+        # Joint angles that mirror to outside the servo range get 0. The
+        # limits are kept inside the servo range, see servoRange().
+        m = int(round(self.mirror * RES))
+        n = len(curve.a2p)
+        self.table = array('H', [curve.a2p[m - i] if 0 <= m - i < n else 0
+                                 for i in xrange(n)])
+
+    def servoRange(self, mn, mx):
+        """
+        @return: True if the joint limits mn to mx fall inside the 0 - 180°
+                 servo range.
+        """
+        if self.inv:
+            mn, mx = self.mirror - mx, self.mirror - mn
+        return 0 <= mn and mx <= 180
+
+    def pulse(self, pos):
+        """
+        Validates a joint position and converts it to a servo pulse width.
+
+        @param pos: The position as an angle.
+        @return: The pulse width for the position.
+        @raises ValueError: If the position is outside the joint limits.
+        """
+        if not (self.min <= pos <= self.max):
+            raise ValueError("Angle {} outside of limits for {} ({} - {})"\
+                             .format(pos, self.name, self.min, self.max))
+        return self.table[int(pos * RES + 0.5)]
+
+    def position(self, pw):
+        """
+        Converts a servo pulse width to the joint position.
+
+        @param pw: The pulse width.
+        @return: The position as an angle.
+        """
+        a = self.curve.pulseToAngle(pw)
+        return self.mirror - a if self.inv else a
+
 class MeArm(object):
     """
     MeArm joint/angle controller.
     """
 
-    def __init__(self, base, shoulder, wrist, grip, pwMin=550, pwMax=2500):
+    # pigpio script to set all four servo pulse widths in one pigpiod command.
+    # The parameters are the gpio and pulse width pairs for each joint.
+    poseScript = "servo p0 p1 servo p2 p3 servo p4 p5 servo p6 p7"
+
+    def __init__(self, base, shoulder, wrist, grip, pwMin=550, pwMax=2500,
+                 io=None, calibration=None):
         """
         Instance initialization.
 
@@ -39,190 +154,579 @@ class MeArm(object):
         @param grip: Grip joint definition
         @param pwMin: Minimum allowed pulse with for servo to get to 0°
         @param pwMax: Maximum allowed pulse with for servo to get to 180°
+        @param calibration: Optional dictionary of calibration points per
+               joint name, see Calibration. Joints without calibration use a
+               straight line from pwMin to pwMax.
+        @param io: The servo backend; a pigpio.pi or SimPigpio.pi instance. If
+               None, a pigpio.pi instance connected to the local pigpiod is
+               used.
         """
-        # NOTE: We do not validate here, so we simply assign to instance local
-        # params and add names to the joint definitions.
-        self.base = base
-        self.base['name'] = 'base'
-
-        self.shoulder = shoulder
-        self.shoulder['name'] = 'shoulder'
-
-        self.wrist = wrist
-        self.wrist['name'] = 'wrist'
-
-        self.grip = grip
-        self.grip['name'] = 'grip'
-
         # Save min/max servo pulse widths
         self.pwMin = pwMin
         self.pwMax = pwMax
 
-        # Calculate the pulse width per degree of angle
-        self.pwPdeg = (pwMax - pwMin) / 180.0
-
-        # Set up instance of pigpio
-        self.io = pigpio.pi()
+        # The default calibration curve for uncalibrated servos
+        self.curve = Curve.linear(pwMin, pwMax)
+        calibration = calibration or {}
+
+        # NOTE: We do not validate here. The joint definitions are copied
+        # into ArmJoint instances, so the caller's definitions are not changed.
+        defs = [('base', base), ('shoulder', shoulder), ('wrist', wrist),
+                ('grip', grip)]
+        for name, d in defs:
+            curve = Curve(calibration[name]) if name in calibration else \
+                    self.curve
+            setattr(self, name, ArmJoint(name, d, curve))
+
+        # All joints in pose order
+        self.joints = [self.base, self.shoulder, self.wrist, self.grip]
+
+        # Lock for state changes. See locked()
+        self.lock = threading.RLock()
+
+        # The commanded pulse width per gpio. This is the authoritative record
+        # of where the servos were told to go and is used to answer position
+        # queries without a pigpiod round trip. See getPos() and verify().
+        self._pw = {}
+        # Callables to call as listener(arm, joint) after a joint limit was
+        # changed by setLimit()
+        self.limitListeners = []
+        # Callables to call as listener(arm) after any servo pulse width was
+        # changed
+        self.poseListeners = []
+        # Background verification thread and its stop event
+        self._verifier = None
+        self._verifyStop = threading.Event()
+
+        # Set up instance of pigpio, unless we were given a backend
+        if io is None:
+            if pigpio is None:
+                raise ImportError("pigpio is not installed. Pass a "
+                                  "SimPigpio.pi() as io to simulate the arm.")
+            io = pigpio.pi()
+        self.io = io
+        # Store the script to set a full pose in one go
+        self.poseScriptID = self._storePoseScript()
         # Home them all
         self.homeAll()
 
-    def angleToPulse(self, a):
+    def _storePoseScript(self):
+        """
+        Stores the pose script on pigpiod and waits for it to be ready to run.
+
+        @return: The script ID or None if the script could not be stored, in
+                 which case poses are set with one command per joint.
+        """
+        try:
+            sid = self.io.store_script(self.poseScript)
+            if sid < 0:
+                return None
+            # The script is initialising until it has been compiled
+            for i in range(50):
+                if self.io.script_status(sid)[0] == SimPigpio.PI_SCRIPT_HALTED:
+                    return sid
+                time.sleep(0.01)
+            self.io.delete_script(sid)
+        except (PigpioError, AttributeError):
+            pass
+        return None
+
+    def angleToPulse(self, a, joint=None):
         """
         Converts and angle to a pulse width for the servo.
 
-        Calculation is based on the calculated pulse width per degree value.
+        The pulse width is looked up in the compiled calibration curve for the
+        joint servo.
+
+        @param a: The servo angle, to 0.1° accuracy.
+        @param joint: The joint, or None for the default curve.
         """
-        return int((a * self.pwPdeg) + self.pwMin)
+        return (joint.curve if joint else self.curve).angleToPulse(a)
 
-    def pulseToAngle(self, p):
+    def pulseToAngle(self, p, joint=None):
         """
         Converts a pulse width to an angle for the servo.
 
-        Calculation is based on the calculated pulse width per degree value.
+        The angle is looked up in the compiled calibration curve for the joint
+        servo.
+
+        @param p: The pulse width.
+        @param joint: The joint, or None for the default curve.
+        @return: The servo angle to 0.1° accuracy.
+        """
+        return (joint.curve if joint else self.curve).pulseToAngle(p)
+
+    @locked
+    def calibrate(self, joint, points):
+        """
+        Replaces the calibration curve for a joint servo. A joint that is on
+        is moved to where its position is on the new curve.
+
+        @param joint: The joint
+        @param points: The calibration points, see Calibration.Curve, or None
+               to use the default curve.
+        @raises ValueError: If the points are not valid.
+        """
+        curve = self.curve if points is None else Curve(points)
+        pos = self.getPos(joint)
+        joint.setCurve(curve)
+        if pos is not None:
+            self._setPulse(joint, curve.angleToPulse(pos))
+
+    def calibration(self):
+        """
+        @return: A dictionary of calibration points per joint name, for the
+                 calibrated joints.
+        """
+        return dict((j.name, [list(p) for p in j.curve.points])
+                    for j in self.joints if j.curve is not self.curve)
+
+    def getPose(self):
+        """
+        Returns the current position of all joints as joint angles.
+
+        Unlike getPos(), which returns the servo angle, this takes joint
+        inversion into account so the values can be passed straight back to
+        goto() or setPose(). Joints whose servo is off are returned as None.
+
+        @return: A dictionary of position per joint name.
+        """
+        pose = {}
+        for j in self.joints:
+            pw = self.getPos(j, deg=False)
+            pose[j.name] = None if pw is None else j.position(pw)
+        return pose
+
+    def limits(self):
+        """
+        Returns the current limits for all joints.
+
+        @return: A dictionary of (min, max) tuples per joint name.
+        """
+        return dict((j.name, (j.min, j.max)) for j in self.joints)
+
+    def getPoint(self):
         """
-        # For the 9g servos used for testing, the min effective pulse width is
-        # 550 and max is 2500 - this does not equate to a perfect 180° and there
-        # is some degree of error when converting back to angle from pulse
-        # width. The precision modifier below is applied to the calculated value
-        # before rounding to 1 decimal digit to get a more accurate angle in
-        # degrees.
-        pm = 0.05
-        calcDeg = (p - self.pwMin) / self.pwPdeg
-        return round(calcDeg+pm, 1)
+        Returns the current gripper tip position.
 
-    def getPos(self, joint, deg=True):
+        @return: (x, y, z) tuple in mm, or None if any of the base, shoulder
+                 or wrist servos are off.
+        """
+        pose = self.getPose()
+        angles = [pose[j] for j in Kinematics.JOINTS]
+        if None in angles:
+            return None
+        return Kinematics.forward(*angles)
+
+    def gotoPoint(self, x, y, z, strict=True):
+        """
+        Moves the gripper tip to a position.
+
+        The joint angles are solved with Kinematics.solve() and set with
+        setPose(), so the joint limits are respected.
+
+        @param x: X position in mm.
+        @param y: Y position in mm.
+        @param z: Z position in mm.
+        @param strict: See setPose()
+        @return: The new pose as returned by setPose()
+        @raises ValueError: If the position is out of reach or, in strict mode,
+                would put any joint outside its limits.
+        """
+        base, shoulder, wrist = Kinematics.solve(x, y, z)
+        return self.setPose(base=base, shoulder=shoulder, wrist=wrist,
+                            strict=strict)
+
+    def reachable(self, points):
+        """
+        Checks an array of gripper tip positions for reachability within the
+        current joint limits.
+
+        @param points: N x 3 array like of (x, y, z) positions.
+        @return: See Kinematics.solveMany()
+        """
+        return Kinematics.solveMany(points, self.limits())
+
+    def _setPulse(self, joint, pw):
+        """
+        Sets the servo pulse width for a joint and records it as the commanded
+        pulse width.
+
+        @param joint: The joint
+        @param pw: The pulse width
+        """
+        self.io.set_servo_pulsewidth(joint.gpio, pw)
+        self._pw[joint.gpio] = pw
+        self._poseChanged()
+
+    def _poseChanged(self):
+        """
+        Calls all pose listeners.
+        """
+        for l in self.poseListeners:
+            l(self)
+
+    @timed('mearm_arm_call', call='getPos')
+    def getPos(self, joint, deg=True, fresh=False):
         """
         Returns the current pulse width or angle (if deg is True) for the given
         joint.
 
-        @param joint: The joint definition
+        The position is the last commanded pulse width unless fresh is True, or
+        the joint has not been commanded yet, in which case it is read back from
+        pigpiod. A read back only becomes the commanded pulse width if nothing
+        was commanded yet, so changes made outside this instance are left for
+        verify() to find. It is done under the instance lock, so it can not
+        race a concurrent change to the commanded pulse width.
+
+        @param joint: The joint
         @param deg: If true, convert the pulse width to an angle in degrees,
                else return the pulse width.
+        @param fresh: If True, read the pulse width back from pigpiod.
         @return: None if the servo is current off, or else the angle or pulse
                  width
         """
-        pw = self.io.get_servo_pulsewidth(joint['gpio'])
+        pw = self._pw.get(joint.gpio)
+        if fresh or pw is None:
+            with self.lock:
+                pw = self.io.get_servo_pulsewidth(joint.gpio)
+                self._pw.setdefault(joint.gpio, pw)
         if pw == 0:
             return None
 
         # Convert?
         if deg:
-            return self.pulseToAngle(pw)
+            return self.pulseToAngle(pw, joint)
         else:
            return pw
 
+    @timed('mearm_arm_call', call='goto')
+    @locked
     def goto(self, joint, pos):
         """
         Positions a joint to the requested position.
 
-        @param joint: The joint definition
+        @param joint: The joint
         @param pos: The position as an angle. May be a floating point value to
                0.1° accuracy.
-        @return: The position read from pigpio
-        """
-        # Validate that the requested angle in withing the join limits before
-        # setting the angle
-        if (joint['min'] <= pos <= joint['max']):
-            # Handle inverted position here
-            a = joint['max']-(pos-joint['min']) if joint.get('inv', False) else pos
-            self.io.set_servo_pulsewidth(joint['gpio'], self.angleToPulse(a))
-        else:
-            raise ValueError("Angle {} outside of limits for {} ({} - {})"\
-                             .format(pos, joint['name'], joint['min'],
-                                     joint['max']))
+        @return: The new position
+        @raises ValueError: If the position is outside the joint limits.
+        """
+        self._setPulse(joint, joint.pulse(pos))
         return self.getPos(joint)
 
+    @timed('mearm_arm_call', call='setPose')
+    @locked
+    def setPose(self, base=None, shoulder=None, wrist=None, grip=None,
+                strict=True):
+        """
+        Positions all joints at once.
+
+        All targets are validated before any servo is moved. The pulse widths
+        for all four servos are then sent to pigpiod in a single command using
+        the pose script, so the joints start moving at the same time. Joints
+        without a target are sent their current commanded pulse width.
+
+        @param base: Base position angle, or None to leave it where it is.
+        @param shoulder: Shoulder position angle, or None to leave it.
+        @param wrist: Wrist position angle, or None to leave it.
+        @param grip: Grip position angle, or None to leave it.
+        @param strict: If True, the pose is all-or-nothing: if any target is
+               outside its joint limits, a ValueError is raised and no servo is
+               moved. If False, out of limit targets are clamped to the limits.
+        @return: A dictionary of the new joint angle per joint name, like
+                 getPose(). Joints whose servo is off are returned as None.
+        @raises ValueError: In strict mode, if any target is out of limits. The
+                message lists all failing targets.
+        """
+        targets = [base, shoulder, wrist, grip]
+        pulses = []
+        errors = []
+        for joint, pos in zip(self.joints, targets):
+            if pos is None:
+                pulses.append(self.getPos(joint, deg=False) or 0)
+                continue
+            if not strict:
+                pos = min(max(pos, joint.min), joint.max)
+            try:
+                pulses.append(joint.pulse(pos))
+            except ValueError, e:
+                errors.append(str(e))
+        if errors:
+            raise ValueError("; ".join(errors))
+
+        if self.poseScriptID is not None:
+            params = []
+            for joint, pw in zip(self.joints, pulses):
+                params.extend([joint.gpio, pw])
+            self.io.run_script(self.poseScriptID, params)
+            for joint, pw in zip(self.joints, pulses):
+                self._pw[joint.gpio] = pw
+            self._poseChanged()
+        else:
+            # No script support, so send a burst of commands
+            for joint, pw in zip(self.joints, pulses):
+                self._setPulse(joint, pw)
+
+        return dict((j.name, j.position(pw) if pw else None)
+                    for j, pw in zip(self.joints, pulses))
+
+    @locked
+    def verify(self, fix=True):
+        """
+        Verifies the commanded pulse widths against those reported by pigpiod.
+
+        A mismatch means the servo was changed outside of this instance, or
+        pigpiod was restarted.
+
+        The compare and resend run under the instance lock, so a concurrent
+        change through this instance is not taken for a mismatch and reverted.
+
+        @param fix: If True, the commanded pulse width is sent again for any
+               joint that does not match.
+        @return: A dictionary keyed on joint name of (commanded, actual) pulse
+                 widths for joints that did not match. Empty if all match.
+        """
+        mismatch = {}
+        for j in self.joints:
+            cmd = self._pw.get(j.gpio)
+            if cmd is None:
+                continue
+            act = self.io.get_servo_pulsewidth(j.gpio)
+            if act != cmd:
+                mismatch[j.name] = (cmd, act)
+                if fix:
+                    self._setPulse(j, cmd)
+        return mismatch
+
+    def startVerifier(self, interval=5.0, onMismatch=None):
+        """
+        Starts a background thread that calls verify() every interval seconds.
+
+        @param interval: Seconds between verifications.
+        @param onMismatch: Optional callable to call with the verify() result
+               whenever there is a mismatch.
+        """
+        if self._verifier is not None:
+            return
+        self._verifyStop.clear()
+
+        def verifier():
+            while not self._verifyStop.wait(interval):
+                try:
+                    mismatch = self.verify()
+                except Exception:
+                    # Keep verifying; pigpiod may be restarting
+                    continue
+                if mismatch and onMismatch is not None:
+                    onMismatch(mismatch)
+
+        self._verifier = threading.Thread(target=verifier, name="MeArmVerify")
+        self._verifier.daemon = True
+        self._verifier.start()
+
+    def stopVerifier(self):
+        """
+        Stops the background verification thread if running.
+        """
+        if self._verifier is None:
+            return
+        self._verifyStop.set()
+        self._verifier.join()
+        self._verifier = None
+
     def home(self, joint):
         """
         Homes a joint by setting the angle to it's home position.
 
-        @param joint: one of the local joint instance config dictionaries
+        @param joint: one of the instance joints
         """
-        self.goto(joint, joint['home'])
+        self.goto(joint, joint.home)
 
     def homeAll(self):
         """
         Homes all joints
         """
-        for j in [self.base, self.shoulder, self.wrist, self.grip]:
-            self.home(j)
+        self.setPose(*[j.home for j in self.joints])
 
+    @locked
     def setLimit(self, joint, minL=None, maxL=None):
         """
         Set a min and/or max limit for for the given joint.
+
+        Both limits are validated before either is set. If the joint is outside
+        the new limits, it is moved to the nearest limit.
+
+        @param joint: The joint
+        @param minL: The new min limit, or None to leave it.
+        @param maxL: The new max limit, or None to leave it.
+        @raises ValueError: If the limits are not valid.
         """
+        mn = joint.min if minL is None else minL
+        mx = joint.max if maxL is None else maxL
         # Min?
         if minL is not None:
             # Validate - max is either the new max value, else the current
-            mx = maxL if maxL is not None else joint['max']
             if minL > mx:
                 raise ValueError("Can not set min limit ({}) higher than max "\
-                                 "({}) for {}.").format(minL, mx, joint['name'])
+                                 "({}) for {}.".format(minL, mx, joint.name))
             if minL < 0:
-                raise ValueError("Can not set min limit less than 0 for {}.")\
-                                 .format(joint['name'])
-            # Set the limit
-            joint['min'] = minL
-            # Do we need to move to this new limit
-            if self.getPos(joint) < minL:
-                self.goto(joint, minL)
+                raise ValueError("Can not set min limit less than 0 for {}."\
+                                 .format(joint.name))
         # Max?
         if maxL is not None:
             # Validate
-            if maxL < joint['min']:
+            if maxL < mn:
                 raise ValueError("Can not set max limit ({}) less than min "\
-                                 "({}) for {}.".format(maxL, joint['min'],
-                                                        joint['name']))
+                                 "({}) for {}.".format(maxL, mn, joint.name))
             if maxL > 180:
                 raise ValueError("Can not set max limit greater than 180 "\
-                                 "for {}.".format(joint['name']))
-            # Set the limit
-            joint['max'] = maxL
-            # Do we need to move to this new limit
-            if self.getPos(joint) > maxL:
-                self.goto(joint, maxL)
-
-    def qtest(self):
-        """
-        Runs a quick test for all joints. This is meant to be run with only
-        servos connected instead of the complete arm. This precaution is there
-        to prevent damage to the arm should any min/max positions be incorrect.
-        """
-        import time
-        # Get all servos to min position
-        for j in [self.base, self.shoulder, self.wrist, self.grip]:
-            self.goto(j, j['min'])
-
-        # Step all from min to max and back to min wit 0.5° steps
-        a = 0.5
-        step = 0.5
-        while a>=0:
-            print a,
-            for j in [self.base, self.shoulder, self.wrist, self.grip]:
-                try:
-                    self.goto(j, a)
-                    print "{0:10.2f}".format(self.getPos(j)),
-                except ValueError:
-                    pass
-            print
-            a += step
-            if a>=180:
-                step = -0.5
-                a = 180
-
-        for j in [self.base, self.shoulder, self.wrist, self.grip]:
-            self.goto(j, j['max'])
-            time.sleep(0.5)
-            self.goto(j, j['min'])
-
-        self.homeAll()
-                
-
-
-if __name__ == "__main__":
-    # Instantiate an arm instance
-    arm = MeArm(**armDef)
-    # Run the self test
-    arm.qtest()
-
+                                 "for {}.".format(joint.name))
+        if not joint.servoRange(mn, mx):
+            raise ValueError("Limits {} - {} for inverted joint {} are outside "\
+                             "the servo range.".format(mn, mx, joint.name))
+        # Set the limits
+        joint.min, joint.max = mn, mx
+        # Do we need to move to within the new limits
+        pw = self.getPos(joint, deg=False)
+        if pw is not None:
+            pos = joint.position(pw)
+            if not (mn <= pos <= mx):
+                self.goto(joint, min(max(pos, mn), mx))
+
+        # Let any interested parties know
+        for l in self.limitListeners:
+            l(self, joint)
+
+    def _checkOp(self, op, lim, pose):
+        """
+        Validates a batch operation against simulated limits and positions, and
+        updates the simulation with the effect of the operation.
 
+        @param op: The operation. See batch()
+        @param lim: Dictionary of [min, max] lists per joint name.
+        @param pose: Dictionary of positions per joint name.
+        @raises ValueError: If the operation is invalid.
+        """
+        if not isinstance(op, dict):
+            raise ValueError("Operation must be an object")
+        kind, name = op.get('op'), op.get('joint')
+        if kind not in ['pos', 'min', 'max', 'get']:
+            raise ValueError("Invalid operation: {}".format(kind))
+        if name not in lim:
+            raise ValueError("Invalid joint: {}".format(name))
+        if kind == 'get':
+            return
+        v = op.get('value')
+        if not isinstance(v, (int, float)) or isinstance(v, bool):
+            raise ValueError("Integer or float expected for {} {}, got: {}"\
+                             .format(name, kind, v))
+        lo, hi = lim[name]
+        if kind == 'pos':
+            if not (lo <= v <= hi):
+                raise ValueError("Angle {} outside of limits for {} ({} - {})"\
+                                 .format(v, name, lo, hi))
+            pose[name] = v
+            return
+        if kind == 'min':
+            if not (0 <= v <= hi):
+                raise ValueError("Min limit {} for {} must be between 0 and "\
+                                 "max ({})".format(v, name, hi))
+            lo = v
+        else:
+            if not (lo <= v <= 180):
+                raise ValueError("Max limit {} for {} must be between min "\
+                                 "({}) and 180".format(v, name, lo))
+            hi = v
+        # Validated like setLimit() does, so it can not fail half way through
+        # the batch
+        if not getattr(self, name).servoRange(lo, hi):
+            raise ValueError("Limits {} - {} for inverted joint {} are outside "\
+                             "the servo range.".format(lo, hi, name))
+        lim[name] = [lo, hi]
+        # Setting a limit moves the joint to within the limit
+        if pose[name] is not None:
+            pose[name] = min(max(pose[name], lim[name][0]), lim[name][1])
+
+    @timed('mearm_arm_call', call='batch')
+    @locked
+    def batch(self, ops):
+        """
+        Validates and applies an ordered list of operations as one unit.
+
+        Each operation is a dictionary with the keys:
+
+            'op': 'pos' to set a position, 'min' or 'max' to set a limit, or
+                  'get' to read the joint position and limits.
+            'joint': The joint name.
+            'value': The angle for 'pos', 'min' and 'max' operations.
+
+        All operations are validated in order against the limits and positions
+        as they will be after the preceding operations, before anything is
+        applied. Runs of position operations on different joints are combined
+        into a single setPose() call. The instance lock is held throughout, so
+        no other changes are interleaved.
+
+        @param ops: The list of operations.
+        @return: A list with a result for each operation: the new position or
+                 limit for 'pos', 'min' and 'max' operations, and a dictionary
+                 with 'pos', 'min' and 'max' keys for 'get' operations. Positions
+                 are joint angles, like getPose().
+        @raises ValueError: If any operation is invalid, with a message listing
+                all invalid operations. Nothing is applied in this case.
+        """
+        lim = dict((j.name, [j.min, j.max]) for j in self.joints)
+        pose = self.getPose()
+        errors = []
+        for i, op in enumerate(ops):
+            try:
+                self._checkOp(op, lim, pose)
+            except ValueError, e:
+                errors.append("op {}: {}".format(i, e))
+        if errors:
+            raise ValueError("; ".join(errors))
+
+        results = [None] * len(ops)
+        # Position operations waiting to be sent as one pose, as
+        # {joint name: (op index, position)}
+        pending = {}
+
+        def flush():
+            if not pending:
+                return
+            res = self.setPose(**dict((n, p) for n, (i, p) in pending.items()))
+            for n, (i, p) in pending.items():
+                results[i] = res[n]
+            pending.clear()
+
+        for i, op in enumerate(ops):
+            name, kind = op['joint'], op['op']
+            if kind == 'pos':
+                # A second position for the same joint starts a new pose
+                if name in pending:
+                    flush()
+                pending[name] = (i, op['value'])
+                continue
+            flush()
+            joint = getattr(self, name)
+            if kind == 'get':
+                pw = self.getPos(joint, deg=False)
+                results[i] = {'pos': None if pw is None else joint.position(pw),
+                              'min': joint.min, 'max': joint.max}
+            else:
+                self.setLimit(joint, **{kind+'L': op['value']})
+                results[i] = getattr(joint, kind)
+        flush()
+
+        return results
+
+    def close(self):
+        """
+        Removes the pose script from pigpiod and releases the pigpiod
+        connection.
+        """
+        self.stopVerifier()
+        if self.poseScriptID is not None:
+            self.io.delete_script(self.poseScriptID)
+            self.poseScriptID = None
+        self.io.stop()
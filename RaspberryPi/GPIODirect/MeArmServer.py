@@ -2,8 +2,6 @@
 # *-* coding: utf-8 *-*
 # TODO:
 #    * Introspect for service help
-#    * Sessions to allow only one session to control the arm at once. It should
-#      have timeout functionality, session release, aquire, etc.
 #    * JSON/HTML?YAML/TEXT optional output from services
 #    * Handle assertions and errors in page handlers and return HTML error code.
 """
@@ -14,77 +12,215 @@ RaspberryPi connected to the MeArmI²C arduino via I²C.
 """
 
 import os, os.path
+import sys
 import json
-import time
-import uuid
+import threading
 import cherrypy
+try:
+    from ws4py.server.cherrypyserver import WebSocketPlugin, WebSocketTool
+    from ws4py.websocket import WebSocket
+except ImportError:
+    # No WebSocket streaming without ws4py. The web UI falls back to PUTs.
+    WebSocket = None
 
 from MeArm import armDef, MeArm
+import Kinematics
+import Workspace
+import SimPigpio
+import Calibration
+from StateStream import StateHub, armState
+from Metrics import REGISTRY, timed, describe
+from Profiler import PROFILER
+from Admission import AdmissionController, Rejected, rejectRequest
+from StaticCache import StaticCache, StaticAssets
+from Lease import LeaseManager
+from CameraRelay import CameraRelay, BOUNDARY
+from Clock import monotonic
+from Trajectory import Move, MeArmSink
+from ControlLoop import ControlLoop
+
+## Seconds between keep alive comments on idle state event streams
+EVENTS_KEEPALIVE = 15
+## Default max concurrent state event stream viewers. Every viewer holds a
+#  request thread, so together with CAMERA_MAX_VIEWERS this must stay well
+#  below the thread pool size.
+EVENTS_MAX_VIEWERS = 3
+## Default max concurrent camera stream viewers
+CAMERA_MAX_VIEWERS = 3
+## Seconds a viewer turned away from a full stream should wait before retrying
+VIEWER_RETRY = 10
 
 ## The maximum inactive period for the bearer of the control stick.
 CONTROL_STICK_TIMEOUT = 60
 
-def checkControlExpiration():
+describe('mearm_http_handler_seconds', "Time taken by REST handlers.")
+describe('mearm_http_handler_errors_total', "REST handler calls that raised "
+         "an error, including HTTP errors.")
+describe('mearm_http_tool_seconds', "Time taken by request tools.")
+describe('mearm_http_request_seconds', "Time taken by whole requests, "
+         "including CherryPy and tools.")
+_requestTime = REGISTRY.histogram('mearm_http_request_seconds')
+
+def requestTimerTool():
+    """
+    Tool timing every request from the start of handling the resource to the
+    end of the request. Compared to the handler timings, this shows the time
+    spent in CherryPy and the tools.
+    """
+    t = monotonic()
+    def done():
+        _requestTime.observe(monotonic() - t)
+    cherrypy.request.hooks.attach('on_end_request', done)
+
+cherrypy.tools.requestTimer = cherrypy.Tool('on_start_resource',
+                                            requestTimerTool)
+
+def adminTool():
+    """
+    Tool restricting handlers to administrators.
+
+    If the 'admin.token' config value is set, the request must carry it in the
+    X-Admin-Token header. Without a token only requests from the local host are
+    allowed.
+    """
+    token = cherrypy.config.get('admin.token', None)
+    req = cherrypy.request
+    if token is not None:
+        if req.headers.get('X-Admin-Token', None) != token:
+            raise cherrypy.HTTPError(403, "Admin token required.")
+    elif req.remote.ip not in ('127.0.0.1', '::1'):
+        raise cherrypy.HTTPError(403, "Only allowed from the local host.")
+
+cherrypy.tools.admin = cherrypy.Tool('before_handler', adminTool)
+
+def profilerTool():
+    """
+    Tool running requests under the profiler while it is sampling. It runs
+    before the other tools so that their time is included.
+    """
+    p = PROFILER.begin()
+    if p is not None:
+        cherrypy.request.hooks.attach('on_end_request',
+                                      lambda: PROFILER.end(p), priority=90)
+
+cherrypy.tools.profiler = cherrypy.Tool('on_start_resource', profilerTool,
+                                        priority=10)
+
+def admissionTool():
+    """
+    Tool admitting requests that use the arm hardware through the admission
+    controller in the 'admission' config value. See Admission.
+
+    GET and HEAD requests only read cached state, so they are not subject to
+    admission control unless they ask for a 'fresh' read. Rejected requests
+    get a 429 or 503 response with a Retry-After header without running the
+    handler.
     """
-    Checks if the control stick control session has expired, and if so, reset it
-    to None.
+    req = cherrypy.request
+    if req.method in ('GET', 'HEAD') and \
+       str(req.params.get('fresh', '0')).lower() not in ['1', 'true', 'yes']:
+        return
+    adm = cherrypy.config.get('admission', None)
+    if adm is None:
+        return
+    client = req.remote.ip
+    try:
+        adm.admit(client)
+    except Rejected, e:
+        rejectRequest(e.status, e.args[0], e.retryAfter)
+        return
+    req.hooks.attach('on_end_request', lambda: adm.release(client),
+                     failsafe=True)
+
+# After the control stick tool, so requests without control are not queued
+cherrypy.tools.admission = cherrypy.Tool('before_handler', admissionTool,
+                                         priority=70)
+
+## Open streaming responses per stream name. See viewerLimitTool.
+_viewers = {}
+_viewersLock = threading.Lock()
+
+def viewerLimitTool(name, limit):
+    """
+    Tool capping the concurrent viewers of a streaming response.
+
+    A streamed response holds its request thread for as long as the viewer
+    stays connected, so without a cap viewers could take every thread in the
+    pool and starve all other requests. Viewers over the limit get a 503
+    response with a Retry-After header without running the handler. The slot
+    is given back when the response ends, also when the viewer disconnects.
+
+    @param name: The name the viewers are counted under.
+    @param limit: The max concurrent viewers.
     """
-    # If no-one has the stick, we return
-    if cherrypy.controlStick is None:
+    with _viewersLock:
+        n = _viewers.get(name, 0)
+        if n < limit:
+            _viewers[name] = n + 1
+    if n >= limit:
+        rejectRequest(503, "Too many viewers.", VIEWER_RETRY)
         return
-    # Has it expired?
-    if time.time() > cherrypy.controlStick['tmout']:
-        # Yep, release control
-        cherrypy.controlStick = None
 
+    def release():
+        with _viewersLock:
+            _viewers[name] -= 1
+    cherrypy.request.hooks.attach('on_end_request', release, failsafe=True)
+
+cherrypy.tools.viewerLimit = cherrypy.Tool('before_handler', viewerLimitTool,
+                                           priority=70)
+
+## The control stick lease. See Lease.LeaseManager.
+controlStick = LeaseManager(CONTROL_STICK_TIMEOUT)
+
+def stickToken():
+    """
+    Returns the control stick lease token for the request. Browsers get the
+    token in the 'stick' cookie when taking the stick, and other clients can
+    send it in the X-Control-Token header instead.
+
+    @return: The token, or None if the request has none.
+    """
+    req = cherrypy.request
+    token = req.headers.get('X-Control-Token', None)
+    if token is None and 'stick' in req.cookie:
+        token = req.cookie['stick'].value
+    return token
+
+@timed('mearm_http_tool', tool='controlStick')
 def controlStickTool(noControlError=False):
     """
     Tool that gets called before every requests to see if the caller has the
-    "control stick". Having the control stick means that the user of this
-    session is allowed to control the arm, to ensure that only one user can take
-    control at a time.
+    "control stick". Having the control stick means that the user is allowed
+    to control the arm, to ensure that only one user can take control at a
+    time.
 
     To get the "control stick", the user first needs to call the
-    services/takeStick endpoint. If the control stick is available, the user's
-    session will get a UUID (if it does not already have one) and the control
-    stick assigned to that session.
-
-    The control stick itself is the locally added cherrypy.controlStick
-    attribute. When the stick is not in anyone's control, this attribute is
-    None. As soon as someone takes control, it is set to the following dict:
-        
-        {'sid': session ID of controller,
-         'tmout': a unix time stamp of when control will be lost without any
-                  further control actions.
-        }
+    services/control endpoint. If the control stick is available, the user
+    gets a lease on it, identified by a token (see stickToken()).
+
+    Every control action (any request other than a GET or HEAD) by the lease
+    holder renews the lease for another CONTROL_STICK_TIMEOUT seconds, and
+    without any the lease expires and the stick is free again. GET and HEAD
+    requests only check the lease, which does not need a lock, and requests
+    without a token do not touch the lease at all.
 
-    Every call through this tool by the session owner that has control of the
-    stick, will set the time out for the control period to the current time +
-    CONTROL_STICK_TIMEOUT unless the current time is past the last tmout value,
-    in which case cherrypy.controlStick is reset to None. This will either
-    extend the current controll period, or relinquish control of the stick on
-    timeout.
+    @param noControlError: If True, raise a 400 error if the caller does not
+           have control.
     """
+    req = cherrypy.request
     # Preset the request.inControl indicator to False to show the current
-    # session does not have control of the arm.
-    cherrypy.request.inControl = False
-
-    # Get the session ID from the session if any
-    sid = cherrypy.session.get('id', None)
-    # Check for expiration regardless of stick control
-    checkControlExpiration()
-
-    # If the control stick is in no-ones hands, or not in the hands of the
-    # current session owner, return or raise error
-    if cherrypy.controlStick is None or cherrypy.controlStick['sid'] != sid:
-        if noControlError:
-            raise cherrypy.HTTPError(400, "You do not have control.")
-        return
+    # caller does not have control of the arm.
+    req.inControl = False
 
-    # The current session own the stick, so extend the period before timeout.
-    cherrypy.controlStick['tmout'] = time.time() + CONTROL_STICK_TIMEOUT
-    # Indicate that this session has control
-    cherrypy.request.inControl = True
+    token = stickToken()
+    if token is not None:
+        if req.method in ('GET', 'HEAD'):
+            req.inControl = controlStick.check(token)
+        else:
+            req.inControl = controlStick.renew(token)
+
+    if not req.inControl and noControlError:
+        raise cherrypy.HTTPError(400, "You do not have control.")
 
 # Add the control stick tool before the handler is called.
 cherrypy.tools.controlStick = cherrypy.Tool('before_handler',
@@ -100,9 +236,13 @@ class UI(object):
     @cherrypy.expose
     def index(self):
         """
-        Main index.
+        Main index, served from the static file cache. It is revalidated on
+        every load, so UI changes show up straight away.
         """
-        return open('web/html/index.html')
+        return cherrypy.config['staticCache'].serve('html/index.html',
+                                                    maxAge=0)
+    index._cp_config = {'tools.encode.on': False,
+                        'tools.controlStick.on': False}
 
 
 def servicesErrorHandler(status, message, traceback, version):
@@ -170,6 +310,57 @@ class Arm(object):
     def GET(self):
         return self.serviceHelp
 
+    @cherrypy.tools.controlStick(noControlError=True)
+    def PUT(self, *args, **kwargs):
+        """
+        Sets a whole pose, or applies a batch of operations, in one request.
+
+        For a pose we expect a JSON document in the format:
+            { 'base': angle, 'shoulder': angle, 'wrist': angle, 'grip': angle }
+        where any of the joints are optional, but at least one is required. The
+        new positions per joint name are returned.
+
+        For a batch we expect a JSON document in the format:
+            { 'ops': [ {'op': 'pos'|'min'|'max'|'get',
+                        'joint': joint name,
+                        'value': angle}, ... ] }
+        or just the list of operations. A JSON object with a 'results' list
+        with the result for each operation in order is returned. See
+        MeArm.batch() for details.
+
+        All operations are validated before anything is applied, and either all
+        are applied or none.
+        """
+        json = getattr(cherrypy.request, 'json', None)
+        arm = cherrypy.config['MeArmIF']
+
+        pose = False
+        if isinstance(json, dict) and 'ops' in json:
+            ops = json['ops']
+        elif isinstance(json, dict):
+            # A pose is a batch of position operations
+            pose = True
+            ops = [{'op': 'pos', 'joint': j.name, 'value': json[j.name]}
+                   for j in arm.joints if j.name in json]
+            extra = set(json) - set(j.name for j in arm.joints)
+            if extra:
+                raise cherrypy.HTTPError(400, "Invalid joint(s): {}"\
+                                         .format(", ".join(sorted(extra))))
+        else:
+            ops = json
+        if not isinstance(ops, list) or len(ops) == 0:
+            raise cherrypy.HTTPError(400, "Expected a non-empty JSON pose "\
+                                     "object or list of operations.")
+
+        try:
+            results = arm.batch(ops)
+        except (ValueError, IOError), e:
+            raise cherrypy.HTTPError(400, str(e.args[0]))
+
+        if pose:
+            return dict((op['joint'], r) for op, r in zip(ops, results))
+        return {'results': results}
+
 class Joint(object):
     """
     Base class for service exposure for control and access to one joint in the
@@ -194,6 +385,7 @@ class Joint(object):
         # Expose this instace to cherrypy
         self.exposed = True
 
+    @timed('mearm_http_handler', handler='Joint.GET')
     def GET(self, *args, **kwargs):
         """
         Return the current joint position, min or max positions, or all joint
@@ -211,8 +403,13 @@ class Joint(object):
             ../services/joint/limits -return the joint min and max positions
             ../services/joint/info   -return the current, min and max positions
 
+        The position is the last commanded position unless the 'fresh' query
+        parameter is given a true value, e.g. ../services/joint/info?fresh=1,
+        in which case it is read back from pigpiod.
+
         @keyword args: Optionally one of 'pos', 'min', 'max', 'limits' or 'info'
                  to indicate other than standard postion to return.
+        @keyword kwargs: Optionally 'fresh' to force a hardware read.
 
         @return: A dictionary with keys 'pos', 'min', 'max' keywords with the
                  requested values. One or more of these keys will be present.
@@ -228,15 +425,17 @@ class Joint(object):
         # Set up the return
         res = {}
         if detail in [None, 'pos', 'info']:
-            res['pos'] = arm.getPos(joint)
+            fresh = kwargs.get('fresh', '0').lower() in ['1', 'true', 'yes']
+            res['pos'] = arm.getPos(joint, fresh=fresh)
         if detail in ['min', 'limits', 'info']:
-            res['min'] = joint['min']
+            res['min'] = joint.min
         if detail in ['max', 'limits', 'info']:
-            res['max'] = joint['max']
+            res['max'] = joint.max
 
         return res
 
     @cherrypy.tools.controlStick(noControlError=True)
+    @timed('mearm_http_handler', handler='Joint.PUT')
     def PUT(self, *args, **kwargs):
         """
         Set the current joint position and/or min and/or max limit.
@@ -271,18 +470,303 @@ class Joint(object):
                 else:
                     a = {k+'L': v}
                     arm.setLimit(joint, **a)
-                    json[k] = joint[k]
+                    json[k] = getattr(joint, k)
             except (ValueError, IOError), e:
                 raise cherrypy.HTTPError(400, str(e.args[0]))
 
         return json
 
+class Point(object):
+    """
+    Cartesian control of the gripper tip position.
+
+    Positions are JSON objects with 'x', 'y' and 'z' keys in mm. See the
+    Kinematics module for the coordinate system.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        """
+        Returns the current gripper tip position, or checks reachability of a
+        position:
+
+            ../services/arm/point                    -current position
+            ../services/arm/point/reach?x=..&y=..&z=.. -reachability check
+
+        The reachability check is a lookup in the workspace table and returns
+        a JSON object with the 'reachable' flag and the 'seed' joint angles per
+        joint name for the nearest precomputed pose (null if not reachable).
+        """
+        if args:
+            if args[0] != 'reach':
+                raise cherrypy.HTTPError(400, "Invalid point request: {}"\
+                                         .format(args[0]))
+            return self._reach(**kwargs)
+
+        arm = cherrypy.config['MeArmIF']
+        p = arm.getPoint()
+        if p is None:
+            raise cherrypy.HTTPError(400, "Arm servos are not all on.")
+        return dict(zip(['x', 'y', 'z'], p))
+
+    @cherrypy.tools.controlStick(noControlError=True)
+    def PUT(self, *args, **kwargs):
+        """
+        Moves the gripper tip to a position.
+
+        We expect a JSON document in the format:
+            { 'x': number, 'y': number, 'z': number }
+
+        @return: The new joint angles per joint name.
+        """
+        json = getattr(cherrypy.request, 'json', None)
+        arm = cherrypy.config['MeArmIF']
+        p = self._point(json)
+        try:
+            return arm.gotoPoint(*p)
+        except ValueError, e:
+            raise cherrypy.HTTPError(400, str(e.args[0]))
+
+    def POST(self, *args, **kwargs):
+        """
+        Solves the joint angles for a batch of positions without moving the arm.
+
+        We expect a JSON document in the format:
+            { 'points': [[x, y, z], ...] }
+
+        @return: A JSON object with a 'solutions' list containing for each
+                 point in order an object with the solved 'angles' per joint
+                 name (null if out of reach), and the 'reachable' and
+                 'inLimits' flags.
+        """
+        json = getattr(cherrypy.request, 'json', None)
+        arm = cherrypy.config['MeArmIF']
+        if not isinstance(json, dict) or \
+           not isinstance(json.get('points', None), list):
+            raise cherrypy.HTTPError(400, "Expected a JSON object with a "\
+                                     "'points' list.")
+        try:
+            angles, reach, inLim = arm.reachable(json['points'])
+        except (ValueError, ImportError), e:
+            raise cherrypy.HTTPError(400, str(e.args[0]))
+
+        sols = []
+        for a, r, l in zip(angles.tolist(), reach.tolist(), inLim.tolist()):
+            sols.append({
+                'angles': dict(zip(Kinematics.JOINTS, a)) if r else None,
+                'reachable': r,
+                'inLimits': l
+            })
+        return {'solutions': sols}
+
+    def _reach(self, **kwargs):
+        """
+        Workspace table reachability lookup for the x, y and z query params.
+        """
+        ws = cherrypy.config.get('workspace', None)
+        if ws is None:
+            raise cherrypy.HTTPError(400, "No workspace table available.")
+        try:
+            p = [float(kwargs[k]) for k in ['x', 'y', 'z']]
+        except (KeyError, ValueError):
+            raise cherrypy.HTTPError(400, "Numeric x, y and z parameters "\
+                                     "expected.")
+        seed = ws.seed(*p)
+        return {'reachable': seed is not None,
+                'seed': dict(zip(Kinematics.JOINTS, seed)) if seed else None}
+
+    def _point(self, json):
+        """
+        Validates a JSON position object.
+
+        @return: (x, y, z) tuple
+        """
+        if not isinstance(json, dict):
+            raise cherrypy.HTTPError(400, "Expected a JSON postion object.")
+        p = []
+        for k in ['x', 'y', 'z']:
+            v = json.get(k, None)
+            if not isinstance(v, (int, float)):
+                raise cherrypy.HTTPError(400, "Integer or float expected for "\
+                                         "'{}', got: {}".format(k, v))
+            p.append(v)
+        return p
+
+class Motion(object):
+    """
+    Smooth synchronized moves, run by the fixed rate control loop. See the
+    Trajectory and ControlLoop modules.
+
+        GET    ../services/arm/move -the control loop stats, including the
+                                     number of setpoints still to run
+        PUT    ../services/arm/move -start a smooth move to a target pose
+        DELETE ../services/arm/move -stop the move, holding the current pose
+
+    The loop drives the arm from its own thread, so the motion timing does not
+    depend on request thread scheduling. Joint, pose and point commands made
+    while a move runs are overridden by its next setpoint.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        return cherrypy.config['controlLoop'].stats()
+
+    @cherrypy.tools.controlStick(noControlError=True)
+    def PUT(self, *args, **kwargs):
+        """
+        Starts a smooth move from the current pose, replacing any move that is
+        still running.
+
+        We expect a JSON document in the format:
+            { 'pose': { 'base': angle, 'shoulder': angle, ... },
+              'vMax': °/s, 'aMax': °/s², 'profile': 'trapezoid'|'scurve',
+              'duration': seconds }
+        where only 'pose' is required, with at least one joint. All target
+        angles are validated against the joint limits before the move starts.
+
+        @return: A JSON object with the move 'duration' in seconds and the
+                 'target' pose.
+        """
+        json = getattr(cherrypy.request, 'json', None)
+        arm = cherrypy.config['MeArmIF']
+        if not isinstance(json, dict) or \
+           not isinstance(json.get('pose', None), dict) or not json['pose']:
+            raise cherrypy.HTTPError(400, "Expected a JSON object with a "\
+                                     "non-empty 'pose' object.")
+        target = json['pose']
+        extra = set(target) - set(j.name for j in arm.joints)
+        if extra:
+            raise cherrypy.HTTPError(400, "Invalid joint(s): {}"\
+                                     .format(", ".join(sorted(extra))))
+        for k in ['vMax', 'aMax', 'duration']:
+            v = json.get(k, 1)
+            if not isinstance(v, (int, float)) or isinstance(v, bool) or \
+               v <= 0:
+                raise cherrypy.HTTPError(400, "Positive number expected for "\
+                                         "'{}', got: {}".format(k, v))
+        opts = dict((k, json[k]) for k in ['vMax', 'aMax', 'profile',
+                                           'duration'] if k in json)
+        try:
+            for j in arm.joints:
+                if j.name not in target:
+                    continue
+                v = target[j.name]
+                if not isinstance(v, (int, float)) or isinstance(v, bool):
+                    raise ValueError("Integer or float expected for {}, got: "\
+                                     "{}".format(j.name, v))
+                # Validates against the joint limits
+                j.pulse(v)
+            move = Move(arm.getPose(), target, **opts)
+        except ValueError, e:
+            raise cherrypy.HTTPError(400, str(e.args[0]))
+        cherrypy.config['controlLoop'].follow(move)
+        return {'duration': move.duration, 'target': move.target}
+
+    @cherrypy.tools.controlStick(noControlError=True)
+    def DELETE(self, *args, **kwargs):
+        loop = cherrypy.config['controlLoop']
+        loop.clear()
+        return loop.stats()
+
+class ArmSocket(WebSocket or object):
+    """
+    WebSocket handler for streaming joint positions.
+
+    Each frame from the client is a text message in the format:
+
+        <seq> <joint> <pos>
+
+    where seq is a client sequence number, joint is the joint initial (one of
+    'b', 's', 'w' or 'g') and pos is the position angle. Every frame is
+    answered with an ack in the format:
+
+        <seq> <pos>
+
+    with the new position on success, or on failure:
+
+        <seq> ! <error message>
+
+    Control is checked on every frame against the control stick token of the
+    client that opened the socket, and every successful frame extends the
+    control period the same as a PUT does.
+    """
+
+    joints = {'b': 'base', 's': 'shoulder', 'w': 'wrist', 'g': 'grip'}
+
+    # The control stick token of the client that opened the socket. Set by the
+    # Stream handler.
+    token = None
+
+    def received_message(self, message):
+        if message.is_binary:
+            return
+        f = message.data.split()
+        seq = f[0] if f else '0'
+        try:
+            if len(f) != 3 or f[1] not in self.joints:
+                raise ValueError("Invalid frame: {}".format(message.data))
+            if not controlStick.renew(self.token):
+                raise ValueError("You do not have control.")
+            arm = cherrypy.config['MeArmIF']
+            joint = getattr(arm, self.joints[f[1]])
+            pos = arm.goto(joint, float(f[2]))
+        except (ValueError, IOError), e:
+            self.send("{} ! {}".format(seq, e.args[0]))
+            return
+        self.send("{} {}".format(seq, pos))
+
+class Stream(object):
+    """
+    WebSocket endpoint for streaming joint positions. See ArmSocket.
+
+    The upgrade to a WebSocket is done by the ws4py websocket tool, so the
+    handler only needs to tie the socket to the caller's control stick token.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        cherrypy.request.ws_handler.token = stickToken()
+
+class Events(object):
+    """
+    Server-Sent Events stream of the arm state.
+
+    Every event is the state of all joints as a JSON object keyed on joint name,
+    each with 'pos', 'min' and 'max' values, with the state version as event
+    ID. The current state is sent on connect, and then every new state as it
+    is published to the state hub. All viewers share the same snapshot, so
+    viewers do not cause any hardware reads.
+
+    Every viewer holds a request thread, so the number of viewers is capped by
+    the 'events.maxViewers' config value (see viewerLimitTool).
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        hub = cherrypy.config['stateHub']
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+
+        def events():
+            version = None
+            while not hub.closed:
+                ev = hub.wait(version, EVENTS_KEEPALIVE)
+                if ev is None:
+                    # Comment line to keep the connection alive
+                    yield ": keepalive\n\n"
+                    continue
+                version, data = ev
+                yield "id: {}\ndata: {}\n\n".format(version, data)
+
+        return events()
+    GET._cp_config = {'response.stream': True}
+
 class ControlStick(object):
     """
     Control stick service.
 
     This services will allow taking the control stick ("GET") and releasing it
-    again on completion ("DELETE") by a user/session.
+    again on completion ("DELETE") by a user.
     """
     exposed = True
 
@@ -290,52 +774,132 @@ class ControlStick(object):
         """
         Grabs the control stick if it is available.
 
+        The lease token is set in the 'stick' cookie, and also returned as the
+        'token' value in a JSON object for clients that send it in the
+        X-Control-Token header.
+
         On success returns: 200 - OK, you've got the stick
         If not available returns: 402 - Payment required
         """
         # Validate and clean name
-        name = None if name.strip()=="" else name.strip()
+        name = (name or "").strip() or 'Anonymous'
 
-        # If the stick is not avail, and I'm not already in control, return 402
-        if cherrypy.controlStick is not None and not cherrypy.request.inControl:
-            msg = "Ask {0[name]} at {0[ip]}, or wait {1}s"\
-                    .format(cherrypy.controlStick,
-                            cherrypy.controlStick['tmout']-time.time())
+        # Atomically take the stick, or renew it if we already have it
+        ok, lease = controlStick.acquire(name, cherrypy.request.remote.ip,
+                                         stickToken())
+        if not ok:
+            msg = "Ask {0.name} at {0.ip}, or wait {1:.0f}s"\
+                    .format(lease, lease.remaining())
             raise cherrypy.HTTPError(402, msg)
 
-        # If the stick is avaiable, grab it
-        if cherrypy.controlStick is None:
-            # Does this session have an ID?
-            if not cherrypy.session.get('id', False):
-                cherrypy.session['id'] = str(uuid.uuid1())
-            # Grab the stick
-            cherrypy.controlStick = {
-                'sid': cherrypy.session['id'],
-                'tmout': time.time() + CONTROL_STICK_TIMEOUT,
-                'name': 'Anonymous' if name is None else name,
-                'ip': cherrypy.request.remote.ip
-            }
-
-        # At this point we either already had control, or we just took control.
+        cookie = cherrypy.response.cookie
+        cookie['stick'] = lease.token
+        cookie['stick']['path'] = '/'
+        cookie['stick']['httponly'] = True
         cherrypy.response.status = "200 OK, you've got the stick."
+        return {'token': lease.token}
 
     def DELETE(self):
         """
         Release stick if you have it.
         """
         # If you are in control, release it
-        if cherrypy.request.inControl:
-            cherrypy.controlStick = None
-            cherrypy.request.inControl = False
-        else:
+        if not controlStick.release(stickToken()):
             # It's not your's to release
             raise cherrypy.HTTPError('400', "Not your's to release...")
+        cherrypy.request.inControl = False
 
+        cookie = cherrypy.response.cookie
+        cookie['stick'] = ''
+        cookie['stick']['path'] = '/'
+        cookie['stick']['expires'] = 0
         cherrypy.response.status = "200 OK, thanks for playing."
 
+class Metrics(object):
+    """
+    Timing histograms and counters in the Prometheus text format.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return REGISTRY.render()
+
+class Profile(object):
+    """
+    Admin only on demand profiling of live requests. See Profiler.
+
+        GET    ../services/profile       -the profiling status
+        GET    ../services/profile/stats -the aggregated stats as text, with
+                                          optional 'sort' and 'limit' query
+                                          params
+        GET    ../services/profile/dump  -the aggregated stats in the pstats
+                                          file format
+        POST   ../services/profile       -start profiling for 'seconds'
+                                          seconds, sampling 'every' Nth
+                                          request, from a JSON object
+        DELETE ../services/profile       -stop profiling early
+    """
+    exposed = True
+    _cp_config = {'tools.admin.on': True}
+
+    def GET(self, *args, **kwargs):
+        if len(args) == 0:
+            return self._status()
+        if args[0] == 'stats':
+            try:
+                text = PROFILER.report(kwargs.get('sort', 'cumulative'),
+                                       int(kwargs.get('limit', 40)))
+            except (KeyError, ValueError):
+                raise cherrypy.HTTPError(400, "Invalid sort or limit.")
+            cherrypy.response.headers['Content-Type'] = 'text/plain'
+            return text
+        if args[0] == 'dump':
+            data = PROFILER.dump()
+            if data is None:
+                raise cherrypy.HTTPError(404, "No requests sampled.")
+            cherrypy.response.headers['Content-Type'] = \
+                    'application/octet-stream'
+            cherrypy.response.headers['Content-Disposition'] = \
+                    'attachment; filename="mearm.prof"'
+            return data
+        raise cherrypy.HTTPError(400, "Invalid profile request: {}"\
+                                 .format(args[0]))
+
+    def POST(self, *args, **kwargs):
+        req = getattr(cherrypy.request, 'json', None) or {}
+        try:
+            PROFILER.start(float(req.get('seconds', 10)),
+                           int(req.get('every', 1)))
+        except (AttributeError, TypeError, ValueError), e:
+            raise cherrypy.HTTPError(400, str(e))
+        return self._status()
+
+    def DELETE(self, *args, **kwargs):
+        PROFILER.stop()
+        return self._status()
+
+    def _status(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(PROFILER.status())
+
+class SimStats(object):
+    """
+    Call counters of the simulated backend, for measuring the hardware calls
+    per request when benchmarking. Only mounted when running with the
+    simulated backend.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        return dict(cherrypy.config['simBackend'].calls)
+
 class Camera(object):
     """
     Base class for camera interfacing.
+
+    The camera stream is relayed through the server, see CameraRelay, so any
+    number of viewers share one connection to the camera.
     """
 
     @cherrypy.expose()
@@ -343,7 +907,41 @@ class Camera(object):
         """
         Returns the video stream URL as a plain text string.
         """
-        return cherrypy.config['camera.url']
+        return '/services/camera/stream'
+
+    @cherrypy.expose()
+    def stream(self):
+        """
+        Relayed MJPEG stream of the camera.
+
+        Every viewer holds a request thread, so the number of viewers is capped
+        by the 'camera.maxViewers' config value (see viewerLimitTool).
+        """
+        cherrypy.response.headers['Content-Type'] = \
+                'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY)
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return cherrypy.config['cameraRelay'].stream()
+    stream._cp_config = {'response.stream': True}
+
+    @cherrypy.expose()
+    def snapshot(self):
+        """
+        Returns the latest camera frame as a JPEG image.
+        """
+        jpeg = cherrypy.config['cameraRelay'].snapshot()
+        if jpeg is None:
+            raise cherrypy.HTTPError(503, "No camera frame available.")
+        cherrypy.response.headers['Content-Type'] = 'image/jpeg'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return jpeg
+
+    @cherrypy.expose()
+    def stats(self):
+        """
+        Returns the relay state and counters as JSON.
+        """
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(cherrypy.config['cameraRelay'].stats())
 
     @cherrypy.expose()
     def view(self):
@@ -360,29 +958,113 @@ class Camera(object):
             <img src="{}"></img>
             </body>
         </html>
-        """.format(cherrypy.config['camera.url'])
+        """.format(self.URL())
         cherrypy.response.headers["content-type"] = "text/html";
         import re
         # Remove the spaces on the start of lines from the HTML
         return re.sub('^ {8}', '', pg, flags=re.M)
 
 if __name__ == '__main__':
+    # An optional config file can be given on the command line, for example
+    # sim.conf to run against simulated servos.
+    if len(sys.argv) > 1:
+        cherrypy.config.update(sys.argv[1])
+    # The servo backend is pigpiod ('pigpio') or simulated servos ('sim') with
+    # the SimPigpio.pi keyword args from 'arm.sim'.
+    io = None
+    if cherrypy.config.get('arm.backend', 'pigpio') == 'sim':
+        io = SimPigpio.pi(**cherrypy.config.get('arm.sim', {}))
+        cherrypy.log("Using simulated servos")
+    # Per servo calibration curves, measured with Calibration.py
+    calibration = None
+    calPath = cherrypy.config.get('arm.calibration', Calibration.PATH)
+    if os.path.exists(calPath):
+        calibration = Calibration.load(calPath)
+        cherrypy.log("Using servo calibration from {}".format(calPath))
+    arm = MeArm(io=io, calibration=calibration, **armDef)
+    # Periodically check that the servos are where we told them to be
+    arm.startVerifier(10,
+                      lambda m: cherrypy.log("Servo mismatch: {}".format(m)))
+    cherrypy.engine.subscribe('stop', arm.stopVerifier)
+
+    # Serve the web UI files from memory
+    staticCache = StaticCache('web',
+                              maxAge=cherrypy.config.get('static.maxAge', 3600))
+    staticCache.preload()
+
+    # Admission control for requests using the arm hardware
+    admission = AdmissionController(
+            maxActive=cherrypy.config.get('admission.active', 1),
+            maxQueue=cherrypy.config.get('admission.queue', 16),
+            perClient=cherrypy.config.get('admission.perClient', 4),
+            timeout=cherrypy.config.get('admission.timeout', 2.0))
+
+    # The shared state snapshot for the events stream. It is published on
+    # every change made through the arm instance, and by a sampler reading
+    # back from the hardware to catch changes made outside the server.
+    stateHub = StateHub()
+    publishState = lambda a, *args: stateHub.publish(armState(a))
+    arm.poseListeners.append(publishState)
+    arm.limitListeners.append(publishState)
+    publishState(arm)
+    stateHub.startSampler(lambda: armState(arm, fresh=True), 5)
+    cherrypy.engine.subscribe('stop', stateHub.close)
+
+    # Smooth moves are run by a fixed rate control loop, see Motion
+    controlLoop = ControlLoop(MeArmSink(arm),
+                              rate=cherrypy.config.get('control.rate', 50),
+                              priority=cherrypy.config.get('control.priority',
+                                                           None),
+                              cpu=cherrypy.config.get('control.cpu', None))
+    controlLoop.start()
+    cherrypy.engine.subscribe('stop', controlLoop.stop)
+
+    # Memory map the workspace lookup table, building it on first use, and
+    # keep it up to date with the joint limits.
+    try:
+        try:
+            ws = Workspace.Workspace.load()
+            ws.updateLimits(arm.limits())
+        except IOError:
+            ws = Workspace.Workspace.build(Workspace.PATH, arm.limits())
+        arm.limitListeners.append(lambda a, j: ws.updateLimits(a.limits()))
+    except ImportError, e:
+        cherrypy.log("No workspace table: {}".format(e))
+        ws = None
+
     cherrypy.config.update({
         'server.socket_host': '0.0.0.0',
         'server.socket_port': 8081,
         'server.thread_pool': 10,
-        'server.thread_pool_max': -1,
+        'server.thread_pool_max': 20,
         # Set up arm instance in config
-        'MeArmIF': MeArm(**armDef),
+        'MeArmIF': arm,
+        'workspace': ws,
+        'stateHub': stateHub,
+        'controlLoop': controlLoop,
+        'admission': admission,
+        'staticCache': staticCache,
+        'simBackend': io,
         # Camera config
         'camera.url': 'http://fruitix:8080/?action=stream',
     })
+    # Settings in the config file override the defaults above
+    if len(sys.argv) > 1:
+        cherrypy.config.update(sys.argv[1])
+    # One upstream camera connection shared by all viewers
+    cameraRelay = CameraRelay(cherrypy.config['camera.url'],
+                              frames=cherrypy.config.get('camera.frames', 8),
+                              idle=cherrypy.config.get('camera.idle', 30))
+    cherrypy.config.update({'cameraRelay': cameraRelay})
+    cherrypy.engine.subscribe('stop', cameraRelay.stop)
     conf = {
         '/': {
-            'tools.sessions.on': True,
-            'tools.staticdir.root': os.path.abspath(os.getcwd()),
+            # Control is by lease token (see controlStickTool), so no sessions
+            # are needed.
             # Make sure we switch the control stick tool on.
             'tools.controlStick.on': True,
+            'tools.requestTimer.on': True,
+            'tools.profiler.on': True,
         },
         '/services': {
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
@@ -392,6 +1074,26 @@ if __name__ == '__main__':
         '/services/arm': {
             # Return an error unless the requestor has the stick
             #'tools.controlStick.noControlError': True,
+            # Bound the requests waiting for the hardware
+            'tools.admission.on': True,
+        },
+        '/services/arm/events': {
+            'tools.json_in.on': False,
+            'tools.json_out.on': False,
+            'tools.controlStick.on': False,
+            'tools.viewerLimit.on': True,
+            'tools.viewerLimit.name': 'events',
+            'tools.viewerLimit.limit': cherrypy.config.get(
+                'events.maxViewers', EVENTS_MAX_VIEWERS),
+        },
+        '/services/profile': {
+            'tools.json_out.on': False,
+            'tools.controlStick.on': False,
+        },
+        '/services/metrics': {
+            'tools.json_in.on': False,
+            'tools.json_out.on': False,
+            'tools.controlStick.on': False,
         },
         '/services/camera': {
             # Default dispatcher
@@ -400,14 +1102,33 @@ if __name__ == '__main__':
             'tools.response_headers.headers': [('Content-Type', 'text/plain')],
             'tools.json_in.on': False,
             'tools.json_out.on': False,
+            'tools.controlStick.on': False,
+        },
+        '/services/camera/stream': {
+            'tools.viewerLimit.on': True,
+            'tools.viewerLimit.name': 'camera',
+            'tools.viewerLimit.limit': cherrypy.config.get(
+                'camera.maxViewers', CAMERA_MAX_VIEWERS),
         },
         '/static': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': './web'
+            # Files are served from memory, see StaticCache
+            'tools.controlStick.on': False,
         }
     }
+    if WebSocket is not None:
+        # Set up WebSocket support for position streaming
+        WebSocketPlugin(cherrypy.engine).subscribe()
+        cherrypy.tools.websocket = WebSocketTool()
+        conf['/services/arm/stream'] = {
+            'tools.websocket.on': True,
+            'tools.websocket.handler_cls': ArmSocket,
+            'tools.json_in.on': False,
+            'tools.json_out.on': False,
+        }
     # Hang the UI off '/'
     webapp = UI()
+    # The web UI files
+    webapp.static = StaticAssets(staticCache)
 
     # Set up the main /services/ endpoint
     webapp.services = WebService()
@@ -417,13 +1138,26 @@ if __name__ == '__main__':
     webapp.services.arm.shoulder = Joint('Shoulder')
     webapp.services.arm.wrist = Joint('Wrist')
     webapp.services.arm.grip = Joint('Grip')
+    # Cartesian gripper position
+    webapp.services.arm.point = Point()
+    # Smooth moves through the control loop
+    webapp.services.arm.move = Motion()
+    # State event stream
+    webapp.services.arm.events = Events()
+    # Position streaming
+    if WebSocket is not None:
+        webapp.services.arm.stream = Stream()
     # Set up the control stick endpoint
     webapp.services.control = ControlStick()
     # The camera interface
     webapp.services.camera = Camera()
-
-    # The actual control stick container.
-    cherrypy.controlStick = None
+    # Metrics
+    webapp.services.metrics = Metrics()
+    # On demand profiling
+    webapp.services.profile = Profile()
+    # Simulated backend call counters
+    if io is not None:
+        webapp.services.sim = SimStats()
 
     # Start the app
     cherrypy.quickstart(webapp, '/', conf)
@@ -0,0 +1,211 @@
+# *-* coding: utf-8 *-*
+"""
+Low overhead timing histograms and counters for the MeArm servers and arm
+interfaces, rendered in the Prometheus text exposition format.
+
+Code is instrumented with the timed() decorator or the timer() context
+manager, which record the time taken in a histogram and count any exceptions:
+
+    from Metrics import timed, timer, REGISTRY
+
+    @timed('mearm_arm_call', call='goto')
+    def goto(self, joint, angle):
+        ...
+
+    with timer('mearm_http_request', handler='Joint.GET', joint='base'):
+        ...
+
+    print REGISTRY.render()
+
+A timer named 'mearm_arm_call' records into the 'mearm_arm_call_seconds'
+histogram and the 'mearm_arm_call_errors_total' counter. Recording is a bisect
+and a few additions under a lock per metric, so instrumentation can be left on
+all the time.
+"""
+
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+from Clock import monotonic
+
+## Default histogram bucket upper bounds in seconds
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5]
+
+def _labelStr(labels, extra=None):
+    """
+    Formats a labels tuple, plus an optional extra (name, value) label, for
+    the exposition format.
+    """
+    labels = list(labels) + ([extra] if extra else [])
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                   .replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+class Counter(object):
+    """
+    Monotonically increasing counter.
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def lines(self, name, labels):
+        return ["{}{} {}".format(name, _labelStr(labels), self.value)]
+
+class Histogram(object):
+    """
+    Histogram of observed values in fixed buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        @param buckets: Sorted bucket upper bounds. Values above the last bound
+               go into an implicit +Inf bucket.
+        """
+        self._lock = threading.Lock()
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        i = bisect.bisect_left(self.bounds, v)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += v
+            self.count += 1
+
+    def lines(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total, n = self.sum, self.count
+        res = []
+        cum = 0
+        for b, c in zip(self.bounds + ['+Inf'], counts):
+            cum += c
+            res.append("{}_bucket{} {}".format(name,
+                                               _labelStr(labels, ('le', b)),
+                                               cum))
+        res.append("{}_sum{} {!r}".format(name, _labelStr(labels), total))
+        res.append("{}_count{} {}".format(name, _labelStr(labels), n))
+        return res
+
+class Registry(object):
+    """
+    Collection of metrics, keyed on metric name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(name, labels tuple): metric}
+        self._metrics = {}
+        # {name: help text}
+        self._help = {}
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        m = self._metrics.get(key)
+        if m is None:
+            with self._lock:
+                m = self._metrics.setdefault(key, cls())
+        return m
+
+    def counter(self, name, **labels):
+        """
+        @return: The Counter for name and labels, created if needed.
+        """
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        """
+        @return: The Histogram for name and labels, created if needed.
+        """
+        return self._get(Histogram, name, labels)
+
+    def describe(self, name, text):
+        """
+        Sets the help text for a metric name.
+        """
+        self._help[name] = text
+
+    def render(self):
+        """
+        @return: All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            items = sorted(self._metrics.items(), key=lambda i: i[0])
+        res = []
+        last = None
+        for (name, labels), m in items:
+            if name != last:
+                if name in self._help:
+                    res.append("# HELP {} {}".format(name, self._help[name]))
+                res.append("# TYPE {} {}".format(name, m.kind))
+                last = name
+            res.extend(m.lines(name, labels))
+        return "\n".join(res) + "\n"
+
+## The default registry
+REGISTRY = Registry()
+
+def describe(name, text):
+    """
+    Sets the help text for a metric name in the default registry.
+    """
+    REGISTRY.describe(name, text)
+
+@contextmanager
+def timer(name, registry=None, **labels):
+    """
+    Context manager recording the time taken into the name+'_seconds'
+    histogram, and counting exceptions in the name+'_errors_total' counter.
+
+    @param name: The metric base name.
+    @param registry: The Registry; the default registry if None.
+    @param labels: The metric labels.
+    """
+    reg = registry or REGISTRY
+    hist = reg.histogram(name + '_seconds', **labels)
+    t = monotonic()
+    try:
+        yield
+    except Exception:
+        reg.counter(name + '_errors_total', **labels).inc()
+        raise
+    finally:
+        hist.observe(monotonic() - t)
+
+def timed(name, registry=None, **labels):
+    """
+    Decorator version of timer(). The metrics are looked up once when
+    decorating, so the cost per call is only the timing and recording.
+    """
+    reg = registry or REGISTRY
+    hist = reg.histogram(name + '_seconds', **labels)
+    errors = reg.counter(name + '_errors_total', **labels)
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            t = monotonic()
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                hist.observe(monotonic() - t)
+        return wrapper
+    return decorator
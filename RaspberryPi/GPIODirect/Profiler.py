@@ -0,0 +1,157 @@
+# *-* coding: utf-8 *-*
+"""
+On demand cProfile sampling of live requests.
+
+The RequestProfiler is switched on for a number of seconds, and while it is on
+every Nth request is run under its own cProfile.Profile. The profiles of all
+sampled requests are aggregated into one pstats.Stats, which can be rendered
+as text or dumped in the pstats file format for tools like snakeviz:
+
+    PROFILER.start(30, every=5)
+    ...
+    p = PROFILER.begin()     # at the start of a request, in its thread
+    ...
+    PROFILER.end(p)          # at the end of the request
+    ...
+    print PROFILER.report()
+
+cProfile profiles the thread it is enabled in, so a sample covers everything
+done in the request thread: tools, the handler and any backend calls made
+from that thread. Work handed off to other threads, like the I²C bus worker,
+is not included.
+"""
+
+import marshal
+import pstats
+import cProfile
+import threading
+from StringIO import StringIO
+
+from Clock import monotonic
+
+## The longest profiling period in seconds that can be requested
+MAX_SECONDS = 300
+
+class RequestProfiler(object):
+    """
+    Samples requests with cProfile for a limited period.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.until = 0
+        self.every = 1
+        self.seconds = 0
+        # Requests seen and sampled in the current period
+        self.seen = 0
+        self.sampled = 0
+        # The aggregated stats, or None if nothing was sampled yet
+        self.stats = None
+
+    def start(self, seconds, every=1):
+        """
+        Starts a new profiling period, discarding any earlier results.
+
+        @param seconds: The period length, at most MAX_SECONDS.
+        @param every: Sample every Nth request.
+        @raises ValueError: For invalid arguments.
+        """
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError("Seconds must be more than 0 and at most {}"\
+                             .format(MAX_SECONDS))
+        if int(every) < 1:
+            raise ValueError("Every must be 1 or more")
+        with self._lock:
+            self.seconds = seconds
+            self.every = int(every)
+            self.seen = 0
+            self.sampled = 0
+            self.stats = None
+            self.until = monotonic() + seconds
+
+    def stop(self):
+        """
+        Ends the profiling period early. The results are kept.
+        """
+        self.until = 0
+
+    def active(self):
+        return monotonic() < self.until
+
+    def begin(self):
+        """
+        Called at the start of a request in the request thread.
+
+        @return: An enabled cProfile.Profile if this request is sampled, else
+                 None.
+        """
+        if not self.active():
+            return None
+        with self._lock:
+            self.seen += 1
+            if (self.seen - 1) % self.every:
+                return None
+        p = cProfile.Profile()
+        p.enable()
+        return p
+
+    def end(self, p):
+        """
+        Called at the end of a sampled request in the request thread.
+
+        @param p: The Profile returned by begin().
+        """
+        p.disable()
+        with self._lock:
+            try:
+                if self.stats is None:
+                    self.stats = pstats.Stats(p)
+                else:
+                    self.stats.add(p)
+            except TypeError:
+                # Nothing was recorded
+                return
+            self.sampled += 1
+
+    def status(self):
+        """
+        @return: A dictionary with the profiling state.
+        """
+        return {'active': self.active(),
+                'remaining': max(0.0, self.until - monotonic()),
+                'seconds': self.seconds,
+                'every': self.every,
+                'seen': self.seen,
+                'sampled': self.sampled}
+
+    def report(self, sort='cumulative', limit=40):
+        """
+        @param sort: The pstats sort key.
+        @param limit: The number of functions to list.
+        @return: The aggregated stats as text.
+        @raises KeyError: For an invalid sort key.
+        """
+        with self._lock:
+            if self.stats is None:
+                return "No requests sampled.\n"
+            buf = StringIO()
+            stream = self.stats.stream
+            self.stats.stream = buf
+            try:
+                self.stats.sort_stats(sort).print_stats(limit)
+            finally:
+                self.stats.stream = stream
+            return buf.getvalue()
+
+    def dump(self):
+        """
+        @return: The aggregated stats in the pstats file format, or None if
+                 nothing was sampled.
+        """
+        with self._lock:
+            if self.stats is None:
+                return None
+            return marshal.dumps(self.stats.stats)
+
+## The process wide profiler
+PROFILER = RequestProfiler()
@@ -0,0 +1,174 @@
+# *-* coding: utf-8 *-*
+"""
+Simulated pigpio interface for running MeArm without a Raspberry Pi.
+
+The pi class implements the subset of the pigpio.pi interface used by MeArm,
+with a model of the pigpiod socket round trip latency, the servo slew rate
+and fault injection:
+
+    from SimPigpio import pi
+    arm = MeArm(io=pi(latency=0.0005), **armDef)
+
+Every call is counted per method in the calls attribute, so the number of
+pigpiod round trips an operation costs can be measured.
+"""
+
+import re
+import time
+import random
+import threading
+from collections import defaultdict
+
+try:
+    import pigpio
+    _Error = pigpio.error
+except ImportError:
+    _Error = Exception
+
+## Script status values, the same as pigpio
+PI_SCRIPT_INITING = 0
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+PI_SCRIPT_WAITING = 3
+PI_SCRIPT_FAILED = 4
+
+class error(_Error):
+    """
+    Simulated pigpio error. A subclass of pigpio.error if pigpio is installed.
+    """
+    pass
+
+class pi(object):
+    """
+    Simulated pigpio.pi instance.
+    """
+
+    ## Valid servo pulse width range, the same as pigpiod
+    pwMin = 500
+    pwMax = 2500
+
+    def __init__(self, latency=0.0005, jitter=0.0002, slew=0.12,
+                 failRate=0.0, seed=None):
+        """
+        Instance initialization.
+
+        @param latency: Simulated pigpiod round trip time per call in seconds.
+        @param jitter: Max random extra time per call in seconds.
+        @param slew: Servo speed in seconds per 60°, as found in servo data
+               sheets.
+        @param failRate: Probability of any call failing with an error.
+        @param seed: Optional random seed for repeatable jitter and faults.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        # Servo speed in µs of pulse width per second, using the MeArm default
+        # of 1950µs over 180°.
+        self.slewRate = (1950/180.0) * 60 / slew
+        self.failRate = failRate
+        self.failNext = 0
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self.connected = True
+        # Per gpio servo state as {gpio: [target pw, start pw, start time]}
+        self._servos = {}
+        self._scripts = {}
+        self._nextScript = 0
+        # Call counters per method name
+        self.calls = defaultdict(int)
+
+    def inject(self, failNext=0, failRate=None):
+        """
+        Injects faults.
+
+        @param failNext: The number of following calls that fail.
+        @param failRate: If not None, the new probability of any call failing.
+        """
+        self.failNext = failNext
+        if failRate is not None:
+            self.failRate = failRate
+
+    def _call(self, name):
+        """
+        Counts a call, applies the latency model and injects faults.
+        """
+        with self._lock:
+            self.calls[name] += 1
+            fail = self.failNext > 0 or self._rand.random() < self.failRate
+            if self.failNext > 0:
+                self.failNext -= 1
+            delay = self.latency + self._rand.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+        if fail or not self.connected:
+            raise error("Simulated pigpiod failure in {}".format(name))
+
+    def _servo(self, gpio, pw):
+        cur = self.actual(gpio)
+        self._servos[gpio] = [pw, cur if cur else pw, time.time()]
+
+    def set_servo_pulsewidth(self, gpio, pw):
+        self._call('set_servo_pulsewidth')
+        if pw != 0 and not (self.pwMin <= pw <= self.pwMax):
+            raise error("PI_BAD_PULSEWIDTH")
+        self._servo(gpio, pw)
+        return 0
+
+    def get_servo_pulsewidth(self, gpio):
+        """
+        Returns the commanded pulse width, the same as pigpiod does.
+        """
+        self._call('get_servo_pulsewidth')
+        return self._servos.get(gpio, [0])[0]
+
+    def actual(self, gpio):
+        """
+        Returns the simulated physical servo position as a pulse width, taking
+        the slew rate into account. Not part of the pigpio interface.
+        """
+        if gpio not in self._servos:
+            return 0
+        target, start, t = self._servos[gpio]
+        if target == 0:
+            return 0
+        moved = (time.time() - t) * self.slewRate
+        if abs(target - start) <= moved:
+            return target
+        return start + moved if target > start else start - moved
+
+    def store_script(self, script):
+        self._call('store_script')
+        # Only servo commands with parameter or literal arguments are supported
+        cmds = re.findall(r'servo\s+(p\d|\d+)\s+(p\d|\d+)', script.lower())
+        if not cmds:
+            raise error("PI_BAD_SCRIPT")
+        sid = self._nextScript
+        self._nextScript += 1
+        self._scripts[sid] = cmds
+        return sid
+
+    def script_status(self, sid):
+        self._call('script_status')
+        if sid not in self._scripts:
+            raise error("PI_BAD_SCRIPT_ID")
+        return (PI_SCRIPT_HALTED, [0]*10)
+
+    def run_script(self, sid, params=None):
+        self._call('run_script')
+        if sid not in self._scripts:
+            raise error("PI_BAD_SCRIPT_ID")
+        params = params or []
+        val = lambda a: params[int(a[1])] if a[0] == 'p' else int(a)
+        for g, p in self._scripts[sid]:
+            pw = val(p)
+            if pw != 0 and not (self.pwMin <= pw <= self.pwMax):
+                raise error("PI_BAD_PULSEWIDTH")
+            self._servo(val(g), pw)
+        return 0
+
+    def delete_script(self, sid):
+        self._call('delete_script')
+        self._scripts.pop(sid, None)
+        return 0
+
+    def stop(self):
+        self.connected = False
@@ -0,0 +1,107 @@
+# *-* coding: utf-8 *-*
+"""
+Shared arm state snapshot for server push to any number of viewers.
+
+The StateHub holds one serialized snapshot of the arm state with a version
+number. The snapshot is published when commands change the arm state, and
+optionally by a single background sampler. Viewers wait on the hub for a newer
+version than the one they have, so the number of viewers does not change the
+number of hardware reads.
+"""
+
+import json
+import threading
+
+def armState(arm, fresh=False):
+    """
+    Returns the state of all joints of a MeArm instance.
+
+    @param arm: The MeArm instance.
+    @param fresh: If True, positions are read back from the hardware, else the
+           commanded positions are used.
+    @return: A dictionary per joint name with 'pos', 'min' and 'max' keys.
+    """
+    return dict((j.name, {'pos': arm.getPos(j, fresh=fresh),
+                          'min': j.min, 'max': j.max})
+                for j in arm.joints)
+
+class StateHub(object):
+    """
+    Versioned state snapshot with change notification.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.version = 0
+        self.state = None
+        # The state serialized once for all viewers
+        self.data = None
+        self.closed = False
+        self._sampler = None
+        self._samplerStop = threading.Event()
+
+    def publish(self, state):
+        """
+        Publishes a new state. Viewers are only woken up if the state changed.
+
+        @param state: The state. Must be JSON serializable.
+        """
+        with self._cond:
+            if state == self.state:
+                return
+            self.state = state
+            self.data = json.dumps(state)
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout=None):
+        """
+        Waits for a state newer than version.
+
+        @param version: The version the caller already has, or None to get the
+               current state immediately if there is one.
+        @param timeout: Max time in seconds to wait.
+        @return: (version, serialized state) tuple, or None if there was no
+                 newer state within timeout or the hub was closed.
+        """
+        with self._cond:
+            if self.version == version or self.data is None:
+                self._cond.wait(timeout)
+            if self.closed or self.version == version or self.data is None:
+                return None
+            return self.version, self.data
+
+    def startSampler(self, fn, interval):
+        """
+        Starts a background thread that publishes fn() every interval seconds.
+
+        @param fn: Callable returning the state.
+        @param interval: Seconds between samples.
+        """
+        if self._sampler is not None:
+            return
+        self._samplerStop.clear()
+
+        def sampler():
+            while not self._samplerStop.wait(interval):
+                try:
+                    self.publish(fn())
+                except Exception:
+                    # Keep sampling; the hardware may be temporarily away
+                    continue
+
+        self._sampler = threading.Thread(target=sampler, name="StateSampler")
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def close(self):
+        """
+        Stops the sampler and releases all waiting viewers.
+        """
+        if self._sampler is not None:
+            self._samplerStop.set()
+            self._sampler.join()
+            self._sampler = None
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
@@ -0,0 +1,174 @@
+# *-* coding: utf-8 *-*
+"""
+In memory cache for the web UI files.
+
+Files under the web directory are read into memory on first use, together
+with a gzip compressed variant and a strong ETag, and reloaded when their
+modification time changes. Requests are answered from memory with the
+compressed variant where the client accepts it, and with a 304 when the
+client already has the current version:
+
+    cache = StaticCache('web')
+    cache.preload()
+    webapp.static = StaticAssets(cache)
+
+StaticAssets switches the session tool off, and servers switch any other tools
+not needed for serving files off too, so page loads cost as little request
+thread time as possible.
+"""
+
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+from StringIO import StringIO
+
+import cherrypy
+
+## Content types worth compressing, besides text/*
+COMPRESSIBLE = ['application/javascript', 'application/x-javascript',
+                'application/json', 'image/svg+xml']
+
+class Asset(object):
+    """
+    A cached file.
+    """
+    __slots__ = ['mtime', 'ctype', 'body', 'etag', 'gz', 'gzEtag']
+
+    def __init__(self, path):
+        """
+        Reads and prepares a file.
+
+        @param path: The full file path.
+        """
+        self.mtime = os.stat(path).st_mtime
+        self.ctype = mimetypes.guess_type(path)[0] or \
+                     'application/octet-stream'
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.etag = '"{}"'.format(hashlib.sha1(self.body).hexdigest()[:20])
+        self.gz = None
+        self.gzEtag = None
+        if self.ctype.startswith('text/') or self.ctype in COMPRESSIBLE:
+            buf = StringIO()
+            # A fixed mtime keeps the compressed bytes, and so the ETag, the
+            # same between restarts.
+            with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+                f.write(self.body)
+            if buf.tell() < len(self.body):
+                self.gz = buf.getvalue()
+                self.gzEtag = self.etag[:-1] + '-gz"'
+
+class StaticCache(object):
+    """
+    Cache of the files under a directory.
+    """
+
+    def __init__(self, root, check=True, maxAge=3600):
+        """
+        @param root: The directory to serve files from.
+        @param check: If True, the file modification time is checked on every
+               request and changed files are reloaded.
+        @param maxAge: The Cache-Control max-age in seconds for the files.
+        """
+        self.root = os.path.abspath(root)
+        self.check = check
+        self.maxAge = maxAge
+        self._lock = threading.Lock()
+        self._assets = {}
+
+    def _path(self, rel):
+        """
+        @return: The full path for a relative path, or None if it is outside
+                 root.
+        """
+        path = os.path.normpath(os.path.join(self.root, rel))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def get(self, rel):
+        """
+        @param rel: The file path relative to root.
+        @return: The Asset for the file, or None if there is no such file.
+        """
+        asset = self._assets.get(rel)
+        if asset is not None and not self.check:
+            return asset
+        path = self._path(rel)
+        if path is None:
+            return None
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if asset is not None and asset.mtime == mtime:
+            return asset
+        if not os.path.isfile(path):
+            return None
+        with self._lock:
+            asset = Asset(path)
+            self._assets[rel] = asset
+        return asset
+
+    def preload(self):
+        """
+        Loads all files under root.
+
+        @return: The number of files loaded.
+        """
+        for dirpath, dirs, files in os.walk(self.root):
+            for f in files:
+                self.get(os.path.relpath(os.path.join(dirpath, f), self.root))
+        return len(self._assets)
+
+    def serve(self, rel, maxAge=None):
+        """
+        Serves a file as the response to the current CherryPy request.
+
+        @param rel: The file path relative to root.
+        @param maxAge: The Cache-Control max-age in seconds, instead of the
+               default for the cache.
+        @return: The response body.
+        @raises cherrypy.HTTPError: 404 if there is no such file.
+        """
+        asset = self.get(rel)
+        if asset is None:
+            raise cherrypy.HTTPError(404)
+        req = cherrypy.request
+        headers = cherrypy.response.headers
+
+        body, etag = asset.body, asset.etag
+        if asset.gz is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in req.headers.get('Accept-Encoding', ''):
+                body, etag = asset.gz, asset.gzEtag
+                headers['Content-Encoding'] = 'gzip'
+        headers['Content-Type'] = asset.ctype
+        headers['ETag'] = etag
+        maxAge = self.maxAge if maxAge is None else maxAge
+        headers['Cache-Control'] = 'public, max-age={}'.format(maxAge) \
+                                   if maxAge else 'no-cache'
+
+        match = [t.strip() for t in
+                 req.headers.get('If-None-Match', '').split(',')]
+        if etag in match or '*' in match:
+            cherrypy.response.status = 304
+            headers.pop('Content-Encoding', None)
+            return ""
+        return body
+
+class StaticAssets(object):
+    """
+    CherryPy handler serving the files in a StaticCache.
+    """
+    _cp_config = {'tools.sessions.on': False,
+                  'tools.encode.on': False}
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    @cherrypy.expose
+    def default(self, *path):
+        return self.cache.serve('/'.join(path))
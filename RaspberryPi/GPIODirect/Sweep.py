@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+"""
+Servo sweep characterization for the MeArm.
+
+Each joint is swept from one end of its range to the other and back in fixed
+angle steps, either as fast as possible or at a target command rate. For every
+step the goto() call is timed, the pulse width is read back from pigpiod with
+the read back timed separately, and the angle from the read back pulse width is
+compared to the commanded angle. The report has per joint:
+
+    rate      - the achieved commands per second, and the target
+    interval  - the time between command starts, and its jitter against the
+                target interval
+    command   - goto() latency: the lock, conversion and the pigpiod round trip
+    readback  - get_servo_pulsewidth() latency: one bare pigpiod round trip
+    error     - read back angle against the commanded angle
+    tracking  - simulated servo position against the commanded angle, after
+                the settle time. Only with the simulated backend.
+
+The report is written as JSON, together with the Pi model, pigpio version and
+the sweep settings, so servos, pigpiod settings and Pi models can be compared.
+Passing an earlier report with --compare prints the change per joint and exits
+with status 1 if any joint got slower or lost command rate by more than the
+threshold:
+
+    python Sweep.py [-j joint] [-s step] [-r rate] [-o report] [--compare old]
+
+By default the joints are swept within their limits, so this is safe with the
+arm assembled. Only use --full with the servos disconnected from the arm, as
+sweeping the full 0 - 180° servo range may damage it.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+
+from Clock import monotonic
+
+## Default regression threshold for --compare, as a fraction
+THRESHOLD = 0.2
+
+def percentile(vals, p):
+    """
+    @param vals: Sorted list of values.
+    @param p: The percentile (0-100).
+    @return: The nearest rank percentile, or None for no values.
+    """
+    if not vals:
+        return None
+    return vals[min(len(vals) - 1, int(len(vals) * p / 100.0))]
+
+def summary(vals, scale=1.0):
+    """
+    @param vals: List of values.
+    @param scale: Factor to scale the values with, like 1000 for ms.
+    @return: Dictionary with the mean, p50, p95, p99 and max of the values.
+    """
+    vals = sorted(v * scale for v in vals)
+    if not vals:
+        return {}
+    return {'mean': round(sum(vals) / len(vals), 4),
+            'p50': round(percentile(vals, 50), 4),
+            'p95': round(percentile(vals, 95), 4),
+            'p99': round(percentile(vals, 99), 4),
+            'max': round(vals[-1], 4)}
+
+def angles(lo, hi, step, passes):
+    """
+    @return: The list of angles sweeping lo to hi and back passes times.
+    """
+    n = int(round((hi - lo) / step))
+    up = [min(hi, round(lo + i*step, 1)) for i in range(n + 1)]
+    if up[-1] != hi:
+        up.append(hi)
+    return (up + up[-2::-1][:-1]) * passes + [lo]
+
+def sweep(arm, joint, lo=None, hi=None, step=0.5, rate=0, passes=1,
+          settle=0):
+    """
+    Sweeps a joint and measures the command and read back timing and errors.
+
+    @param arm: The MeArm instance.
+    @param joint: The joint.
+    @param lo: The low end of the sweep, default the joint min limit.
+    @param hi: The high end of the sweep, default the joint max limit.
+    @param step: The angle step in degrees.
+    @param rate: The target commands per second, or 0 for as fast as possible.
+    @param passes: The number of times to sweep up and back down.
+    @param settle: Seconds to wait after each command before reading back.
+    @return: Dictionary with the results.
+    """
+    lo = joint.min if lo is None else lo
+    hi = joint.max if hi is None else hi
+    io = arm.io
+    actual = getattr(io, 'actual', None)
+    cmdLat, rbLat, errs, track, starts = [], [], [], [], []
+
+    arm.goto(joint, lo)
+    time.sleep(0.5)
+    start = monotonic()
+    for i, a in enumerate(angles(lo, hi, step, passes)):
+        if rate:
+            wait = start + i / float(rate) - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        t0 = monotonic()
+        arm.goto(joint, a)
+        t1 = monotonic()
+        if settle:
+            time.sleep(settle)
+        t2 = monotonic()
+        pw = io.get_servo_pulsewidth(joint.gpio)
+        t3 = monotonic()
+        starts.append(t0)
+        cmdLat.append(t1 - t0)
+        rbLat.append(t3 - t2)
+        errs.append(abs(joint.position(pw) - a))
+        if actual is not None:
+            track.append(abs(joint.position(int(round(actual(joint.gpio)))) - a))
+    elapsed = monotonic() - start
+
+    intervals = [b - a for a, b in zip(starts, starts[1:])]
+    res = {'joint': joint.name,
+           'range': [lo, hi],
+           'commands': len(cmdLat),
+           'seconds': round(elapsed, 3),
+           'rate': round(len(cmdLat) / elapsed, 1),
+           'targetRate': rate,
+           'intervalMs': summary(intervals, 1000),
+           'commandMs': summary(cmdLat, 1000),
+           'readbackMs': summary(rbLat, 1000),
+           'errorDeg': summary(errs)}
+    if rate and intervals:
+        res['jitterMs'] = summary([abs(v - 1.0/rate) for v in intervals], 1000)
+    if track:
+        res['trackingDeg'] = summary(track)
+    return res
+
+def piModel():
+    """
+    @return: The Raspberry Pi model, or the machine type if not on a Pi.
+    """
+    try:
+        with open('/proc/device-tree/model') as f:
+            return f.read().strip('\0\n')
+    except IOError:
+        return platform.machine()
+
+def environment(arm, backend):
+    """
+    @return: Dictionary describing where the sweep ran.
+    """
+    env = {'host': socket.gethostname(),
+           'model': piModel(),
+           'python': sys.version.split()[0],
+           'backend': backend,
+           'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    for key, call in [('pigpio', 'get_pigpio_version'),
+                      ('hwRevision', 'get_hardware_revision')]:
+        fn = getattr(arm.io, call, None)
+        if fn is not None:
+            env[key] = fn()
+    return env
+
+def report(r):
+    """
+    Prints a sweep result.
+    """
+    print "{:8} {:5d} cmds {:7.1f}/s  cmd p50 {:6.3f} p99 {:6.3f} ms  "\
+          "readback p50 {:6.3f} ms  error max {:4.2f}°"\
+          .format(r['joint'], r['commands'], r['rate'], r['commandMs']['p50'],
+                  r['commandMs']['p99'], r['readbackMs']['p50'],
+                  r['errorDeg']['max'])
+    if 'jitterMs' in r:
+        print "{:8} jitter p50 {:6.3f} p99 {:6.3f} max {:6.3f} ms"\
+              .format('', r['jitterMs']['p50'], r['jitterMs']['p99'],
+                      r['jitterMs']['max'])
+    if 'trackingDeg' in r:
+        print "{:8} tracking error p50 {:5.2f} max {:5.2f}°"\
+              .format('', r['trackingDeg']['p50'], r['trackingDeg']['max'])
+
+def compare(old, new, threshold):
+    """
+    Compares two reports and prints the change per joint.
+
+    @return: True if any joint regressed by more than threshold.
+    """
+    prev = dict((r['joint'], r) for r in old['results'])
+    regressed = False
+    print "\nChange from {} ({}):".format(old['env'].get('model'),
+                                          old['env'].get('time'))
+    if old.get('settings') != new['settings']:
+        print "  Note: the sweep settings differ: {}"\
+              .format(json.dumps(old.get('settings'), sort_keys=True))
+    for r in new['results']:
+        o = prev.get(r['joint'])
+        if o is None:
+            continue
+        p99 = r['commandMs']['p99'] / max(o['commandMs']['p99'], 0.001) - 1
+        rate = r['rate'] / max(o['rate'], 0.001) - 1
+        flag = p99 > threshold or rate < -threshold
+        regressed = regressed or flag
+        print "  {:8} cmd p99 {:+6.1%}  rate {:+6.1%}{}"\
+              .format(r['joint'], p99, rate, "  REGRESSION" if flag else "")
+    return regressed
+
+
+if __name__ == "__main__":
+    import argparse
+    import SimPigpio
+    import Calibration
+    from MeArm import MeArm, armDef
+
+    parser = argparse.ArgumentParser(description="MeArm servo sweep "
+                                     "characterization.")
+    parser.add_argument('-j', '--joint', action='append',
+                        choices=sorted(armDef),
+                        help="Joint to sweep. May be repeated. Default is all "
+                        "joints")
+    parser.add_argument('-s', '--step', type=float, default=0.5,
+                        help="Angle step in degrees")
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help="Target commands per second, 0 for as fast as "
+                        "possible")
+    parser.add_argument('-n', '--passes', type=int, default=1,
+                        help="Sweeps up and down per joint")
+    parser.add_argument('--settle', type=float, default=0,
+                        help="Seconds to wait after each command before "
+                        "reading back")
+    parser.add_argument('--full', action='store_true',
+                        help="Sweep the full 0 - 180° servo range instead of "
+                        "the joint limits. Servos disconnected only!")
+    parser.add_argument('--sim', type=json.loads, nargs='?', const={},
+                        help="Use simulated servos, with an optional JSON "
+                        "object of SimPigpio.pi keyword args")
+    parser.add_argument('-c', '--calibration', default=Calibration.PATH,
+                        help="Servo calibration file, used if it exists")
+    parser.add_argument('-o', '--output', default='sweep.json',
+                        help="Report file")
+    parser.add_argument('--compare', help="Earlier report to compare against")
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help="Regression threshold as a fraction")
+    args = parser.parse_args()
+
+    cal = Calibration.load(args.calibration) \
+          if os.path.exists(args.calibration) else None
+    io = SimPigpio.pi(**args.sim) if args.sim is not None else None
+    arm = MeArm(io=io, calibration=cal, **armDef)
+    if args.full:
+        for j in arm.joints:
+            arm.setLimit(j, 0, 180)
+
+    results = {'env': environment(arm, 'sim' if io else 'pigpio'),
+               'settings': {'step': args.step, 'rate': args.rate,
+                            'passes': args.passes, 'settle': args.settle,
+                            'full': args.full, 'sim': args.sim,
+                            'calibration': cal is not None},
+               'results': []}
+    try:
+        for name in args.joint or [j.name for j in arm.joints]:
+            r = sweep(arm, getattr(arm, name), step=args.step,
+                      rate=args.rate, passes=args.passes, settle=args.settle)
+            report(r)
+            results['results'].append(r)
+        arm.homeAll()
+    finally:
+        arm.close()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print "Report written to", args.output
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.threshold):
+                sys.exit(1)
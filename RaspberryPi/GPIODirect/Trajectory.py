@@ -0,0 +1,221 @@
+# *-* coding: utf-8 *-*
+"""
+Time parameterized joint trajectories for the MeArm.
+
+A Move describes a smooth, synchronized motion of any number of joints from a
+start pose to a target pose. All joints follow the same normalized velocity
+profile scaled to their own distance, so they all start and arrive at the same
+time. The move duration is the shortest time in which no joint exceeds the
+velocity and acceleration limits.
+
+Setpoints are streamed to an arm backend through a sink at a fixed rate. Sinks
+are provided for both the GPIODirect MeArm and the I²C MeArmI2C interfaces:
+
+    from MeArm import armDef, MeArm
+    from Trajectory import MeArmSink, smoothMove
+
+    arm = MeArm(**armDef)
+    smoothMove(MeArmSink(arm), {'base': 30, 'shoulder': 120}, vMax=60)
+
+This module does not depend on either backend so it is shared by the
+GPIODirect and I2C directories.
+"""
+
+import math
+import time
+
+from Clock import monotonic
+
+## Joint names in pose order
+JOINTS = ['base', 'shoulder', 'wrist', 'grip']
+
+class Trapezoid(object):
+    """
+    Normalized trapezoidal velocity profile.
+
+    Position s(tau) goes from 0 to 1 for normalized time tau from 0 to 1, with
+    constant acceleration for the first accel fraction of the time, constant
+    velocity, and then constant deceleration for the last accel fraction.
+    """
+
+    def __init__(self, accel=0.25):
+        """
+        @param accel: The fraction of the move time spent accelerating, and
+               again decelerating. Must be > 0 and <= 0.5.
+        """
+        assert 0 < accel <= 0.5, "Accel fraction must be > 0 and <= 0.5"
+        self.f = accel
+        # Peak normalized velocity and acceleration
+        self.vPeak = 1.0 / (1 - accel)
+        self.aPeak = 1.0 / (accel * (1 - accel))
+
+    def s(self, tau):
+        f = self.f
+        if tau <= 0:
+            return 0.0
+        if tau >= 1:
+            return 1.0
+        if tau < f:
+            return 0.5 * self.aPeak * tau * tau
+        if tau <= 1 - f:
+            return (tau - f/2.0) * self.vPeak
+        return 1.0 - 0.5 * self.aPeak * (1 - tau)**2
+
+class SCurve(object):
+    """
+    Normalized minimum jerk (quintic) S-curve profile.
+
+    Velocity and acceleration are zero at both ends of the move, so there are
+    no steps in acceleration at all.
+    """
+
+    # Peak normalized velocity and acceleration of the quintic
+    vPeak = 1.875
+    aPeak = 10 / math.sqrt(3)
+
+    def s(self, tau):
+        if tau <= 0:
+            return 0.0
+        if tau >= 1:
+            return 1.0
+        return tau**3 * (10 - 15*tau + 6*tau*tau)
+
+## The available profiles by name
+PROFILES = {'trapezoid': Trapezoid, 'scurve': SCurve}
+
+class Move(object):
+    """
+    A synchronized move of one or more joints.
+    """
+
+    def __init__(self, start, target, vMax=90.0, aMax=360.0,
+                 profile='trapezoid', duration=None):
+        """
+        Instance initialization.
+
+        @param start: The start pose as a dictionary of angle per joint name.
+               A joint without a start angle, or with None like for a servo
+               that is off, has no known position to move from, so it starts
+               at its target and is sent straight there.
+        @param target: The target pose as a dictionary of angle per joint name.
+               Only joints in target move.
+        @param vMax: Maximum joint velocity in °/s.
+        @param aMax: Maximum joint acceleration in °/s².
+        @param profile: 'trapezoid', 'scurve' or a profile instance.
+        @param duration: Optional minimum duration in seconds. The move will
+               take longer than this if needed to stay within vMax and aMax.
+        """
+        if not isinstance(profile, (Trapezoid, SCurve)):
+            if profile not in PROFILES:
+                raise ValueError("Invalid profile: {}. Should be one of {}"\
+                                 .format(profile, ", ".join(PROFILES)))
+            profile = PROFILES[profile]()
+        self.profile = profile
+        self.start = dict((j, target[j] if start.get(j) is None else start[j])
+                          for j in target)
+        self.target = dict(target)
+
+        # The slowest joint determines the duration for all joints
+        t = duration or 0.0
+        for j in self.target:
+            d = abs(self.target[j] - self.start[j])
+            t = max(t, d * profile.vPeak / vMax,
+                    math.sqrt(d * profile.aPeak / aMax))
+        self.duration = t
+
+    def sample(self, t):
+        """
+        Returns the pose at time t seconds from the start of the move.
+
+        @param t: Time from start. Times past the duration return the target.
+        @return: A dictionary of angle per joint name.
+        """
+        if self.duration <= 0 or t >= self.duration:
+            return dict(self.target)
+        s = self.profile.s(t / self.duration)
+        return dict((j, self.start[j] + (self.target[j]-self.start[j])*s)
+                    for j in self.target)
+
+    def setpoints(self, rate):
+        """
+        Generates the setpoints for the move at a fixed rate.
+
+        @param rate: Setpoints per second.
+        @return: Generator of (t, pose) tuples, ending with the target pose.
+        """
+        n = int(math.ceil(self.duration * rate))
+        for k in range(n + 1):
+            t = float(k) / rate
+            yield t, self.sample(t)
+
+class MeArmSink(object):
+    """
+    Setpoint sink for the GPIODirect MeArm. Each setpoint is sent as a single
+    setPose() call.
+    """
+
+    def __init__(self, arm):
+        self.arm = arm
+
+    def read(self):
+        return self.arm.getPose()
+
+    def write(self, pose):
+        self.arm.setPose(**pose)
+
+class MeArmI2CSink(object):
+    """
+    Setpoint sink for the MeArmI2C interface, or a BusWorker wrapping it. The
+    I²C registers only accept whole degrees, so setpoints are rounded.
+    """
+
+    def __init__(self, arm):
+        self.arm = arm
+        # A BusWorker keeps the MeArmI2C instance with the registers in .arm
+        iface = getattr(arm, 'arm', arm)
+        self.regs = dict((j, getattr(iface, 'Reg'+j.capitalize()))
+                         for j in JOINTS)
+
+    def read(self):
+        return dict((j, self.arm.jointState(r)['pos'])
+                    for j, r in self.regs.items())
+
+    def write(self, pose):
+        for j, pos in pose.items():
+            self.arm.joint(self.regs[j], int(round(pos)))
+
+def run(sink, move, rate=50):
+    """
+    Streams the setpoints for a move to a sink at a fixed rate.
+
+    Setpoint deadlines are calculated from the start time, so a late setpoint
+    does not delay those that follow.
+
+    @param sink: The setpoint sink.
+    @param move: The Move to run.
+    @param rate: Setpoints per second.
+    """
+    t0 = monotonic()
+    for t, pose in move.setpoints(rate):
+        delay = t0 + t - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sink.write(pose)
+
+def smoothMove(sink, target, vMax=90.0, aMax=360.0, profile='trapezoid',
+               duration=None, rate=50):
+    """
+    Moves the arm smoothly from its current pose to a target pose.
+
+    @param sink: The setpoint sink for the arm backend.
+    @param target: The target pose as a dictionary of angle per joint name.
+    @param vMax: Maximum joint velocity in °/s.
+    @param aMax: Maximum joint acceleration in °/s².
+    @param profile: 'trapezoid' or 'scurve'.
+    @param duration: Optional minimum move duration in seconds.
+    @param rate: Setpoints per second.
+    @return: The Move that was run.
+    """
+    move = Move(sink.read(), target, vMax, aMax, profile, duration)
+    run(sink, move, rate)
+    return move
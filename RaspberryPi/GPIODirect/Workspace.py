@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# *-* coding: utf-8 *-*
+"""
+Precomputed MeArm workspace lookup table.
+
+The joint space for the base, shoulder and wrist joints is discretized in fixed
+angle steps, and the gripper position for every grid point is calculated once
+with forward kinematics. Cartesian space is divided into cubic voxels, and
+every voxel holds the index of a grid point inside the joint limits whose
+gripper position falls in that voxel, or -1 if there is none. Reachability of
+a position is then one index calculation and one array lookup, and the grid
+point gives the joint angles to seed a solver with.
+
+The joint grid covers the full 0-180° servo range, while only grid points
+within the current joint limits are used for the voxel table. This allows the
+voxel table to be updated incrementally when a joint limit changes, by only
+considering the joint grid slices that moved in or out of the limits.
+
+The table is stored in a directory as NumPy .npy files and memory mapped on
+loading:
+
+    fk.npy     - float32 (N, 3) gripper position per joint grid point
+    voxel.npy  - int32 (N,) voxel index per joint grid point
+    seeds.npy  - int32 (V,) joint grid point index per voxel, or -1
+    meta.json  - grid parameters and the limits the seeds are valid for
+
+To build the table for the default armDef limits:
+
+    python Workspace.py [-s step] [-v voxel size] [directory]
+"""
+
+import os
+import json
+
+import Kinematics
+from Kinematics import np
+
+## Default joint grid step in degrees
+STEP = 2.0
+## Default voxel edge length in mm
+VOXEL = 10.0
+## Default table directory
+PATH = 'workspace'
+
+class Workspace(object):
+    """
+    Memory mapped workspace lookup table.
+    """
+
+    def __init__(self, path, meta, fk, voxel, seeds):
+        """
+        Use build() or load() to get an instance.
+        """
+        self.path = path
+        self.meta = meta
+        self.fk = fk
+        self.voxel = voxel
+        self.seeds = seeds
+        self.step = meta['step']
+        self.size = meta['voxel']
+        self.origin = np.array(meta['origin'])
+        self.shape = tuple(meta['shape'])
+        self.n = meta['n']
+
+    @classmethod
+    def build(cls, path, limits, step=STEP, voxel=VOXEL,
+              geom=Kinematics.MEARM):
+        """
+        Builds a new table and writes it to path.
+
+        @param path: The table directory. It is created if needed.
+        @param limits: Dictionary of (min, max) tuples per joint name, as
+               returned by MeArm.limits().
+        @param step: Joint grid step in degrees.
+        @param voxel: Voxel edge length in mm.
+        @param geom: The arm Geometry.
+        @return: A Workspace instance for the new table.
+        """
+        Kinematics._needNumpy()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        n = int(round(180 / step)) + 1
+        a = np.arange(n) * step
+        grid = np.array(np.meshgrid(a, a, a, indexing='ij')).reshape(3, -1).T
+        fk = Kinematics.forwardMany(grid, geom).astype(np.float32)
+
+        origin = fk.min(axis=0) - voxel/2.0
+        shape = (np.ceil((fk.max(axis=0) - origin) / voxel) + 1).astype(int)
+        iv = np.floor((fk - origin) / voxel).astype(np.int32)
+        vox = np.ravel_multi_index(iv.T, shape).astype(np.int32)
+
+        np.save(os.path.join(path, 'fk.npy'), fk)
+        np.save(os.path.join(path, 'voxel.npy'), vox)
+        np.save(os.path.join(path, 'seeds.npy'),
+                np.full(int(np.prod(shape)), -1, dtype=np.int32))
+        # No limits yet, so the seeds are filled by the update below
+        meta = {'step': step, 'voxel': voxel, 'n': n,
+                'origin': origin.tolist(), 'shape': shape.tolist(),
+                'limits': dict((j, [0, -1]) for j in Kinematics.JOINTS)}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        ws = cls.load(path)
+        ws.updateLimits(limits)
+        return ws
+
+    @classmethod
+    def load(cls, path=PATH):
+        """
+        Memory maps an existing table.
+
+        @param path: The table directory.
+        @return: A Workspace instance.
+        """
+        Kinematics._needNumpy()
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        fk = np.load(os.path.join(path, 'fk.npy'), mmap_mode='r')
+        voxel = np.load(os.path.join(path, 'voxel.npy'), mmap_mode='r')
+        # Seeds are updated in place when limits change
+        seeds = np.load(os.path.join(path, 'seeds.npy'), mmap_mode='r+')
+        return cls(path, meta, fk, voxel, seeds)
+
+    def _inLimits(self, limits):
+        """
+        Returns a boolean mask over the joint grid for the points within
+        limits.
+        """
+        a = np.arange(self.n) * self.step
+        masks = []
+        for j in Kinematics.JOINTS:
+            lo, hi = limits[j]
+            masks.append((a >= lo) & (a <= hi))
+        return (masks[0][:, None, None] & masks[1][None, :, None] &
+                masks[2][None, None, :]).ravel()
+
+    def updateLimits(self, limits):
+        """
+        Updates the voxel seeds for new joint limits.
+
+        Only joint grid points that moved into or out of the limits are
+        processed: voxels seeded from a point now outside the limits are
+        refilled from the remaining points in that voxel, and points that are
+        now inside the limits seed any empty voxels they fall in.
+
+        @param limits: Dictionary of (min, max) tuples per joint name. Joints
+               other than those in Kinematics.JOINTS are ignored.
+        @return: The number of joint grid points that changed state.
+        """
+        old = self._inLimits(self.meta['limits'])
+        new = self._inLimits(limits)
+        removed = old & ~new
+        added = new & ~old
+
+        if removed.any():
+            # Voxels seeded from removed points lose their seed...
+            seeded = self.seeds >= 0
+            lost = np.zeros(len(self.seeds), dtype=bool)
+            lost[seeded] = removed[self.seeds[seeded]]
+            self.seeds[lost] = -1
+            # ...and get a new one from any other point within the limits
+            idx = np.nonzero(new & lost[self.voxel])[0]
+            self.seeds[self.voxel[idx]] = idx
+        if added.any():
+            idx = np.nonzero(added)[0]
+            idx = idx[self.seeds[self.voxel[idx]] < 0]
+            self.seeds[self.voxel[idx]] = idx
+        self.seeds.flush()
+
+        self.meta['limits'] = dict((j, list(limits[j]))
+                                   for j in Kinematics.JOINTS)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+        return int(removed.sum() + added.sum())
+
+    def voxelIndex(self, x, y, z):
+        """
+        @return: The voxel index for a position, or -1 if it is outside the
+                 table.
+        """
+        i = [int((c - o) // self.size) for c, o in zip((x, y, z), self.origin)]
+        for c, s in zip(i, self.shape):
+            if not 0 <= c < s:
+                return -1
+        return (i[0]*self.shape[1] + i[1])*self.shape[2] + i[2]
+
+    def seed(self, x, y, z):
+        """
+        Returns the joint angles for a grid point within the joint limits that
+        reaches the voxel for a position.
+
+        @return: (base, shoulder, wrist) tuple of angles, or None if the
+                 position is not reachable within the joint limits.
+        """
+        v = self.voxelIndex(x, y, z)
+        if v < 0:
+            return None
+        i = int(self.seeds[v])
+        if i < 0:
+            return None
+        n = self.n
+        return ((i // (n*n)) * self.step, ((i // n) % n) * self.step,
+                (i % n) * self.step)
+
+    def reachable(self, x, y, z):
+        """
+        @return: True if the voxel for the position is reachable within the
+                 joint limits.
+        """
+        v = self.voxelIndex(x, y, z)
+        return v >= 0 and self.seeds[v] >= 0
+
+    def reachableMany(self, points):
+        """
+        @param points: N x 3 array like of (x, y, z) positions.
+        @return: Boolean array of reachability per point.
+        """
+        p = np.asarray(points, dtype=float).reshape(-1, 3)
+        iv = np.floor((p - self.origin) / self.size).astype(int)
+        inside = np.all((iv >= 0) & (iv < np.array(self.shape)), axis=1)
+        res = np.zeros(len(p), dtype=bool)
+        v = np.ravel_multi_index(iv[inside].T, self.shape)
+        res[inside] = self.seeds[v] >= 0
+        return res
+
+
+if __name__ == "__main__":
+    import argparse
+    from MeArm import armDef
+
+    parser = argparse.ArgumentParser(description="Build the MeArm workspace "
+                                     "lookup table for the armDef limits.")
+    parser.add_argument('-s', '--step', type=float, default=STEP,
+                        help="Joint grid step in degrees")
+    parser.add_argument('-v', '--voxel', type=float, default=VOXEL,
+                        help="Voxel edge length in mm")
+    parser.add_argument('path', nargs='?', default=PATH,
+                        help="Table directory")
+    args = parser.parse_args()
+
+    limits = dict((j, (d['min'], d['max'])) for j, d in armDef.items())
+    ws = Workspace.build(args.path, limits, args.step, args.voxel)
+    print "Built {} joint grid points, {} of {} voxels reachable, in {}"\
+          .format(len(ws.fk), int((ws.seeds >= 0).sum()), len(ws.seeds),
+                  args.path)
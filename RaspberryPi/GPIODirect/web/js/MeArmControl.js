@@ -46,6 +46,12 @@ MeArm.Access = {
         // Update arm control stuff
         MeArm.Arm.refreshAllJoints();
         MeArm.Arm.updateLimitEditors();
+        // Only stream positions while we have the stick
+        if(this.stickHolder == "me") {
+            MeArm.Arm.openSocket();
+        } else {
+            MeArm.Arm.closeSocket();
+        }
 
     },
 
@@ -110,6 +116,82 @@ MeArm.Arm = {
 
     queue: 0,
 
+    // The position streaming WebSocket, or null if not connected, in which
+    // case positions are sent with PUT requests.
+    socket: null,
+    // Frame sequence number
+    seq: 0,
+    // Number of frames sent but not acked yet
+    inFlight: 0,
+    // Max frames in flight before new positions are held back
+    maxInFlight: 4,
+    // Held back positions per joint. Only the latest position is kept.
+    held: {},
+
+    // Joint initials as used in stream frames
+    jointInitial: {base: "b", shoulder: "s", wrist: "w", grip: "g"},
+
+    openSocket: function() {
+        if(this.socket !== null || !("WebSocket" in window)) {
+            return;
+        }
+        var me = this,
+            proto = window.location.protocol == "https:" ? "wss://" : "ws://",
+            ws = new WebSocket(proto + window.location.host + this.apiBase +
+                               "stream");
+        ws.onopen = function() {
+            me.socket = ws;
+            me.inFlight = 0;
+            me.held = {};
+        };
+        ws.onmessage = function(event) {
+            me.streamAck(event.data);
+        };
+        // On error or close we fall back to PUTs
+        ws.onclose = function() {
+            if(me.socket === ws) {
+                me.socket = null;
+            }
+        };
+    },
+
+    closeSocket: function() {
+        if(this.socket !== null) {
+            this.socket.close();
+            this.socket = null;
+        }
+    },
+
+    streamAck: function(data) {
+        // Acks are "<seq> <pos>" or "<seq> ! <error message>"
+        var f = data.split(" ");
+        this.inFlight = Math.max(0, this.inFlight-1);
+        if(f[1] === "!") {
+            console.log("Stream frame " + f[0] + " failed: ",
+                        f.slice(2).join(" "));
+        }
+        // Send the latest held back positions
+        for(var joint in this.held) {
+            if(this.inFlight >= this.maxInFlight) {
+                break;
+            }
+            var pos = this.held[joint];
+            delete this.held[joint];
+            this.streamJoint(joint, pos);
+        }
+    },
+
+    streamJoint: function(joint, pos) {
+        if(this.inFlight >= this.maxInFlight) {
+            // Too many unacked frames; hold back the latest position only
+            this.held[joint] = pos;
+            return;
+        }
+        this.seq += 1;
+        this.inFlight += 1;
+        this.socket.send(this.seq + " " + this.jointInitial[joint] + " " + pos);
+    },
+
     updateJointCallBack: function(jqXHR, status) {
         var q = $("form fieldset.arm div.q");
         this.queue -= 1;
@@ -124,6 +206,11 @@ MeArm.Arm = {
     },
     
     updateJoint: function(joint, pos) {
+        // Stream the position if we have a socket
+        if(this.socket !== null) {
+            this.streamJoint(joint, pos);
+            return;
+        }
         // Only allow one request to the server at a time
         if(this.queue>0) {
             return;
@@ -0,0 +1 @@
+../GPIODirect/Admission.py
\ No newline at end of file
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+##
+# Single bus owner thread for the MeArm I²C interface.
+##
+
+import threading
+
+class Future(object):
+    """
+    The result of a command executed by the BusWorker thread.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc = None
+
+    def setResult(self, result):
+        self._result = result
+        self._done.set()
+
+    def setException(self, exc):
+        self._exc = exc
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for and returns the command result.
+
+        @param timeout: Max time in seconds to wait for the result, or None to
+               wait forever.
+        @return: The command result.
+        @raises: The exception raised by the command, if any, or IOError if the
+                 result was not available within timeout.
+        """
+        if not self._done.wait(timeout):
+            raise IOError({"code": "eTimeout",
+                           "err": "No response from bus worker in {}s"\
+                                  .format(timeout)})
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+
+class BusWorker(threading.Thread):
+    """
+    Thread that owns the MeArmI2C instance and performs all bus transactions.
+
+    Other threads submit commands to the worker and get a Future for the result.
+    Joint position writes are coalesced per joint: if a new position for a
+    joint arrives while an earlier one is still waiting to be sent, only the
+    newest position is sent, and all futures waiting on that joint get the
+    result of the newest position.
+
+    Pending position writes are always sent before the next queued command so
+    that a read submitted after a position write sees the new position.
+
+    joint() does not wait for a position write to be sent, so request threads
+    never block on the bus for position writes. A failed write is recorded per
+    joint instead, and reported by writeError() and jointState() until the next
+    successful write to that joint.
+
+    The joint, jointLimit and jointState methods mirror the MeArmI2C methods
+    of the same name, so an instance can be used in place of the arm interface.
+    """
+
+    # Default time in seconds to wait for a command result
+    Timeout = 5.0
+
+    def __init__(self, arm, timeout=Timeout):
+        """
+        Instance initialization.
+
+        @param arm: The MeArmI2C instance to own.
+        @param timeout: Default time in seconds to wait for command results.
+        """
+        super(BusWorker, self).__init__(name="MeArmI2CBus")
+        self.daemon = True
+        self.arm = arm
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        # Queued (future, callable, args, kwargs) commands
+        self._queue = []
+        # Pending position writes as {register: [pos, [futures]]}
+        self._positions = {}
+        self._stopping = False
+        # Number of position writes that were superseded before being sent
+        self.coalesced = 0
+        # The error info of the last failed position write per joint register
+        self._errors = {}
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues a call to be made on the bus thread.
+
+        @param fn: The callable, normally a bound method of the arm instance.
+        @return: A Future for the call result.
+        """
+        f = Future()
+        with self._cond:
+            self._queue.append((f, fn, args, kwargs))
+            self._cond.notify()
+        return f
+
+    def setPosition(self, reg, pos):
+        """
+        Queues a joint position write, replacing any position for the joint that
+        has not been sent yet.
+
+        @param reg: The joint register.
+        @param pos: The position to set.
+        @return: A Future for the position that is eventually set.
+        """
+        f = Future()
+        with self._cond:
+            if reg in self._positions:
+                self._positions[reg][0] = pos
+                self._positions[reg][1].append(f)
+                self.coalesced += 1
+            else:
+                self._positions[reg] = [pos, [f]]
+            self._cond.notify()
+        return f
+
+    def _sendPositions(self, positions):
+        """
+        Sends coalesced position writes as one pipelined batch.
+
+        The batch is verified per write (see MeArmI2C.flush()), so only the
+        futures for the writes that were not applied get the error. If the
+        batch could not be verified at all, all of them get it.
+        """
+        failed = None
+        try:
+            with self.arm.pipeline():
+                for reg, (pos, futures) in positions.items():
+                    self.arm.joint(reg, pos)
+        except Exception, e:
+            info = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+            failed = set(c['reg'] for c in info.get('failed', [])) or \
+                     set(positions)
+        for reg, (pos, futures) in positions.items():
+            if failed is not None and reg in failed:
+                self._errors[reg] = info or {"err": str(e)}
+                for f in futures:
+                    f.setException(e)
+            else:
+                self._errors.pop(reg, None)
+                for f in futures:
+                    f.setResult(pos)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not (self._queue or self._positions or self._stopping):
+                    self._cond.wait()
+                if self._stopping and not (self._queue or self._positions):
+                    return
+                positions, self._positions = self._positions, {}
+                cmd = self._queue.pop(0) if self._queue else None
+
+            if positions:
+                self._sendPositions(positions)
+            if cmd is not None:
+                f, fn, args, kwargs = cmd
+                try:
+                    f.setResult(fn(*args, **kwargs))
+                except Exception, e:
+                    f.setException(e)
+
+    def stop(self):
+        """
+        Stops the worker after all outstanding commands have been handled.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def writeError(self, name):
+        """
+        Returns the error of the last position write for a joint.
+
+        @param name: The joint register.
+        @return: The error info dictionary, or None if the last write was
+                 applied.
+        """
+        return self._errors.get(name)
+
+    def joint(self, name, pos=None, fresh=False):
+        """
+        Gets or sets the position for a joint via the bus thread.
+
+        A position is only queued, and this returns without waiting for it to
+        be sent. Use writeError() or jointState() to find out if it failed, or
+        setPosition() to wait for the result.
+
+        See MeArmI2C.joint()
+        """
+        if pos is None:
+            return self.submit(self.arm.joint, name, None, fresh)\
+                       .result(self.timeout)
+        self.setPosition(name, pos)
+        return pos
+
+    def jointLimit(self, name, limInd, lim=None, fresh=False):
+        """
+        Gets or sets a joint position limit via the bus thread.
+
+        See MeArmI2C.jointLimit()
+        """
+        f = self.submit(self.arm.jointLimit, name, limInd, lim, fresh)
+        return f.result(self.timeout)
+
+    def jointState(self, name, fresh=False):
+        """
+        Returns the position and limits for a single joint via the bus thread.
+
+        If the last position write for the joint failed, its error info is
+        added under the 'error' key.
+
+        See MeArmI2C.jointState()
+        """
+        state = self.submit(self.arm.jointState, name, fresh)\
+                    .result(self.timeout)
+        err = self._errors.get(name)
+        if err is not None:
+            state = dict(state, error=err)
+        return state
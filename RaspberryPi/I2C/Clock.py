@@ -0,0 +1 @@
+../GPIODirect/Clock.py
\ No newline at end of file
@@ -0,0 +1 @@
+../GPIODirect/ControlLoop.py
\ No newline at end of file
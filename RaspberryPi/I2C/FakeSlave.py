@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+##
+# A fake MeArm I²C slave for testing the MeArmI2C interface without hardware.
+##
+
+from MeArmControl import MeArmI2C
+
+class FakeMeArmSlave(object):
+    """
+    Emulates the MeArm I²C slave behind the subset of the smbus.SMBus interface
+    used by MeArmI2C.
+
+    Pass an instance as the bus argument when instantiating MeArmI2C:
+
+        arm = MeArmI2C(42, bus=FakeMeArmSlave(42))
+
+    Every command sets the error register to the result of that command, the
+    same as the slave does. Reading the error register does not change it.
+    Setting a limit that excludes the current position moves the joint to the
+    new limit, also the same as the slave does.
+    """
+
+    # Error bits, from MeArmI2C.OpErrors
+    eDLen = 1<<0
+    eNoReg = 1<<1
+    ePLimit = 1<<2
+    eSVLimit = 1<<3
+    eSVRange = 1<<4
+    eInvSubVal = 1<<5
+
+    def __init__(self, addr, home=90, lMin=0, lMax=180):
+        """
+        Instance initialization.
+
+        @param addr: The I²C address this slave answers on.
+        @param home: The initial position for all joints.
+        @param lMin: The initial min limit for all joints.
+        @param lMax: The initial max limit for all joints.
+        """
+        self.addr = addr
+        self.joints = dict((r, {'pos': home, 'min': lMin, 'max': lMax})
+                           for r in MeArmI2C.Joints)
+        self.err = 0
+        # The register and optional sub-value to return on the next read
+        self.reg = None
+        self.subInd = None
+        # Number of bus transactions seen. Useful for asserting how much bus
+        # traffic an operation generates.
+        self.transactions = 0
+
+    def _checkAddr(self, addr):
+        self.transactions += 1
+        if addr != self.addr:
+            # This is what smbus raises when no slave ACKs the address
+            raise IOError(121, "Remote I/O error")
+
+    def _value(self):
+        """
+        Returns the value for the current register pointer.
+        """
+        if self.reg == MeArmI2C.RegErr:
+            return self.err
+        if self.reg not in self.joints:
+            self.err = self.eNoReg
+            return 0
+        j = self.joints[self.reg]
+        if self.subInd is None:
+            self.err = 0
+            return j['pos']
+        if self.subInd == MeArmI2C.RegSubMin:
+            self.err = 0
+            return j['min']
+        if self.subInd == MeArmI2C.RegSubMax:
+            self.err = 0
+            return j['max']
+        self.err = self.eInvSubVal
+        return 0
+
+    def write_byte(self, addr, reg):
+        self._checkAddr(addr)
+        self.reg, self.subInd = reg, None
+
+    def write_byte_data(self, addr, reg, val):
+        self._checkAddr(addr)
+        # A sub-value indicator means the next read is for the sub value,
+        # otherwise this is a position set.
+        if val in (MeArmI2C.RegSubMin, MeArmI2C.RegSubMax):
+            self.reg, self.subInd = reg, val
+            return
+        self.reg, self.subInd = None, None
+        if reg not in self.joints:
+            self.err = self.eNoReg
+            return
+        j = self.joints[reg]
+        if not (j['min'] <= val <= j['max']):
+            self.err = self.ePLimit
+            return
+        j['pos'] = val
+        self.err = 0
+
+    def write_i2c_block_data(self, addr, reg, vals):
+        self._checkAddr(addr)
+        self.reg, self.subInd = None, None
+        if reg not in self.joints:
+            self.err = self.eNoReg
+            return
+        if len(vals) != 2:
+            self.err = self.eDLen
+            return
+        subInd, val = vals
+        if subInd not in (MeArmI2C.RegSubMin, MeArmI2C.RegSubMax):
+            self.err = self.eInvSubVal
+            return
+        if not (0 <= val <= 180):
+            self.err = self.eSVRange
+            return
+        j = self.joints[reg]
+        if (subInd == MeArmI2C.RegSubMin and val > j['max']) or \
+           (subInd == MeArmI2C.RegSubMax and val < j['min']):
+            self.err = self.eSVLimit
+            return
+        j['min' if subInd == MeArmI2C.RegSubMin else 'max'] = val
+        j['pos'] = min(max(j['pos'], j['min']), j['max'])
+        self.err = 0
+
+    def read_byte(self, addr):
+        self._checkAddr(addr)
+        return self._value()
+
+    def read_i2c_block_data(self, addr, reg, length):
+        self._checkAddr(addr)
+        if reg != MeArmI2C.RegState:
+            self.reg, self.subInd = reg, None
+            return [self._value()] * length
+        if length != MeArmI2C.StateLen:
+            self.err = self.eDLen
+            return [0]*(length-1) + [self.err]
+        self.err = 0
+        block = []
+        for r in MeArmI2C.Joints:
+            block.extend(self.joints[r][f] for f in MeArmI2C.StateFields)
+        block.append(self.err)
+        return block
+
+    def close(self):
+        pass
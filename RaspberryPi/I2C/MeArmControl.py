@@ -5,8 +5,26 @@
 # Control interface and API for MeArm-over-I²C controller.
 ##
 
-import smbus
 import time
+from contextlib import contextmanager
+try:
+    import smbus
+except ImportError:
+    # Allows using the class with an alternative bus (see FakeSlave.py) on
+    # hosts without the smbus module.
+    smbus = None
+
+from Metrics import REGISTRY, timed, describe
+
+describe('mearm_i2c_call_seconds', "Time taken by MeArmI2C register calls, "
+         "including settle delays and polling.")
+describe('mearm_i2c_call_errors_total', "MeArmI2C register calls that "
+         "raised an error.")
+describe('mearm_i2c_settle_seconds_total', "Total time spent in settle delays.")
+describe('mearm_i2c_poll_retries_total', "Reads retried because the slave "
+         "was busy.")
+_settleTotal = REGISTRY.counter('mearm_i2c_settle_seconds_total')
+_pollRetries = REGISTRY.counter('mearm_i2c_poll_retries_total')
 
 class MeArmI2C:
     """
@@ -20,11 +38,24 @@ class MeArmI2C:
     RegShoulder = ord('s')
     RegWrist    = ord('w')
     RegGrip     = ord('g')
+    RegState    = ord('a')
+
+    # The joint registers in the order they appear in the RegState block
+    Joints = [RegBase, RegShoulder, RegWrist, RegGrip]
+    # The values per joint in the RegState block, in block order
+    StateFields = ['pos', 'min', 'max']
+    # Total RegState block length: all joint fields followed by the error
+    # register value for the block read itself.
+    StateLen = len(Joints) * len(StateFields) + 1
 
     # Register Sub-value indicator
     RegSubMin = 0b11000001
     RegSubMax = 0b11000010
 
+    # The sub-value indicator for each joint state field. The position is the
+    # main register value and has no sub-value indicator.
+    FieldSubInd = {'pos': None, 'min': RegSubMin, 'max': RegSubMax}
+
 
     # Operation error values
     OpErrors = {
@@ -37,7 +68,20 @@ class MeArmI2C:
     };
 
 
-    def __init__(self, i2cAddr, devInf=1):
+    # Default settle delay in seconds when not learned from the slave
+    SettleDefault = 0.1
+    # Initial and maximum backoff in seconds when polling the slave for
+    # readiness, and how long to keep polling before giving up.
+    PollBackoff = 0.0005
+    PollBackoffMax = 0.01
+    PollTimeout = 0.5
+
+    # Default maximum number of unchecked writes in pipelined mode before they
+    # are verified.
+    MaxPending = 8
+
+    def __init__(self, i2cAddr, devInf=1, bus=None, settle=SettleDefault,
+                 pipelined=False, maxPending=MaxPending, cacheTTL=None):
         """
         Instance intialization.
         
@@ -45,10 +89,52 @@ class MeArmI2C:
         @param devInf: I²C device interface. On revision 1 boards this is bus 1,
                     and on pre revision 1 boards this is bus 0 (what is revision
                     1 board??)
+        @param bus: An already opened SMBus compatible instance to use instead
+                    of opening devInf. Mainly useful for testing against a fake
+                    slave (see FakeSlave.py).
+        @param settle: The settle delay in seconds between a write and the
+                    following read, or the string 'auto' to learn the minimum
+                    safe delay from the slave on startup. See calibrateSettle()
+        @param pipelined: If True, joint writes are not each followed by an
+                    error register check, but verified in batches. See flush()
+                    for details.
+        @param maxPending: In pipelined mode, the maximum number of writes
+                    issued before they are verified.
+        @param cacheTTL: The time in seconds a cached register value stays
+                    valid. None means cached values never expire, and 0
+                    effectively disables the cache. See invalidate().
         """
         self.i2cAddr = i2cAddr
         # Buss instance
-        self.bus = smbus.SMBus(1)
+        if bus is None:
+            if smbus is None:
+                raise ImportError("The smbus module is required to open I²C "\
+                                  "bus {}".format(devInf))
+            bus = smbus.SMBus(devInf)
+        self.bus = bus
+
+        # Pipelined write state. The pending list contains a description of
+        # each write issued since the error register was last checked.
+        self.pipelined = pipelined
+        self.maxPending = maxPending
+        self._pending = []
+
+        # The write-through register cache. Keys are (register, sub-value
+        # indicator) tuples, with a sub-value indicator of None for the main
+        # register value. Values are (value, time stamp) tuples.
+        self.cacheTTL = cacheTTL
+        self._cache = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+        # The settle delay in use, and the value learned by calibrateSettle()
+        # if it was ever called.
+        self.settleTime = self.SettleDefault
+        self.settleLearned = None
+        if settle == 'auto':
+            self.calibrateSettle()
+        else:
+            self.settleTime = float(settle)
 
     def _settleDelay(self):
         """
@@ -56,46 +142,327 @@ class MeArmI2C:
         settle before the next operation.
 
         By always using this method, the settle delay time can be adjusted in
-        one place for the complete system.
+        one place for the complete system. The delay is the settleTime
+        attribute which is either set on instantiation or learned from the slave
+        by calibrateSettle().
+        """
+        if self.settleTime > 0:
+            time.sleep(self.settleTime)
+            _settleTotal.inc(self.settleTime)
+
+    def _bus(self, fn, *args):
+        """
+        Runs a bus transaction, polling the slave for readiness.
+
+        While the slave is still busy handling the previous command it does not
+        ACK its address, which smbus reports as an IOError. This goes for
+        writes as well as reads. Instead of failing, we retry with an
+        exponential backoff from PollBackoff up to PollBackoffMax until
+        PollTimeout has passed. A NACKed transaction did not reach the slave,
+        so retrying it is safe.
+
+        @param fn: The SMBus method, like self.bus.read_byte.
+        @param args: The arguments for fn after the slave address.
+        @return: The fn result.
+        @raises: IOError if the slave is still not ready after PollTimeout.
         """
-        time.sleep(0.1)
+        backoff = self.PollBackoff
+        deadline = time.time() + self.PollTimeout
+        while True:
+            try:
+                return fn(self.i2cAddr, *args)
+            except IOError:
+                if time.time() + backoff > deadline:
+                    raise
+            _pollRetries.inc()
+            time.sleep(backoff)
+            backoff = min(backoff*2, self.PollBackoffMax)
+
+    def _readByte(self):
+        """
+        Reads a byte from the slave, polling it for readiness. See _bus()
+
+        @return: The byte read.
+        @raises: IOError if the slave is still not ready after PollTimeout.
+        """
+        return self._bus(self.bus.read_byte)
 
-    def getError(self):
+    def calibrateSettle(self, start=SettleDefault, minimum=0.0005, trials=5,
+                        margin=2.0):
+        """
+        Learns the minimum safe settle delay for the slave.
+
+        The expected joint positions are first read with a bulk state read
+        (which needs no settle delay). Then, starting at the start delay, the
+        delay is halved for as long as trials successive write and read
+        trials with that delay all succeed. A write trial writes a joint's
+        current position again, so nothing moves, and then checks the error
+        register. This measures how long the slave stays busy after a write,
+        which is longer than after a read. A read trial reads a joint position
+        and checks it against the expected value.
+
+        The trials use the bus directly without polling for readiness, so a
+        slave that is still busy fails the trial. The learned delay is the
+        smallest good delay times the safety margin, but never more than start.
+
+        The learned value is stored in both the settleTime and settleLearned
+        attributes.
+
+        @param start: The delay in seconds to start from. This is assumed to be
+               safe.
+        @param minimum: The smallest delay in seconds to try.
+        @param trials: The number of write and read trials that must succeed
+               for a delay to be considered safe.
+        @param margin: Safety factor to apply to the smallest good delay.
+
+        @return: The learned settle delay in seconds.
+        @raises: IOError if the slave can not be read at all.
+        """
+        expected = self.getState()
+        addr = self.i2cAddr
+        good = start
+        delay = start
+        while delay >= minimum:
+            self.settleTime = delay
+            try:
+                for n in range(trials):
+                    reg = self.Joints[n % len(self.Joints)]
+                    pos = expected[reg]['pos']
+                    # Write trial
+                    self.bus.write_byte_data(addr, reg, pos)
+                    self._settleDelay()
+                    self.bus.write_byte(addr, self.RegErr)
+                    self._settleDelay()
+                    if self.bus.read_byte(addr) != 0:
+                        break
+                    # Read trial
+                    self.bus.write_byte(addr, reg)
+                    self._settleDelay()
+                    if self.bus.read_byte(addr) != pos:
+                        break
+                else:
+                    # All trials passed
+                    good = delay
+                    delay /= 2.0
+                    continue
+            except IOError:
+                pass
+            # This delay was not safe, so we stop here
+            break
+
+        self.settleTime = self.settleLearned = min(good*margin, start)
+        return self.settleTime
+
+    @timed('mearm_i2c_call', call='getError')
+    def getError(self, cmd=None):
         """
         Reads the arm controller error register and raises an excpetion with
         appropriate message in case of an error condition.
+
+        @param cmd: Optional description of the command the error register
+               value is for. If supplied, it is added to the exception info
+               under the "cmd" key.
         """
         # Write the register address to the slave
-        self.bus.write_byte(self.i2cAddr, self.RegErr)
+        self._bus(self.bus.write_byte, self.RegErr)
         self._settleDelay()
         # Now read the bus for the value
-        val = self.bus.read_byte(self.i2cAddr)
+        val = self._readByte()
         if val:
             e = self.OpErrors[val]
-            raise IOError({"code": e["c"], "err": e["e"]})
+            err = {"code": e["c"], "err": e["e"]}
+            if cmd is not None:
+                err["cmd"] = cmd
+            raise IOError(err)
+
+    def _cacheGet(self, reg, subInd=None):
+        """
+        Returns the cached value for a register or sub-value, or None if it is
+        not cached or has expired. Updates the hit and miss counters.
+        """
+        ent = self._cache.get((reg, subInd))
+        if ent is not None and \
+           (self.cacheTTL is None or time.time() - ent[1] < self.cacheTTL):
+            self.cacheHits += 1
+            return ent[0]
+        self.cacheMisses += 1
+        return None
+
+    def _cachePut(self, reg, subInd, val):
+        """
+        Stores a value read from, or written to, the slave in the cache.
+        """
+        self._cache[(reg, subInd)] = (val, time.time())
+
+    def invalidate(self, reg=None, subInd=False):
+        """
+        Invalidates cached register values.
+
+        @param reg: The register to invalidate. If None, the complete cache is
+               invalidated.
+        @param subInd: The sub-value indicator to invalidate for the register.
+               Use None for the main register value. If not supplied, the main
+               value and all sub-values for the register are invalidated.
+        """
+        if reg is None:
+            self._cache.clear()
+        elif subInd is False:
+            for k in [k for k in self._cache if k[0] == reg]:
+                del self._cache[k]
+        else:
+            self._cache.pop((reg, subInd), None)
+
+    def cacheStats(self):
+        """
+        Returns the cache statistics.
+
+        @return: A dictionary with 'hits', 'misses', 'entries' and 'ttl' keys.
+        """
+        return {'hits': self.cacheHits, 'misses': self.cacheMisses,
+                'entries': len(self._cache), 'ttl': self.cacheTTL}
+
+    def _written(self, cmd):
+        """
+        Checks the result of a write, or defers the check in pipelined mode.
+
+        Values are only cached once the write is known to have been applied.
+        Deferred writes are verified, and the cache refreshed, by flush().
 
-    def getRegister(self, reg):
+        @param cmd: A description of the write, as a dictionary with 'reg',
+               'subInd' and 'val' keys.
+        """
+        if not self.pipelined or cmd['reg'] not in self.Joints:
+            # Only joint writes can be verified against the state block, so
+            # anything else is checked straight away.
+            self.getError(cmd)
+            self._cachePut(cmd['reg'], cmd['subInd'], cmd['val'])
+            return
+        self.invalidate(cmd['reg'], cmd['subInd'])
+        self._pending.append(cmd)
+        if len(self._pending) >= self.maxPending:
+            self.flush()
+
+    def flush(self):
+        """
+        Verifies all writes issued since the last check.
+
+        In pipelined mode, joint writes are issued back to back without
+        checking the error register after each one, and verified in one batch:
+        when maxPending writes are outstanding, before any read, at the end of
+        a pipeline() block, or when this method is called explicitly.
+
+        The slave overwrites the error register on every command, so it only
+        tells about the last write of a batch. Instead, the batch is verified
+        with one bulk state read (see getState()), by comparing the last value
+        written to each joint position and limit with the slave's state. A
+        write that was not applied shows up as a mismatch. A position written
+        before a limit on the same joint is not verified, since the slave may
+        have moved the joint to within the new limit.
+
+        The state read refreshes the cache with the slave's values, so values
+        of failed writes never end up in the cache.
+
+        @raises: IOError if any write was not applied, with the first failed
+                 write under the "cmd" key and all of them under the "failed"
+                 key of the exception info, or if the state can not be read.
+        """
+        if not self._pending:
+            return
+        # Taken off the list first, as getState() flushes too
+        pending, self._pending = self._pending, []
+        # The last write per joint value, in write order
+        last = {}
+        for i, cmd in enumerate(pending):
+            if cmd['subInd'] is not None:
+                last.pop((cmd['reg'], None), None)
+            last[(cmd['reg'], cmd['subInd'])] = (i, cmd)
+        try:
+            state = self.getState()
+        except IOError:
+            # We do not know which of the writes made it to the slave
+            for cmd in pending:
+                self.invalidate(cmd['reg'])
+            raise
+        fields = dict((v, k) for k, v in self.FieldSubInd.items())
+        failed = [cmd for i, cmd in sorted(last.values())
+                  if state[cmd['reg']][fields[cmd['subInd']]] != cmd['val']]
+        if failed:
+            raise IOError({"code": "eNotApplied",
+                           "err": "Write not applied by the slave",
+                           "cmd": failed[0], "failed": failed})
+
+    def _discard(self):
+        """
+        Drops the outstanding pipelined writes without verifying them. It is
+        not known which of them the slave applied, so their cache entries are
+        invalidated.
+        """
+        pending, self._pending = self._pending, []
+        for cmd in pending:
+            self.invalidate(cmd['reg'])
+
+    @contextmanager
+    def pipeline(self, maxPending=None):
+        """
+        Context manager to issue a batch of writes in pipelined mode:
+
+            with arm.pipeline():
+                for reg, pos in targets:
+                    arm.joint(reg, pos)
+
+        The writes are verified when the block exits, even if the instance is
+        not in pipelined mode otherwise. If the block raises, the outstanding
+        writes are dropped instead (see _discard()), so their errors can not
+        surface in a later, unrelated call.
+
+        @param maxPending: Optional maximum batch size for the block.
+        """
+        saved = self.pipelined, self.maxPending
+        self.pipelined = True
+        if maxPending is not None:
+            self.maxPending = maxPending
+        try:
+            yield self
+        except Exception:
+            self._discard()
+            raise
+        finally:
+            self.pipelined, self.maxPending = saved
+        self.flush()
+
+    @timed('mearm_i2c_call', call='getRegister')
+    def getRegister(self, reg, fresh=False):
         """
         Reads the given register content from the arm controller.
 
         @param reg: The register to read. Use the Reg* class attributes to
                     ensure the correct register value is specified.
+        @param fresh: If True, always read from the slave instead of returning
+                    a cached value.
 
         @return: the *single* register value read from the arm controller
 
         @raises: IOError and a message if an error occured reading the register.
         """
+        if not fresh:
+            val = self._cacheGet(reg)
+            if val is not None:
+                return val
+        # Verify outstanding pipelined writes before reading.
+        self.flush()
         # Write the register address to the slave
-        self.bus.write_byte(self.i2cAddr, reg)
+        self._bus(self.bus.write_byte, reg)
         self._settleDelay()
         # Now read the bus for  the value
-        val = self.bus.read_byte(self.i2cAddr)
+        val = self._readByte()
         # Check for error which will raise IOError if there is an error.
         self.getError()
+        self._cachePut(reg, None, val)
 
         return val
 
-    def getRegisterSubVal(self, reg, subInd):
+    @timed('mearm_i2c_call', call='getRegisterSubVal')
+    def getRegisterSubVal(self, reg, subInd, fresh=False):
         """
         Reads a sub value for the given register.
 
@@ -103,21 +470,31 @@ class MeArmI2C:
                ensure the correct register value is specified.
         @param subInd: The sub-value indicator. Use one of the RegSub* class
                attributes to ensure the correct indicator value.
+        @param fresh: If True, always read from the slave instead of returning
+               a cached value.
 
         @return: The requested sub value read from the arm controller
 
         @raises: IOError and a message if an error occured reading the register.
         """
+        if not fresh:
+            val = self._cacheGet(reg, subInd)
+            if val is not None:
+                return val
+        # Verify outstanding pipelined writes before reading.
+        self.flush()
         # Write the register address and sub value indicator to the slave
-        self.bus.write_byte_data(self.i2cAddr, reg, subInd)
+        self._bus(self.bus.write_byte_data, reg, subInd)
         self._settleDelay()
         # Now read the bus for  the value
-        val = self.bus.read_byte(self.i2cAddr)
+        val = self._readByte()
         # Check for error which will raise IOError if there is an error.
         self.getError()
+        self._cachePut(reg, subInd, val)
 
         return val
 
+    @timed('mearm_i2c_call', call='setRegister')
     def setRegister(self, reg, val):
         """
         Sets the given register value on the arm controller.
@@ -127,13 +504,15 @@ class MeArmI2C:
         @param val: The value to set the register to.
 
         @raises: IOError and a message if an error occured reading the register.
+                 In pipelined mode the error is raised by a later flush().
         """
         # Set the register
-        self.bus.write_byte_data(self.i2cAddr, reg, val);
+        self._bus(self.bus.write_byte_data, reg, val)
         self._settleDelay()
-        # Check for error
-        self.getError()
+        # Check for error, or defer the check when pipelined
+        self._written({'reg': reg, 'subInd': None, 'val': val})
 
+    @timed('mearm_i2c_call', call='setRegisterSubValue')
     def setRegisterSubValue(self, reg, subInd, val):
         """
         Sets the given register sub-value on the arm controller.
@@ -145,14 +524,86 @@ class MeArmI2C:
         @param val: The value to set for this register sub-value.
 
         @raises: IOError and a message if an error occured reading the register.
+                 In pipelined mode the error is raised by a later flush().
         """
         # Set the register sub value
-        self.bus.write_i2c_block_data(self.i2cAddr, reg, [subInd, val]);
+        self._bus(self.bus.write_i2c_block_data, reg, [subInd, val])
         self._settleDelay()
-        # Check for error
-        self.getError()
+        # Check for error, or defer the check when pipelined
+        self._written({'reg': reg, 'subInd': subInd, 'val': val})
+        # The slave may move the joint to within the new limit
+        self.invalidate(reg, None)
+
+    @timed('mearm_i2c_call', call='getState')
+    def getState(self):
+        """
+        Reads the position and limits for all joints in one block transfer.
+
+        The RegState register returns StateLen bytes laid out as:
 
-    def joint(self, name, pos=None):
+            [base pos, base min, base max,
+             shoulder pos, shoulder min, shoulder max,
+             wrist pos, wrist min, wrist max,
+             grip pos, grip min, grip max,
+             error]
+
+        where the final byte is the error register value for the block read.
+        This replaces the twelve separate register/sub-value reads, each with
+        their own settle delays and error checks, with a single bus round trip.
+
+        @return: A dictionary keyed on joint register (see Joints) with each
+                 value a dictionary with 'pos', 'min' and 'max' keys.
+
+        @raises: IOError and a message if an error occured reading the state.
+        """
+        # Verify outstanding pipelined writes before reading.
+        self.flush()
+        block = self._bus(self.bus.read_i2c_block_data, self.RegState,
+                          self.StateLen)
+        if len(block) != self.StateLen:
+            raise IOError({"code": "eDLen",
+                           "err": "Expected {} state bytes, got {}"\
+                                  .format(self.StateLen, len(block))})
+        # The error byte is the last one in the block
+        err = block[-1]
+        if err:
+            e = self.OpErrors[err]
+            raise IOError({"code": e["c"], "err": e["e"]})
+
+        n = len(self.StateFields)
+        state = {}
+        for i, reg in enumerate(self.Joints):
+            state[reg] = dict(zip(self.StateFields, block[i*n:(i+1)*n]))
+            # Refresh the cache
+            for f, v in state[reg].items():
+                self._cachePut(reg, self.FieldSubInd[f], v)
+
+        return state
+
+    def jointState(self, name, fresh=False):
+        """
+        Returns the position and limits for a single joint.
+
+        The values are returned from the cache if all of them are cached, else
+        they are all read from the slave with a bulk state read.
+
+        @param name: The joint name as defined by one of the Reg* class
+               attributes.
+        @param fresh: If True, always read from the slave.
+        @return: A dictionary with 'pos', 'min' and 'max' keys.
+        @raises: IOError if an error occurs.
+        """
+        if not fresh:
+            state = {}
+            for f in self.StateFields:
+                state[f] = self._cacheGet(name, self.FieldSubInd[f])
+                if state[f] is None:
+                    break
+            else:
+                return state
+        return self.getState()[name]
+
+    def joint(self, name, pos=None, fresh=False):
         """
         Gets or sets the position for a joint.
 
@@ -161,19 +612,21 @@ class MeArmI2C:
         @param pos: If supplied, set the joint position to this position in
                degrees, and returns the new position. If not supplied, or None,
                only return the current position.
+        @param fresh: When getting, always read from the slave instead of
+               returning a cached value.
         @return: The current or new position that was set.
         @raises: IOError if an error occurs.
         """
         # Do we set or get?
         if pos is None:
-            p = self.getRegister(name)
+            p = self.getRegister(name, fresh)
         else:
             self.setRegister(name, pos)
             p = pos
 
         return p
 
-    def jointLimit(self, name, limInd, lim=None):
+    def jointLimit(self, name, limInd, lim=None, fresh=False):
         """
         Gets or sets a joint position limit.
 
@@ -184,6 +637,8 @@ class MeArmI2C:
         @param lim: If supplied, set the joint limit to this value in degrees,
                and returns the new limit. If not supplied, or None, only return
                the current limit.
+        @param fresh: When getting, always read from the slave instead of
+               returning a cached value.
 
         @return: The current or new joint limit that was set.
         @raises: IOError if an error occurs.
@@ -200,7 +655,7 @@ class MeArmI2C:
 
         # Do we set or get?
         if lim is None:
-            l = self.getRegisterSubVal(name, subInd)
+            l = self.getRegisterSubVal(name, subInd, fresh)
         else:
             self.setRegisterSubValue(name, subInd, lim)
             l = lim
@@ -211,4 +666,7 @@ class MeArmI2C:
         """
         Closes the connection to the SMBus.
         """
-        self.bus.close()
+        try:
+            self.flush()
+        finally:
+            self.bus.close()
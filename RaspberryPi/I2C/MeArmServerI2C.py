@@ -16,10 +16,112 @@ RaspberryPi connected to the MeArmI²C arduino via I²C.
 """
 
 import os, os.path
+import sys
 import json
 import cherrypy
 
 from MeArmControl import MeArmI2C
+from BusWorker import BusWorker
+from SimBus import SimSMBus
+from Metrics import REGISTRY, timed, describe
+from Profiler import PROFILER
+from Admission import AdmissionController, Rejected, rejectRequest
+from StaticCache import StaticCache, StaticAssets
+from Clock import monotonic
+
+describe('mearm_http_handler_seconds', "Time taken by REST handlers.")
+describe('mearm_http_handler_errors_total', "REST handler calls that raised "
+         "an error, including HTTP errors.")
+describe('mearm_http_request_seconds', "Time taken by whole requests, "
+         "including CherryPy and tools.")
+_requestTime = REGISTRY.histogram('mearm_http_request_seconds')
+
+def requestTimerTool():
+    """
+    Tool timing every request from the start of handling the resource to the
+    end of the request. Compared to the handler timings, this shows the time
+    spent in CherryPy and the tools.
+    """
+    t = monotonic()
+    def done():
+        _requestTime.observe(monotonic() - t)
+    cherrypy.request.hooks.attach('on_end_request', done)
+
+cherrypy.tools.requestTimer = cherrypy.Tool('on_start_resource',
+                                            requestTimerTool)
+
+def adminTool():
+    """
+    Tool restricting handlers to administrators.
+
+    If the 'admin.token' config value is set, the request must carry it in the
+    X-Admin-Token header. Without a token only requests from the local host are
+    allowed.
+    """
+    token = cherrypy.config.get('admin.token', None)
+    req = cherrypy.request
+    if token is not None:
+        if req.headers.get('X-Admin-Token', None) != token:
+            raise cherrypy.HTTPError(403, "Admin token required.")
+    elif req.remote.ip not in ('127.0.0.1', '::1'):
+        raise cherrypy.HTTPError(403, "Only allowed from the local host.")
+
+cherrypy.tools.admin = cherrypy.Tool('before_handler', adminTool)
+
+def profilerTool():
+    """
+    Tool running requests under the profiler while it is sampling. It runs
+    before the other tools so that their time is included.
+    """
+    p = PROFILER.begin()
+    if p is not None:
+        cherrypy.request.hooks.attach('on_end_request',
+                                      lambda: PROFILER.end(p), priority=90)
+
+cherrypy.tools.profiler = cherrypy.Tool('on_start_resource', profilerTool,
+                                        priority=10)
+
+def admissionTool(coalesced=False):
+    """
+    Tool admitting requests that use the arm hardware through the admission
+    controller in the 'admission' config value. See Admission.
+
+    GET and HEAD requests only read cached state, so they are not subject to
+    admission control unless they ask for a 'fresh' read.
+
+    With coalesced set, PUTs with only a 'pos' are not subject to admission
+    control either. The bus worker coalesces position writes into one pending
+    write per joint (see BusWorker), and does not hold the request while the
+    write is sent, so these can not pile up on the bus. Admitting them one at
+    a time would instead stop the writes from ever being coalesced.
+
+    Rejected requests get a 429 or 503 response with a Retry-After header
+    without running the handler.
+    """
+    req = cherrypy.request
+    if req.method in ('GET', 'HEAD') and \
+       str(req.params.get('fresh', '0')).lower() not in ['1', 'true', 'yes']:
+        return
+    body = getattr(req, 'json', None)
+    if coalesced and req.method == 'PUT' and isinstance(body, dict) and \
+       body.keys() == ['pos']:
+        return
+    adm = cherrypy.config.get('admission', None)
+    if adm is None:
+        return
+    client = req.remote.ip
+    try:
+        adm.admit(client)
+    except Rejected, e:
+        rejectRequest(e.status, e.args[0], e.retryAfter)
+        return
+    req.hooks.attach('on_end_request', lambda: adm.release(client),
+                     failsafe=True)
+
+# After the control stick tool, so requests without control are not queued
+cherrypy.tools.admission = cherrypy.Tool('before_handler', admissionTool,
+                                         priority=70)
+
 
 class UI(object):
     """
@@ -29,9 +131,13 @@ class UI(object):
     @cherrypy.expose
     def index(self):
         """
-        Main index.
+        Main index, served from the static file cache. It is revalidated on
+        every load, so UI changes show up straight away.
         """
-        return open('web/html/index.html')
+        return cherrypy.config['staticCache'].serve('html/index.html',
+                                                    maxAge=0)
+    index._cp_config = {'tools.sessions.on': False,
+                        'tools.encode.on': False}
 
 
 def servicesErrorHandler(status, message, traceback, version):
@@ -89,6 +195,10 @@ class Joint(object):
     level 'exposed'attribute to True to allow cherrypy to dispatch to methods in
     this joint handler.
     """
+    # Bound the requests waiting for the bus. Position writes are coalesced by
+    # the bus worker instead, see admissionTool().
+    _cp_config = {'tools.admission.on': True,
+                  'tools.admission.coalesced': True}
 
     def __init__(self, jointName):
         """
@@ -105,6 +215,7 @@ class Joint(object):
         # Expose this instace to cherrypy
         self.exposed = True
 
+    @timed('mearm_http_handler', handler='Joint.GET')
     def GET(self, *args, **kwargs):
         """
         Return the current joint position, min or max positions, or a
@@ -122,8 +233,15 @@ class Joint(object):
             ../services/joint/limits -return the joint min and max positions
             ../services/joint/info   -return the current, min and max positions
 
+        Values are served from the arm interface cache unless the 'fresh' query
+        parameter is given a true value, e.g. ../services/joint/info?fresh=1
+
+        If the last position set for the joint failed, the error is returned
+        under the 'error' key.
+
         @keyword args: Optionally one of 'pos', 'min', 'max', 'limits' or 'info'
                  to indicate other than standard postion to return.
+        @keyword kwargs: Optionally 'fresh' to force a hardware read.
 
         @return: A dictionary with keys 'pos', 'min', 'max' keywords with the
                  requested values. One or more of these keys will be present.
@@ -131,23 +249,32 @@ class Joint(object):
         arm = cherrypy.config['MeArmIF']
 
         # Any additional detail required?
-        print args
         detail = None if len(args)==0 else args[0].lower()
-        print detail
         if detail not in [None, 'pos', 'min', 'max', 'limits', 'info']:
             raise cherrypy.HTTPError(400, "Invalid joint details request: {}"\
                                      .format(detail))
+        fresh = kwargs.get('fresh', '0').lower() in ['1', 'true', 'yes']
+        # Read the joint position and limits in one bus transaction, or from
+        # the cache.
+        try:
+            state = arm.jointState(self.jointReg, fresh)
+        except IOError, e:
+            raise cherrypy.HTTPError(400, str(e.args[0]))
         # Set up the return
         res = {}
         if detail in [None, 'pos', 'info']:
-            res['pos'] = arm.joint(self.jointReg)
+            res['pos'] = state['pos']
         if detail in ['min', 'limits', 'info']:
-            res['min'] = arm.jointLimit(self.jointReg, 'min')
+            res['min'] = state['min']
         if detail in ['max', 'limits', 'info']:
-            res['max'] = arm.jointLimit(self.jointReg, 'max')
+            res['max'] = state['max']
+        # The last position write failed. See BusWorker.joint()
+        if 'error' in state:
+            res['error'] = state['error']
 
         return res
 
+    @timed('mearm_http_handler', handler='Joint.PUT')
     def PUT(self, *args, **kwargs):
         """
         Set the current joint position and/or min and/or max limit.
@@ -158,6 +285,9 @@ class Joint(object):
               'max': integer ≥ 0 and ≤ 180,
             }
         where any of the fields are optional, but at least one is required.
+
+        A position is queued for the bus worker and the response does not wait
+        for it to be sent. If it fails, a following GET returns the error.
         """
         # Get the JSON doc as input from the request
         json = getattr(cherrypy.request, 'json', None)
@@ -188,21 +318,140 @@ class Joint(object):
 
         return json
 
+class Metrics(object):
+    """
+    Timing histograms and counters in the Prometheus text format.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return REGISTRY.render()
+
+class Profile(object):
+    """
+    Admin only on demand profiling of live requests. See Profiler.
+
+        GET    ../services/profile       -the profiling status
+        GET    ../services/profile/stats -the aggregated stats as text, with
+                                          optional 'sort' and 'limit' query
+                                          params
+        GET    ../services/profile/dump  -the aggregated stats in the pstats
+                                          file format
+        POST   ../services/profile       -start profiling for 'seconds'
+                                          seconds, sampling 'every' Nth
+                                          request, from a JSON object
+        DELETE ../services/profile       -stop profiling early
+    """
+    exposed = True
+    _cp_config = {'tools.admin.on': True}
+
+    def GET(self, *args, **kwargs):
+        if len(args) == 0:
+            return self._status()
+        if args[0] == 'stats':
+            try:
+                text = PROFILER.report(kwargs.get('sort', 'cumulative'),
+                                       int(kwargs.get('limit', 40)))
+            except (KeyError, ValueError):
+                raise cherrypy.HTTPError(400, "Invalid sort or limit.")
+            cherrypy.response.headers['Content-Type'] = 'text/plain'
+            return text
+        if args[0] == 'dump':
+            data = PROFILER.dump()
+            if data is None:
+                raise cherrypy.HTTPError(404, "No requests sampled.")
+            cherrypy.response.headers['Content-Type'] = \
+                    'application/octet-stream'
+            cherrypy.response.headers['Content-Disposition'] = \
+                    'attachment; filename="mearm.prof"'
+            return data
+        raise cherrypy.HTTPError(400, "Invalid profile request: {}"\
+                                 .format(args[0]))
+
+    def POST(self, *args, **kwargs):
+        req = getattr(cherrypy.request, 'json', None) or {}
+        try:
+            PROFILER.start(float(req.get('seconds', 10)),
+                           int(req.get('every', 1)))
+        except (AttributeError, TypeError, ValueError), e:
+            raise cherrypy.HTTPError(400, str(e))
+        return self._status()
+
+    def DELETE(self, *args, **kwargs):
+        PROFILER.stop()
+        return self._status()
+
+    def _status(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(PROFILER.status())
+
+class SimStats(object):
+    """
+    Call counters of the simulated backend, for measuring the hardware calls
+    per request when benchmarking. Only mounted when running with the
+    simulated backend.
+    """
+    exposed = True
+
+    def GET(self, *args, **kwargs):
+        return dict(cherrypy.config['simBackend'].calls)
 
 
 
 if __name__ == '__main__':
+    # An optional config file can be given on the command line, for example
+    # sim.conf to run against a simulated bus.
+    if len(sys.argv) > 1:
+        cherrypy.config.update(sys.argv[1])
+    # The bus backend is the real I²C bus ('smbus') or a simulated one ('sim')
+    # with the SimSMBus keyword args from 'i2c.sim'.
+    bus = None
+    if cherrypy.config.get('i2c.backend', 'smbus') == 'sim':
+        bus = SimSMBus(42, **cherrypy.config.get('i2c.sim', {}))
+        cherrypy.log("Using the simulated I²C bus")
+    # Learn the settle delay from the slave on startup
+    arm = MeArmI2C(42, bus=bus, settle='auto')
+    cherrypy.log("I²C settle delay learned as {:.4f}s"\
+                 .format(arm.settleLearned))
+    # All bus access goes through the bus worker thread
+    busWorker = BusWorker(arm)
+    busWorker.start()
+    cherrypy.engine.subscribe('stop', busWorker.stop)
+
+    # Serve the web UI files from memory
+    staticCache = StaticCache('web',
+                              maxAge=cherrypy.config.get('static.maxAge', 3600))
+    staticCache.preload()
+
+    # Admission control for the requests using the arm hardware that the bus
+    # worker does not coalesce: limit writes and fresh reads. Two are admitted
+    # so the worker has the next command queued while it runs one, and the
+    # rest fail fast instead of holding request threads.
+    admission = AdmissionController(
+            maxActive=cherrypy.config.get('admission.active', 2),
+            maxQueue=cherrypy.config.get('admission.queue', 8),
+            perClient=cherrypy.config.get('admission.perClient', 4),
+            timeout=cherrypy.config.get('admission.timeout', 0.5))
+
     cherrypy.config.update({
         'server.socket_host': '0.0.0.0',
         'server.socket_port': 8081,
         'server.thread_pool': 10,
-        'server.thread_pool_max': -1,
-        'MeArmIF': MeArmI2C(42),
+        'server.thread_pool_max': 20,
+        'MeArmIF': busWorker,
+        'simBackend': bus,
+        'admission': admission,
+        'staticCache': staticCache,
     })
+    # Settings in the config file override the defaults above
+    if len(sys.argv) > 1:
+        cherrypy.config.update(sys.argv[1])
     conf = {
         '/': {
             'tools.sessions.on': True,
-            'tools.staticdir.root': os.path.abspath(os.getcwd()),
+            'tools.requestTimer.on': True,
+            'tools.profiler.on': True,
         },
         '/services': {
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
@@ -211,13 +460,20 @@ if __name__ == '__main__':
             'tools.json_in.on': True,
             'tools.json_out.on': True,
         },
-        '/static': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': './web'
+        '/services/profile': {
+            'tools.json_out.on': False,
+            'tools.sessions.on': False,
+        },
+        '/services/metrics': {
+            'tools.json_in.on': False,
+            'tools.json_out.on': False,
+            'tools.sessions.on': False,
         }
     }
     # Hang the UI off '/'
     webapp = UI()
+    # The web UI files
+    webapp.static = StaticAssets(staticCache)
 
     # Set up the main /services/ endpoint
     webapp.services = WebService()
@@ -226,6 +482,13 @@ if __name__ == '__main__':
     webapp.services.shoulder = Joint('Shoulder')
     webapp.services.wrist = Joint('Wrist')
     webapp.services.grip = Joint('Grip')
+    # Metrics
+    webapp.services.metrics = Metrics()
+    # On demand profiling
+    webapp.services.profile = Profile()
+    # Simulated backend call counters
+    if bus is not None:
+        webapp.services.sim = SimStats()
 
     # Start the app
     cherrypy.quickstart(webapp, '/', conf)
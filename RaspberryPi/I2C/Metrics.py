@@ -0,0 +1 @@
+../GPIODirect/Metrics.py
\ No newline at end of file
@@ -0,0 +1 @@
+../GPIODirect/Profiler.py
\ No newline at end of file
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+##
+# A simulated I²C bus with the MeArm slave on it, for running and measuring
+# the MeArmI2C interface and server without hardware.
+##
+
+import time
+import random
+import threading
+from collections import defaultdict
+
+from FakeSlave import FakeMeArmSlave
+
+class SimSMBus(FakeMeArmSlave):
+    """
+    FakeMeArmSlave with a timing and fault model.
+
+    On top of the register protocol and error register emulated by
+    FakeMeArmSlave, this models:
+
+        - the bus transfer time for every transaction,
+        - the slave being busy handling a write for a while, during which it
+          does not ACK its address and any transaction fails with the same
+          IOError smbus raises,
+        - the servo slew rate, with the physical position of each joint
+          available from actual(),
+        - injected NACKs on any transaction.
+
+    Pass an instance as the bus argument when instantiating MeArmI2C:
+
+        arm = MeArmI2C(42, bus=SimSMBus(42, busy=0.002))
+
+    Every transaction is counted per method in the calls attribute.
+    """
+
+    def __init__(self, addr, latency=0.0003, jitter=0.0001, busy=0.002,
+                 slew=0.12, failRate=0.0, seed=None, **kwargs):
+        """
+        Instance initialization.
+
+        @param addr: The I²C address this slave answers on.
+        @param latency: Bus transfer time per transaction in seconds.
+        @param jitter: Max random extra time per transaction in seconds.
+        @param busy: Time in seconds the slave needs to handle a write before
+               it ACKs its address again.
+        @param slew: Servo speed in seconds per 60°, as found in servo data
+               sheets.
+        @param failRate: Probability of any transaction being NACKed.
+        @param seed: Optional random seed for repeatable jitter and faults.
+        @param kwargs: Passed on to FakeMeArmSlave.
+        """
+        super(SimSMBus, self).__init__(addr, **kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.busy = busy
+        # Servo speed in degrees per second
+        self.slewRate = 60.0 / slew
+        self.failRate = failRate
+        self.failNext = 0
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        # The time until which the slave is busy with the last write
+        self._busyUntil = 0
+        # Slew state per joint register as {reg: (start pos, start time)}
+        self._moves = {}
+        # Transaction counters per method name, and the number of NACKs
+        self.calls = defaultdict(int)
+        self.nacks = 0
+
+    def inject(self, failNext=0, failRate=None):
+        """
+        Injects faults.
+
+        @param failNext: The number of following transactions that are NACKed.
+        @param failRate: If not None, the new probability of any transaction
+               being NACKed.
+        """
+        self.failNext = failNext
+        if failRate is not None:
+            self.failRate = failRate
+
+    def _transfer(self, name, write=False):
+        """
+        Counts a transaction, applies the timing model and injects faults.
+        """
+        with self._lock:
+            self.calls[name] += 1
+            fail = self.failNext > 0 or self._rand.random() < self.failRate
+            if self.failNext > 0:
+                self.failNext -= 1
+            delay = self.latency + self._rand.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+        if fail or time.time() < self._busyUntil:
+            self.nacks += 1
+            raise IOError(121, "Remote I/O error")
+        if write:
+            self._busyUntil = time.time() + self.busy
+
+    def actual(self, reg):
+        """
+        Returns the simulated physical position of a joint, taking the slew
+        rate into account. Not part of the SMBus interface.
+
+        @param reg: The joint register.
+        """
+        target = self.joints[reg]['pos']
+        if reg not in self._moves:
+            return target
+        start, t = self._moves[reg]
+        moved = (time.time() - t) * self.slewRate
+        if abs(target - start) <= moved:
+            return target
+        return start + moved if target > start else start - moved
+
+    def write_byte(self, addr, reg):
+        self._transfer('write_byte')
+        super(SimSMBus, self).write_byte(addr, reg)
+
+    def write_byte_data(self, addr, reg, val):
+        self._transfer('write_byte_data', write=True)
+        start = self.actual(reg) if reg in self.joints else None
+        super(SimSMBus, self).write_byte_data(addr, reg, val)
+        if start is not None:
+            self._moves[reg] = (start, time.time())
+
+    def write_i2c_block_data(self, addr, reg, vals):
+        self._transfer('write_i2c_block_data', write=True)
+        start = self.actual(reg) if reg in self.joints else None
+        super(SimSMBus, self).write_i2c_block_data(addr, reg, vals)
+        # A new limit may have moved the joint
+        if start is not None and start != self.joints[reg]['pos']:
+            self._moves[reg] = (start, time.time())
+
+    def read_byte(self, addr):
+        self._transfer('read_byte')
+        return super(SimSMBus, self).read_byte(addr)
+
+    def read_i2c_block_data(self, addr, reg, length):
+        self._transfer('read_i2c_block_data')
+        return super(SimSMBus, self).read_i2c_block_data(addr, reg, length)
@@ -0,0 +1 @@
+../GPIODirect/StaticCache.py
\ No newline at end of file
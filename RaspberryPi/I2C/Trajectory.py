@@ -0,0 +1 @@
+../GPIODirect/Trajectory.py
\ No newline at end of file
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+##
+# Tests for the MeArmI2C interface and the BusWorker against FakeMeArmSlave.
+#
+# Run from this directory with:
+#
+#   python -m unittest test_MeArmControl
+##
+
+import unittest
+
+from MeArmControl import MeArmI2C
+from BusWorker import BusWorker
+from FakeSlave import FakeMeArmSlave
+
+ADDR = 42
+
+def newArm(**kwargs):
+    """
+    @return: A MeArmI2C instance on a FakeMeArmSlave without settle delays.
+    """
+    return MeArmI2C(ADDR, bus=FakeMeArmSlave(ADDR), settle=0, **kwargs)
+
+
+class StateTest(unittest.TestCase):
+    """
+    Bulk state reads and the register cache.
+    """
+
+    def setUp(self):
+        self.arm = newArm()
+        self.slave = self.arm.bus
+
+    def testStateIsOneTransaction(self):
+        self.slave.joints[MeArmI2C.RegWrist]['pos'] = 45
+        n = self.slave.transactions
+        state = self.arm.getState()
+        self.assertEqual(self.slave.transactions - n, 1)
+        self.assertEqual(sorted(state), sorted(MeArmI2C.Joints))
+        self.assertEqual(state[MeArmI2C.RegWrist],
+                         {'pos': 45, 'min': 0, 'max': 180})
+
+    def testStateFillsCache(self):
+        self.arm.getState()
+        n = self.slave.transactions
+        self.assertEqual(self.arm.jointState(MeArmI2C.RegBase),
+                         {'pos': 90, 'min': 0, 'max': 180})
+        self.assertEqual(self.arm.joint(MeArmI2C.RegGrip), 90)
+        self.assertEqual(self.slave.transactions, n)
+
+    def testWritesAreCached(self):
+        self.arm.joint(MeArmI2C.RegShoulder, 120)
+        n = self.slave.transactions
+        self.assertEqual(self.arm.joint(MeArmI2C.RegShoulder), 120)
+        self.assertEqual(self.slave.transactions, n)
+
+    def testFailedWriteIsNotCached(self):
+        self.arm.jointLimit(MeArmI2C.RegBase, 'max', 100)
+        self.assertRaises(IOError, self.arm.joint, MeArmI2C.RegBase, 150)
+        self.assertEqual(self.arm.joint(MeArmI2C.RegBase), 90)
+
+    def testFreshAndInvalidate(self):
+        self.arm.getState()
+        # Changed behind the interface's back
+        self.slave.joints[MeArmI2C.RegBase]['pos'] = 10
+        self.assertEqual(self.arm.joint(MeArmI2C.RegBase), 90)
+        self.assertEqual(self.arm.joint(MeArmI2C.RegBase, fresh=True), 10)
+        self.slave.joints[MeArmI2C.RegBase]['pos'] = 20
+        self.arm.invalidate(MeArmI2C.RegBase)
+        self.assertEqual(self.arm.joint(MeArmI2C.RegBase), 20)
+
+    def testLimitMovesJoint(self):
+        self.arm.joint(MeArmI2C.RegGrip, 150)
+        self.arm.jointLimit(MeArmI2C.RegGrip, 'max', 100)
+        self.assertEqual(self.arm.joint(MeArmI2C.RegGrip), 100)
+
+
+class PipelineTest(unittest.TestCase):
+    """
+    Pipelined writes, verified by flush().
+    """
+
+    def setUp(self):
+        self.arm = newArm()
+        self.slave = self.arm.bus
+
+    def testBatchApplied(self):
+        with self.arm.pipeline():
+            self.arm.joint(MeArmI2C.RegBase, 30)
+            self.arm.joint(MeArmI2C.RegShoulder, 100)
+        self.assertEqual(self.slave.joints[MeArmI2C.RegBase]['pos'], 30)
+        self.assertEqual(self.arm.joint(MeArmI2C.RegShoulder), 100)
+        self.assertEqual(self.arm._pending, [])
+
+    def testEarlierFailureIsReported(self):
+        self.arm.jointLimit(MeArmI2C.RegBase, 'max', 100)
+        try:
+            with self.arm.pipeline():
+                self.arm.joint(MeArmI2C.RegBase, 170)
+                # The last write succeeds, so the error register is clear
+                self.arm.joint(MeArmI2C.RegShoulder, 100)
+        except IOError, e:
+            info = e.args[0]
+        else:
+            self.fail("Failed write not reported")
+        self.assertEqual(info['code'], 'eNotApplied')
+        self.assertEqual([c['reg'] for c in info['failed']],
+                         [MeArmI2C.RegBase])
+        # The cache holds the slave's values, not the failed write
+        self.assertEqual(self.arm.joint(MeArmI2C.RegBase), 90)
+        self.assertEqual(self.arm.joint(MeArmI2C.RegShoulder), 100)
+
+    def testPositionBeforeLimit(self):
+        # The slave moves the joint to within the new limit, which is not a
+        # failure of the position write.
+        with self.arm.pipeline():
+            self.arm.joint(MeArmI2C.RegWrist, 150)
+            self.arm.jointLimit(MeArmI2C.RegWrist, 'max', 120)
+        self.assertEqual(self.arm.jointState(MeArmI2C.RegWrist),
+                         {'pos': 120, 'min': 0, 'max': 120})
+
+    def testFlushAtMaxPending(self):
+        with self.arm.pipeline(maxPending=2):
+            self.arm.joint(MeArmI2C.RegBase, 30)
+            self.arm.joint(MeArmI2C.RegShoulder, 100)
+            self.assertEqual(self.arm._pending, [])
+            self.arm.joint(MeArmI2C.RegWrist, 60)
+            self.assertEqual(len(self.arm._pending), 1)
+
+    def testRaisingBlockDropsWrites(self):
+        self.arm.jointLimit(MeArmI2C.RegBase, 'max', 100)
+        try:
+            with self.arm.pipeline():
+                self.arm.joint(MeArmI2C.RegBase, 150)
+                raise IOError(121, "Remote I/O error")
+        except IOError:
+            pass
+        self.assertEqual(self.arm._pending, [])
+        # A later read does not get the dropped write's error
+        self.assertEqual(self.arm.joint(MeArmI2C.RegBase), 90)
+
+
+class BusWorkerTest(unittest.TestCase):
+    """
+    Position write coalescing and error reporting by the BusWorker.
+    """
+
+    def setUp(self):
+        self.arm = newArm()
+        self.slave = self.arm.bus
+        self.worker = BusWorker(self.arm, timeout=2)
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def testCoalescing(self):
+        # Queued before the worker runs, so only the newest is sent
+        futures = [self.worker.setPosition(MeArmI2C.RegBase, p)
+                   for p in [10, 20, 30]]
+        self.worker.start()
+        self.assertEqual([f.result(2) for f in futures], [30, 30, 30])
+        self.assertEqual(self.worker.coalesced, 2)
+        self.assertEqual(self.slave.joints[MeArmI2C.RegBase]['pos'], 30)
+
+    def testJointDoesNotWait(self):
+        self.assertEqual(self.worker.joint(MeArmI2C.RegBase, 40), 40)
+        self.worker.start()
+        self.assertEqual(self.worker.joint(MeArmI2C.RegBase), 40)
+
+    def testErrorsPerWrite(self):
+        self.arm.jointLimit(MeArmI2C.RegBase, 'max', 100)
+        fBase = self.worker.setPosition(MeArmI2C.RegBase, 150)
+        fShoulder = self.worker.setPosition(MeArmI2C.RegShoulder, 100)
+        self.worker.start()
+        self.assertRaises(IOError, fBase.result, 2)
+        self.assertEqual(fShoulder.result(2), 100)
+        self.assertEqual(self.worker.writeError(MeArmI2C.RegBase)['code'],
+                         'eNotApplied')
+        self.assertEqual(self.worker.writeError(MeArmI2C.RegShoulder), None)
+        state = self.worker.jointState(MeArmI2C.RegBase)
+        self.assertEqual(state['pos'], 90)
+        self.assertEqual(state['error']['code'], 'eNotApplied')
+        self.assertFalse('error' in
+                         self.worker.jointState(MeArmI2C.RegShoulder))
+
+    def testErrorClearedByGoodWrite(self):
+        self.arm.jointLimit(MeArmI2C.RegBase, 'max', 100)
+        self.worker.start()
+        self.assertRaises(IOError,
+                          self.worker.setPosition(MeArmI2C.RegBase, 150).result,
+                          2)
+        self.worker.setPosition(MeArmI2C.RegBase, 50).result(2)
+        self.assertEqual(self.worker.writeError(MeArmI2C.RegBase), None)
+        self.assertFalse('error' in self.worker.jointState(MeArmI2C.RegBase))
+
+
+if __name__ == "__main__":
+    unittest.main()